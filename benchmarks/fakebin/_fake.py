@@ -0,0 +1,50 @@
+"""
+Shared parts of the fake hmmsearch, getorf and diamond
+Each record gets its own random state seeded by its sequence so the outputs are deterministic and, like a real
+search, don't depend on the names, the order or the sharding of the input. Set FAKE_TOOL_RATE to a number of residues per second to make
+the tools sleep as if they were searching
+"""
+
+import os
+import sys
+import gzip
+import time
+import zlib
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import synthetic
+
+
+def read_fasta(fname):
+    """
+    Yield (name, description, sequence) of the fasta records
+    """
+    fin = gzip.open(fname, 'rb') if fname.endswith(".gz") else open(fname, 'rb')
+    with fin:
+        name = None
+        for line in fin:
+            line = line.decode('ascii')
+            if line.startswith(">"):
+                if name is not None:
+                    yield (name, desc, "".join(seq))
+                spl = line[1:].strip().split(None, 1) + ['']
+                (name, desc, seq) = (spl[0], spl[1], [])
+            elif name is not None:
+                seq.append(line.strip())
+        if name is not None:
+            yield (name, desc, "".join(seq))
+
+
+def record_state(seq):
+    return np.random.RandomState(zlib.crc32(seq.upper().encode('ascii')) & 0xffffffff)
+
+
+def option(argv, opt, default=None):
+    return argv[argv.index(opt) + 1] if opt in argv else default
+
+
+def simulate(residues):
+    rate = float(os.environ.get("FAKE_TOOL_RATE", 0))
+    if rate > 0:
+        time.sleep(residues / rate)
@@ -0,0 +1,372 @@
+#!/usr/bin/env python
+"""
+Benchmark the pipeline stages on synthetic data, without Pfam, HMMER, EMBOSS or diamond.
+The external programs are replaced by the fake executables in benchmarks/fakebin. Every benchmark runs in
+a forked process and reports its wall and CPU time, peak RSS, the domain_classifier.metrics of its stages
+and optionally the peak of the traced Python memory (Python 3). The results are written as json and can be compared to the
+results of a previous version:
+
+    python benchmarks/run_benchmarks.py -o new.json --compare old.json
+"""
+
+from __future__ import division, print_function
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import traceback
+import resource
+import subprocess
+import multiprocessing
+from collections import OrderedDict
+
+BENCHDIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHDIR))
+sys.path.insert(0, BENCHDIR)
+import numpy as np
+import domain_classifier
+import domain_classifier.taxonomy
+import domain_classifier.krakenfilter
+import synthetic
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+def process_command_line(argv):
+    """
+    Return settings object.
+    `argv` is a list of arguments, or `None` for ``sys.argv[1:]``.
+    """
+    if argv is None:
+        argv = sys.argv[1:]
+    parser = argparse.ArgumentParser(
+        description='Benchmark the domain_classifier stages on synthetic data',
+        formatter_class=argparse.HelpFormatter)
+    parser.add_argument("-o", "--output", default="benchmarks.json",
+                        help="Write the results to this json file")
+    parser.add_argument("--compare", default=None,
+                        help="Compare to the results of a previous run and exit with 1 if a benchmark regressed")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="Relative wall time increase reported as a regression, default 0.25")
+    parser.add_argument("--workdir", default=None,
+                        help="Write the synthetic data here and keep it, a temporary directory by default")
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="Multiply all the data sizes by this factor")
+    parser.add_argument("--records", type=int, default=2000, help="Number of DNA records to classify")
+    parser.add_argument("--length", type=int, default=3000, help="Mean DNA record length")
+    parser.add_argument("--families", type=int, default=2000, help="Number of Pfam families")
+    parser.add_argument("--kraken_records", type=int, default=20000, help="Number of kraken fasta records")
+    parser.add_argument("--kraken_length", type=int, default=2000, help="Mean kraken record length")
+    parser.add_argument("--nodes", type=int, default=50000, help="Number of taxonomy nodes")
+    parser.add_argument("--threads", type=int, default=4, help="Threads, shards and workers of the parallel benchmarks")
+    parser.add_argument("--repeat", type=int, default=1, help="Run every benchmark this number of times, report the fastest")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed of the synthetic data")
+    parser.add_argument("--tracemalloc", default=False, action='store_true',
+                        help="Trace the Python memory allocations (Python 3), slows down the benchmarks")
+    parser.add_argument("--rate", type=float, default=0,
+                        help="Make the fake tools sleep as if they search this number of residues per second")
+    parser.add_argument("benchmarks", nargs="*",
+                        help="Run only these benchmarks, all by default")
+    return parser.parse_args(argv)
+
+
+def generate(workdir, settings):
+    """
+    Write the synthetic data set to workdir, return a dictionary of the file names
+    """
+    rng = np.random.RandomState(settings.seed)
+    scale = lambda x: max(1, int(x * settings.scale))
+    data = dict(workdir=workdir, dbdir=os.path.join(workdir, "db"), taxdir=os.path.join(workdir, "taxonomy"),
+                dna=os.path.join(workdir, "input.fna"), domtbl=os.path.join(workdir, "hits.domtbl"),
+                blout=os.path.join(workdir, "hits.blout"), kraken=os.path.join(workdir, "library.fna"),
+                seqid2taxid=os.path.join(workdir, "seqid2taxid.map"), table=os.path.join(workdir, "predictions.tsv"),
+                taxdb=os.path.join(workdir, "taxonomy.sqlite"), out=os.path.join(workdir, "out"))
+    os.makedirs(data['out'])
+    sys.stderr.write("Writing synthetic data to {}\n".format(workdir))
+    (fams, subjects) = synthetic.write_database(data['dbdir'], scale(settings.families), rng)
+    names = synthetic.write_dna_fasta(data['dna'], scale(settings.records), settings.length, rng)
+    synthetic.write_domtblout(data['domtbl'], names, fams, rng)
+    synthetic.write_diamond(data['blout'], names, subjects, rng)
+    accs = synthetic.kraken_accessions(scale(settings.kraken_records))
+    acctax = synthetic.write_taxonomy(data['taxdir'], scale(settings.nodes), accs, rng)
+    records = synthetic.write_kraken_fasta(data['kraken'], acctax, settings.kraken_length, rng)
+    synthetic.write_seqid2taxid(data['seqid2taxid'], acctax)
+    synthetic.write_prediction_table(data['table'], records, rng)
+    data['accessions'] = accs
+    data['domains'] = synthetic.domain_lists(scale(settings.records) * 10, fams, rng)
+    # Prepare the compiled model, hit index, taxonomy database and accession index used by the benchmarks
+    domain_classifier.read_likelihoods(data['dbdir'])
+    domain_classifier.build_hit_index(os.path.join(data['dbdir'], "Pfam-A.fasta.gz"), os.path.join(data['dbdir'], "Pfam-A.hits.sqlite"))
+    domain_classifier.taxonomy.build_taxonomy_db(data['taxdb'], data['taxdir'])
+    domain_classifier.taxonomy.accession_lookup(data['taxdb'], data['taxdb'] + ".idx")
+    domain_classifier.build_subset(data['dbdir'], 0.5)
+    return data
+
+
+def record_filter(data, lookup):
+    accdom = {}
+    domains = {'Eukaryota': 2759, 'Viruses': 10239, 'Bacteria': 2, 'Archaea': 2157}
+    with open(data['table'], 'r') as fin:
+        next(fin)
+        for line in fin:
+            spl = line.split("\t")
+            accdom[spl[0]] = domains[spl[4]]
+    lineages = domain_classifier.taxonomy.lineage_table(os.path.join(data['taxdir'], "nodes.dmp"))
+    return domain_classifier.krakenfilter.RecordFilter(accdom, lineages, lookup)
+
+
+# The benchmarks, each is a function of the data dictionary and the settings
+def bench_read_likelihoods_parse(data, settings):
+    domain_classifier.read_likelihoods(data['dbdir'], pseudocounts=2, compile=False)
+
+
+def bench_read_likelihoods_compiled(data, settings):
+    domain_classifier.read_likelihoods(data['dbdir'])
+
+
+def bench_translate(data, settings):
+    domain_classifier.write_proteins(domain_classifier.translate_fasta(data['dna']), os.path.join(data['out'], "orfs.faa"))
+
+
+def bench_getorf(data, settings):
+    domain_classifier.write_proteins(domain_classifier.run_getorf(data['dna']), os.path.join(data['out'], "orfs.faa"))
+
+
+def bench_parse_domtblout(data, settings):
+    for _ in domain_classifier.resolve_hits(domain_classifier.domtblout_hits(data['domtbl']), grouped=False):
+        pass
+
+
+def bench_parse_diamond(data, settings):
+    for _ in domain_classifier.resolve_hits(domain_classifier.diamond_hits(data['blout'])):
+        pass
+
+
+def bench_find_domains_hmm(data, settings):
+    domain_classifier.find_domains_hmm(data['dna'], data['dbdir'], os.path.join(data['out'], "orfs.faa"),
+                                       os.path.join(data['out'], "hmm.domtbl"), threads=settings.threads)
+
+
+def bench_find_domains_hmm_sharded(data, settings):
+    domain_classifier.find_domains_hmm(data['dna'], data['dbdir'], os.path.join(data['out'], "orfs.faa"),
+                                       os.path.join(data['out'], "hmm.domtbl"), threads=settings.threads, shards=settings.threads)
+
+
+def bench_find_domains_hmm_subset(data, settings):
+    domain_classifier.find_domains_hmm(data['dna'], data['dbdir'], os.path.join(data['out'], "orfs.faa"),
+                                       os.path.join(data['out'], "hmm.domtbl"), threads=settings.threads, subset=True)
+
+
+def bench_find_domains_hmm_dedup(data, settings):
+    domain_classifier.find_domains_hmm(data['dna'], data['dbdir'], os.path.join(data['out'], "orfs.faa"),
+                                       os.path.join(data['out'], "hmm.domtbl"), threads=settings.threads, dedup=True)
+
+
+def _chunk(settings):
+    # Eight chunks of the input
+    return max(1, int(settings.records * settings.scale) // 8)
+
+
+def bench_find_domains_hmm_chunked(data, settings):
+    for _ in domain_classifier.iter_domains_hmm(data['dna'], data['dbdir'], os.path.join(data['out'], "orfs.faa"),
+                                                os.path.join(data['out'], "hmm.domtbl"), threads=settings.threads,
+                                                chunk=_chunk(settings)):
+        pass
+
+
+def bench_find_domains_hmm_pipelined(data, settings):
+    for _ in domain_classifier.iter_domains_pipelined(data['dna'], data['dbdir'], os.path.join(data['out'], "orfs.faa"),
+                                                      os.path.join(data['out'], "hmm.domtbl"), threads=settings.threads,
+                                                      chunk=_chunk(settings)):
+        pass
+
+
+def bench_subset_report(data, settings):
+    domain_classifier.subset_report(data['domtbl'], domain_classifier.load_model(data['dbdir']),
+                                    domain_classifier.read_subset(data['dbdir']))
+
+
+def bench_find_domains(data, settings):
+    domain_classifier.find_domains(data['dna'], data['dbdir'], os.path.join(data['out'], "diamond.blout"), threads=settings.threads)
+
+
+def bench_compute_post(data, settings):
+    (model, _) = domain_classifier.read_likelihoods(data['dbdir'])
+    domain_classifier.compute_post(data['domains'], model)
+
+
+def bench_build_taxonomy_db(data, settings):
+    dbfile = os.path.join(data['out'], "taxonomy.sqlite")
+    if os.path.exists(dbfile):
+        os.remove(dbfile)
+    domain_classifier.taxonomy.build_taxonomy_db(dbfile, data['taxdir'])
+
+
+def bench_lineage_table(data, settings):
+    domain_classifier.taxonomy.lineage_table(os.path.join(data['taxdir'], "nodes.dmp"))
+
+
+def bench_lookup_sqlite(data, settings):
+    domain_classifier.taxonomy.accession_lookup(data['taxdb'], memory_limit=0).resolve(data['accessions'])
+
+
+def bench_lookup_index(data, settings):
+    domain_classifier.taxonomy.accession_lookup(data['taxdb'], data['taxdb'] + ".idx").resolve(data['accessions'])
+
+
+def bench_filter_fasta(data, settings):
+    make_filter = lambda: record_filter(data, domain_classifier.taxonomy.accession_lookup(data['taxdb'], data['taxdb'] + ".idx"))
+    with open(os.devnull, 'wb') as out:
+        domain_classifier.krakenfilter.filter_fasta(data['kraken'], make_filter, out)
+
+
+def bench_filter_fasta_workers(data, settings):
+    make_filter = lambda: record_filter(data, domain_classifier.taxonomy.accession_lookup(data['taxdb'], data['taxdb'] + ".idx"))
+    with open(os.devnull, 'wb') as out:
+        domain_classifier.krakenfilter.filter_fasta(data['kraken'], make_filter, out, workers=settings.threads,
+                                                    size=max(2**16, os.path.getsize(data['kraken']) // (4 * settings.threads)))
+
+
+def bench_filter_by_offsets(data, settings):
+    rfilter = record_filter(data, domain_classifier.taxonomy.accession_lookup(data['taxdb'], data['taxdb'] + ".idx"))
+    with open(os.path.join(data['out'], "filtered.fna"), 'wb') as out:
+        domain_classifier.krakenfilter.filter_by_offsets(
+            data['kraken'], rfilter, out, os.path.join(data['out'], "dropped.txt"),
+            (data['seqid2taxid'], os.path.join(data['out'], "seqid2taxid.map")))
+
+
+BENCHMARKS = OrderedDict((f.__name__[len("bench_"):], f) for f in (
+    bench_read_likelihoods_parse, bench_read_likelihoods_compiled, bench_translate, bench_getorf,
+    bench_parse_domtblout, bench_parse_diamond, bench_find_domains_hmm, bench_find_domains_hmm_sharded,
+    bench_find_domains_hmm_subset, bench_find_domains_hmm_dedup, bench_find_domains_hmm_chunked, bench_find_domains_hmm_pipelined, bench_subset_report, bench_find_domains, bench_compute_post, bench_build_taxonomy_db, bench_lineage_table,
+    bench_lookup_sqlite, bench_lookup_index, bench_filter_fasta, bench_filter_fasta_workers,
+    bench_filter_by_offsets))
+
+
+def _run(func, data, settings, queue):
+    try:
+        trace = settings.tracemalloc and tracemalloc is not None
+        if trace:
+            tracemalloc.start()
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        wall = time.time()
+        with domain_classifier.metrics.collect() as metrics:
+            func(data, settings)
+        wall = time.time() - wall
+        res = OrderedDict(metrics.todict())
+        end = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        res['wall'] = wall
+        res['cpu'] = end.ru_utime + end.ru_stime - usage.ru_utime - usage.ru_stime
+        res['children_cpu'] = children.ru_utime + children.ru_stime
+        if trace:
+            res['traced_peak_bytes'] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+    except Exception:
+        res = dict(error=traceback.format_exc())
+    queue.put(json.dumps(res))
+
+
+def run_benchmark(func, data, settings):
+    """
+    Run the benchmark in a forked process, return its measurements
+    """
+    queue = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=_run, args=(func, data, settings, queue))
+    proc.start()
+    res = json.loads(queue.get())
+    proc.join()
+    if 'error' in res:
+        raise RuntimeError("Benchmark {} failed:\n{}".format(func.__name__, res['error']))
+    return res
+
+
+def fake_tools(bindir):
+    """
+    Write hmmsearch, getorf and diamond wrappers running the fake tools with this interpreter
+    """
+    os.makedirs(bindir)
+    for tool in ("hmmsearch", "getorf", "diamond"):
+        fname = os.path.join(bindir, tool)
+        with open(fname, 'w') as fout:
+            fout.write('#!/bin/sh\nexec "{}" "{}" "$@"\n'.format(sys.executable, os.path.join(BENCHDIR, "fakebin", tool)))
+        os.chmod(fname, 0o755)
+
+
+def compare(results, baseline, threshold):
+    """
+    Print the wall time change of every benchmark, return the names of the regressed benchmarks
+    """
+    regressed = []
+    print("{:32s} {:>10s} {:>10s} {:>8s}".format("benchmark", "baseline", "wall", "change"))
+    for (name, res) in results.items():
+        if name not in baseline:
+            continue
+        (old, new) = (baseline[name]['wall'], res['wall'])
+        change = (new - old) / old if old > 0 else 0.0
+        flag = ""
+        if change > threshold:
+            regressed.append(name)
+            flag = " REGRESSION"
+        print("{:32s} {:10.3f} {:10.3f} {:+8.1%}{}".format(name, old, new, change, flag))
+    return regressed
+
+
+def commit():
+    try:
+        return subprocess.check_output(["git", "describe", "--always", "--dirty"], cwd=BENCHDIR, stderr=subprocess.STDOUT).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    settings = process_command_line(argv)
+    unknown = [x for x in settings.benchmarks if x not in BENCHMARKS]
+    if unknown:
+        sys.stderr.write("Unknown benchmarks: {}. Available: {}\n".format(", ".join(unknown), ", ".join(BENCHMARKS)))
+        return 2
+    workdir = settings.workdir or tempfile.mkdtemp(prefix="dcbench")
+    if settings.workdir and os.path.exists(workdir):
+        shutil.rmtree(workdir)
+    os.environ['PATH'] = os.pathsep.join([os.path.join(workdir, "bin"), os.environ.get('PATH', '')])
+    os.environ['PYTHONPATH'] = os.pathsep.join([os.path.dirname(BENCHDIR), os.environ.get('PYTHONPATH', '')])
+    os.environ['FAKE_TOOL_RATE'] = str(settings.rate)
+    try:
+        fake_tools(os.path.join(workdir, "bin"))
+        data = generate(workdir, settings)
+        results = OrderedDict()
+        for (name, func) in BENCHMARKS.items():
+            if settings.benchmarks and name not in settings.benchmarks:
+                continue
+            runs = [run_benchmark(func, data, settings) for _ in range(settings.repeat)]
+            results[name] = min(runs, key=lambda x: x['wall'])
+            results[name]['runs'] = [x['wall'] for x in runs]
+            sys.stderr.write("{:32s} {:8.3f}s wall {:8.3f}s cpu {:10d} KB peak RSS\n".format(
+                name, results[name]['wall'], results[name]['cpu'], results[name]['peak_rss_kb']))
+    finally:
+        if not settings.workdir:
+            shutil.rmtree(workdir)
+    report = OrderedDict((
+        ("commit", commit()), ("time", time.strftime("%Y-%m-%dT%H:%M:%S")),
+        ("python", sys.version.split()[0]), ("platform", platform.platform()),
+        ("settings", dict((k, v) for (k, v) in vars(settings).items() if k not in ('output', 'compare', 'workdir'))),
+        ("benchmarks", results)))
+    with open(settings.output, 'w') as fout:
+        json.dump(report, fout, indent=2)
+    if settings.compare:
+        with open(settings.compare, 'r') as fin:
+            baseline = json.load(fin)['benchmarks']
+        if compare(results, baseline, settings.threshold):
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    status = main()
+    sys.exit(status)
@@ -0,0 +1,235 @@
+"""
+Synthetic inputs for the benchmarks, in the formats of the real database and tool outputs:
+pfamA_tax_depth.txt.gz, Pfam-A.fasta.gz headers, Pfam-A.hmm accessions, DNA fasta with ORFs,
+hmmsearch domtblout, diamond tabular output, kraken library fasta, NCBI taxonomy dumps and
+predict_domain.py tables. All generators are deterministic given the random state
+"""
+
+import os
+import gzip
+import itertools
+import numpy as np
+
+TAXDOMAINS = ["Archaea", "Eukaryota", "Viruses", "Bacteria"]
+DOMAIN_TAXIDS = {"Bacteria": 2, "Archaea": 2157, "Eukaryota": 2759, "Viruses": 10239}
+ENVIRONMENTAL = 48479
+BASES = "TCAG"
+STOPS = ("TAA", "TAG", "TGA")
+SENSE = np.array([x for x in ("".join(c) for c in itertools.product(BASES, repeat=3)) if x not in STOPS], dtype="S3")
+
+
+def families(n):
+    """
+    Return n Pfam accessions
+    """
+    return ["PF{:05d}".format(i) for i in range(1, n + 1)]
+
+
+def write_tax_depth(fname, fams, rng):
+    """
+    Write pfamA_tax_depth.txt.gz, each family is found in a random subset of the taxonomic domains
+    """
+    with gzip.open(fname, 'wb') as fout:
+        for fam in fams:
+            for tax in TAXDOMAINS:
+                if rng.randint(3):
+                    fout.write("{}\t{}\t{}\n".format(fam, tax, rng.randint(1, 5000)).encode('ascii'))
+
+
+def write_pfam_fasta(fname, fams, per_family, rng):
+    """
+    Write Pfam-A.fasta.gz with per_family sequences of every family, return the list of sequence IDs
+    """
+    ids = []
+    with gzip.open(fname, 'wb') as fout:
+        for fam in fams:
+            for i in range(per_family):
+                sid = "{}_{}/1-{}".format(fam, i, 100)
+                ids.append(sid)
+                fout.write(">{} {}_{}.1 {}.1;fam{};\n{}\n".format(
+                    sid, fam, i, fam, fam[2:], "M" * 60).encode('ascii'))
+    return ids
+
+
+def write_hmm(fname, fams):
+    """
+    Write a Pfam-A.hmm stand-in with the NAME and ACC lines of the families, the fake hmmsearch reads it
+    """
+    with open(fname, 'w') as fout:
+        for fam in fams:
+            fout.write("HMMER3/f [3.1b2 | February 2015]\nNAME  fam{}\nACC   {}.1\nLENG  100\n//\n".format(fam[2:], fam))
+
+
+def random_dna(length, rng, orf_codons=(50, 400)):
+    """
+    Return a DNA sequence (bytes) made of stop free stretches of random lengths separated by stop codons
+    """
+    parts = []
+    total = 0
+    while total < length:
+        ncod = rng.randint(*orf_codons)
+        parts.append(SENSE[rng.randint(len(SENSE), size=ncod)].tobytes())
+        parts.append(STOPS[rng.randint(len(STOPS))].encode('ascii'))
+        total += ncod * 3 + 3
+    return b"".join(parts)[:length]
+
+
+def _wrap(seq, width=80):
+    return b"\n".join(seq[i:i + width] for i in range(0, len(seq), width))
+
+
+def write_dna_fasta(fname, nrecords, length, rng, prefix="seq"):
+    """
+    Write a DNA fasta with records of about length nucleotides, return the record names
+    """
+    names = []
+    with open(fname, 'wb') as fout:
+        for i in range(nrecords):
+            name = "{}{}".format(prefix, i)
+            names.append(name)
+            slen = max(30, int(rng.normal(length, length / 4.0)))
+            fout.write(">{} synthetic record {}\n".format(name, i).encode('ascii'))
+            fout.write(_wrap(random_dna(slen, rng)) + b"\n")
+    return names
+
+
+def write_domtblout(fname, targets, fams, rng, per_target=8):
+    """
+    Write a hmmsearch domtblout with a random number of hits (about per_target) on every target. The hits
+    of a target are spread in the file like hmmsearch orders them (by model)
+    """
+    rows = []
+    for target in targets:
+        tlen = rng.randint(200, 3000)
+        for _ in range(rng.poisson(per_target)):
+            fam = fams[rng.randint(len(fams))]
+            start = rng.randint(1, tlen - 100)
+            rows.append((fam, target, tlen, start, start + rng.randint(30, 100), 20 + rng.random_sample() * 200))
+    rows.sort()
+    with open(fname, 'w') as fout:
+        fout.write("# synthetic domtblout\n")
+        for (fam, target, tlen, start, end, score) in rows:
+            fout.write(domtbl_line(target, tlen, fam, score, start, end))
+        fout.write("# [ok]\n")
+
+
+def domtbl_line(target, tlen, fam, score, start, end):
+    """
+    Return a domtblout line, the columns the pipeline reads are the target, the accession,
+    the i-Evalue, the domain score and the envelope
+    """
+    return "{} - {} fam{} {}.1 100 1e-20 {:.1f} 0.0 1 1 1e-25 1e-22 {:.1f} 0.0 1 100 {} {} {} {} 0.95 -\n".format(
+        target, tlen, fam[2:], fam, score, score, start, end, start, end)
+
+
+def write_diamond(fname, queries, subjects, rng, per_query=8):
+    """
+    Write diamond tabular output (-f 6) with about per_query hits for every query, grouped by query
+    """
+    with open(fname, 'w') as fout:
+        for query in queries:
+            for _ in range(rng.poisson(per_query)):
+                start = rng.randint(1, 5000)
+                fout.write(diamond_line(query, subjects[rng.randint(len(subjects))], start, start + rng.randint(90, 300),
+                                        20 + rng.random_sample() * 200))
+
+
+def diamond_line(query, subject, start, end, score):
+    return "{}\t{}\t45.0\t100\t50\t2\t{}\t{}\t1\t100\t1e-10\t{:.1f}\n".format(query, subject, start, end, score)
+
+
+def write_taxonomy(taxdir, nnodes, accessions, rng):
+    """
+    Write nodes.dmp, names.dmp and nucl_gb.accession2taxid of a random tree below the taxonomic domains.
+    Return a dictionary accession -> taxid of the accessions, assigned to random leaves
+    """
+    if not os.path.exists(taxdir):
+        os.makedirs(taxdir)
+    nodes = [(1, 1, "no rank")] + [(t, 1, "superkingdom") for t in sorted(DOMAIN_TAXIDS.values())]
+    nodes.append((ENVIRONMENTAL, 2, "no rank"))
+    taxids = [x[0] for x in nodes[1:]]
+    for i in range(nnodes):
+        taxid = 100000 + i
+        nodes.append((taxid, taxids[rng.randint(len(taxids))], "species"))
+        taxids.append(taxid)
+    with open(os.path.join(taxdir, "nodes.dmp"), 'w') as fout:
+        for (taxid, parent, rank) in nodes:
+            fout.write("{}\t|\t{}\t|\t{}\t|\t\t|\n".format(taxid, parent, rank))
+    with open(os.path.join(taxdir, "names.dmp"), 'w') as fout:
+        for (taxid, _, _) in nodes:
+            fout.write("{}\t|\ttaxon {}\t|\t\t|\tscientific name\t|\n".format(taxid, taxid))
+    leaves = [x[0] for x in nodes[6:]] or [2]
+    acctax = {}
+    with open(os.path.join(taxdir, "nucl_gb.accession2taxid"), 'w') as fout:
+        fout.write("accession\taccession.version\ttaxid\tgi\n")
+        for i, acc in enumerate(accessions):
+            acctax[acc] = leaves[rng.randint(len(leaves))]
+            fout.write("{}\t{}.1\t{}\t{}\n".format(acc, acc, acctax[acc], i + 1))
+    return acctax
+
+
+def kraken_accessions(nrecords):
+    return ["NC_{:06d}".format(i) for i in range(nrecords)]
+
+
+def write_kraken_fasta(fname, acctax, length, rng, kraken_fraction=0.5):
+    """
+    Write a kraken library fasta, some headers are kraken:taxid|<taxid>|<accession> and the rest plain accessions
+    Return the record accessions (with version) in the file order
+    """
+    records = []
+    with open(fname, 'wb') as fout:
+        for acc in sorted(acctax):
+            rid = "{}.1".format(acc)
+            records.append(rid)
+            header = "kraken:taxid|{}|{}".format(acctax[acc], rid) if rng.random_sample() < kraken_fraction else rid
+            fout.write(">{} synthetic\n".format(header).encode('ascii'))
+            fout.write(_wrap(random_dna(max(30, int(rng.normal(length, length / 4.0))), rng)) + b"\n")
+    return records
+
+
+def write_seqid2taxid(fname, acctax):
+    """
+    Write a kraken seqid2taxid.map of the plain accession records
+    """
+    with open(fname, 'w') as fout:
+        for acc in sorted(acctax):
+            fout.write("{}.1\t{}\n".format(acc, acctax[acc]))
+
+
+def write_prediction_table(fname, records, rng, fraction=0.5):
+    """
+    Write a predict_domain.py table with random predictions of a fraction of the records
+    """
+    with open(fname, 'w') as fout:
+        fout.write("\t".join(["Record", "Description", "Length", "Number of Domains", "MAP"] + TAXDOMAINS + ["Margin"]) + "\n")
+        for rid in records:
+            if rng.random_sample() >= fraction:
+                continue
+            logpost = -rng.random_sample(len(TAXDOMAINS)) * 50
+            best = int(logpost.argmax())
+            top = np.sort(logpost)
+            fout.write("\t".join(str(x) for x in [rid, "synthetic", 1000, rng.randint(1, 30), TAXDOMAINS[best]] +
+                                 logpost.tolist() + [top[-1] - top[-2]]) + "\n")
+
+
+def domain_lists(nseqs, fams, rng, per_seq=8):
+    """
+    Return a dictionary sequence -> list(domains) like find_domains returns
+    """
+    return dict(("seq{}".format(i), [fams[j] for j in rng.randint(len(fams), size=rng.poisson(per_seq))])
+                for i in range(nseqs))
+
+
+def write_database(dbdir, nfamilies, rng, per_family=20):
+    """
+    Write a database directory with pfamA_tax_depth.txt.gz, Pfam-A.fasta.gz and Pfam-A.hmm
+    Return the family accessions and the Pfam-A.fasta sequence IDs
+    """
+    if not os.path.exists(dbdir):
+        os.makedirs(dbdir)
+    fams = families(nfamilies)
+    write_tax_depth(os.path.join(dbdir, "pfamA_tax_depth.txt.gz"), fams, rng)
+    ids = write_pfam_fasta(os.path.join(dbdir, "Pfam-A.fasta.gz"), fams, per_family, rng)
+    write_hmm(os.path.join(dbdir, "Pfam-A.hmm"), fams)
+    return (fams, ids)
@@ -9,6 +9,7 @@ import os
 import os.path
 import argparse
 import subprocess
+import domain_classifier
 from collections import defaultdict
 
 def process_command_line(argv):
@@ -27,6 +28,20 @@ def process_command_line(argv):
     parser.add_argument(
         '--nodiamond', default=False, action='store_true',
         help="Don't build diamond DB, predict_domain.py with --diamond will fail")
+    parser.add_argument(
+        '--subset_coverage', type=float, default=None,
+        help="Build a discriminative subset of Pfam, Pfam-A.subset.hmm (hmmpressed) and the Pfam-A.subset diamond DB, "
+        "with the most informative families that carry this fraction (0-1) of the total information. "
+        "Use it with predict_domain.py --subset")
+    parser.add_argument(
+        '--subset_only', default=False, action='store_true',
+        help="Don't download, only build the subset in an existing database directory")
+    parser.add_argument(
+        '--subset_report', default=None,
+        help="hmmsearch domtblout of a search of the full Pfam-A.hmm, report the MAP calls the subset changes")
+    parser.add_argument(
+        '--hmmpress', default='hmmpress',
+        help="hmmpress executable")
     settings = parser.parse_args(argv)
     return settings
 
@@ -37,12 +52,34 @@ def main(argv=None):
     fasta_in = "ftp://ftp.ebi.ac.uk/pub/databases/Pfam/current_release/Pfam-A.fasta.gz"
     hmm_in = "ftp://ftp.ebi.ac.uk/pub/databases/Pfam/current_release/Pfam-A.hmm.gz"
     tax_base = "ftp://ftp.ebi.ac.uk/pub/databases/Pfam/current_release/database_files/pfamA_tax_depth.txt.gz"
-    subprocess.check_call("wget -q -P {} {} {} {}".format(outdir, fasta_in, tax_base, hmm_in), shell=True)
-    # Run diamond build db
-    if (not settings.nodiamond):
-        subprocess.check_call("diamond makedb --in {}/Pfam-A.fasta.gz -d {}/Pfam-A".format(outdir, outdir), shell=True)
-    subprocess.check_call("gunzip {}/Pfam-A.hmm.gz".format(outdir), shell=True)
+    version_in = "ftp://ftp.ebi.ac.uk/pub/databases/Pfam/current_release/Pfam.version.gz"
+    if not settings.subset_only:
+        subprocess.check_call("wget -q -P {} {} {} {} {}".format(outdir, fasta_in, tax_base, hmm_in, version_in), shell=True)
+        # Run diamond build db
+        if (not settings.nodiamond):
+            subprocess.check_call("diamond makedb --in {}/Pfam-A.fasta.gz -d {}/Pfam-A".format(outdir, outdir), shell=True)
+            # Index the diamond subjects to their Pfam family
+            domain_classifier.build_hit_index("{}/Pfam-A.fasta.gz".format(outdir), "{}/{}".format(outdir, domain_classifier.pfamindex.HIT_INDEX))
+        subprocess.check_call("gunzip {}/Pfam-A.hmm.gz".format(outdir), shell=True)
+        # Compile the likelihoods with the default pseudocounts
+        domain_classifier.load_model(outdir)
 #    subprocess.check_call("hmmpress -f {}/Pfam-A.hmm".format(outdir), shell=True)
+    if settings.subset_coverage is not None:
+        # Keep only the families that move the posteriors
+        (families, nmodels) = domain_classifier.build_subset(outdir, settings.subset_coverage, fasta=not settings.nodiamond)
+        subprocess.check_call("{} -f {}/{}".format(settings.hmmpress, outdir, domain_classifier.SUBSET_HMM), shell=True)
+        if (not settings.nodiamond):
+            subprocess.check_call("diamond makedb --in {}/{} -d {}/{}".format(
+                outdir, domain_classifier.subset.SUBSET_FASTA, outdir, domain_classifier.SUBSET_DIAMOND), shell=True)
+        sys.stderr.write("Subset of {} families ({} models) carries {:.0%} of the information\n".format(
+            len(families), nmodels, settings.subset_coverage))
+    if settings.subset_report:
+        report = domain_classifier.subset_report(settings.subset_report, domain_classifier.load_model(outdir),
+                                                 domain_classifier.read_subset(outdir))
+        print "\t".join(["Record", "MAP", "Subset MAP"])
+        for (name, full, sub) in report['calls']:
+            print "\t".join([name, full, sub or "-"])
+        sys.stderr.write("The subset changes {} of {} MAP calls\n".format(report['changed'], report['sequences']))
     
     return 0
 
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+"""
+Classify many inputs (e.g. every library/*/library.fna of a kraken database) under one CPU and memory budget and
+optionally filter each of them like filter_kraken_db.py. The model and the taxonomy are loaded once, each input
+gets its own predictions table in the output directory and a rerun continues where the previous run stopped
+"""
+
+from __future__ import division
+import domain_classifier
+import domain_classifier.batch
+import domain_classifier.taxonomy
+import domain_classifier.metrics
+import sys
+import argparse
+import logging
+import multiprocessing
+
+def process_command_line(argv):
+    """
+    Return settings object.
+    `argv` is a list of arguments, or `None` for ``sys.argv[1:]``.
+    """
+    if argv is None:
+        argv = sys.argv[1:]
+    parser = argparse.ArgumentParser(
+        description='Classify and filter many inputs under a shared CPU and memory budget',
+        formatter_class=argparse.HelpFormatter)
+    parser.add_argument("-d", "--dir", default=".",
+                        help="Database directory")
+    parser.add_argument("-o", "--outdir", required=True,
+                        help="Output directory, <name>.tsv is the predictions table of each input. Rerun with the same directory to resume")
+    parser.add_argument("-p", "--protein", default=False, action='store_true',
+                        help="Inputs are protein")
+    parser.add_argument("--threads", type=int, default=multiprocessing.cpu_count(),
+                        help="Total number of cores of all the stages. Default is the number of CPUs")
+    parser.add_argument("--memory", type=int, default=None,
+                        help="Total memory (in MB) of all the stages. Default is three quarters of the physical memory")
+    parser.add_argument("--search_threads", type=int, default=4,
+                        help="Number of threads of each hmmsearch. Default is %(default)s")
+    parser.add_argument("--limit", type=int, default=100,
+                        help="Limit the number of proteins from each sequence to this number. Default is 100")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Random seed of the proteins selected with --limit. Default is 0")
+    parser.add_argument("--weighted", default=False, action='store_true',
+                        help="Select the proteins proportionally to their length, see predict_domain.py")
+    parser.add_argument("--shards", type=int, default=1,
+                        help="Split the proteins of each input and run this number of hmmsearch processes, at most --search_threads. Default is 1")
+    parser.add_argument("--dedup", default=False, action='store_true',
+                        help="Search identical sequences of each input once, see predict_domain.py")
+    parser.add_argument("--subset", default=False, action='store_true',
+                        help="Search the discriminative subset of Pfam, see predict_domain.py")
+    parser.add_argument("--pseudocounts", type=int, default=1,
+                        help='Pseudocounts of the likelihoods. Default is 1')
+    parser.add_argument(
+        '--hmmsearch', default='hmmsearch',
+        help='hmmsearch executable, default hmmsearch')
+    parser.add_argument(
+        '--filter', default=False, action='store_true',
+        help='Filter each input as a kraken fasta file by its predictions to <name>.filtered.fna, see filter_kraken_db.py')
+    parser.add_argument(
+        '--dbfile', default=None,
+        help='Taxonomy database file of --filter, built from --taxonomy if missing or incomplete')
+    parser.add_argument(
+        '--taxonomy',
+        help="path taxonomy directory of kraken2 DB, should contain names.dmp, nodes.dmp and *accession2taxid files")
+    parser.add_argument(
+        '--acc_index', default=None,
+        help='Sorted accession index prefix, built from the database if missing. Default is <dbfile>.idx')
+    parser.add_argument(
+        '--dropped', default=False, action='store_true',
+        help='Write the accessions of the dropped records of each input to <name>.dropped.txt')
+    parser.add_argument(
+        '--mindomains', type=int, default=5,
+        help='Minimal number of domains to consider. Less than that will pass')
+    parser.add_argument(
+        '--mindiff', type=float, default=1.0,
+        help='Minimal log probability difference between the MAP and the second to best')
+    parser.add_argument(
+        '--filter_virus', default=False, action='store_true',
+        help='By default keep all sequences originating from viral genomes, use this to filter them')
+    parser.add_argument(
+        '--filter_archaea', default=False, action='store_true',
+        help='By default keep all sequences originating from archaea genomes, use this to filter them')
+    parser.add_argument(
+        '--filter_enviro', default=False, action='store_true',
+        help='Set to remove environmental samples')
+    parser.add_argument(
+        '--trust_archaea', default=False, action='store_true',
+        help='By default keep all sequences that map to archaea, use this to filter them')
+    parser.add_argument(
+        '--trust_viruses', default=False, action='store_true',
+        help='By default keep all sequences that map to viruses, use this to filter them')
+    parser.add_argument(
+        '--metrics', default=None,
+        help='Write the time, CPU, memory and I/O of each stage to this json file, - for STDERR')
+    parser.add_argument(
+        'inputs', nargs='+',
+        help='Input fasta files')
+    settings = parser.parse_args(argv)
+    if settings.filter and (not settings.dbfile or settings.dbfile == ':memory:'):
+        parser.error("--filter requires a --dbfile file")
+    return settings
+
+
+def load_taxonomy(settings):
+    """
+    Build the taxonomy database if needed, return the lineages and the accession index
+    """
+    if not domain_classifier.taxonomy.taxonomy_db_complete(settings.dbfile):
+        if not settings.taxonomy:
+            raise ValueError("The taxonomy database {} is incomplete, use --taxonomy to build it".format(settings.dbfile))
+        logging.info(settings.taxonomy)
+        domain_classifier.taxonomy.build_taxonomy_db(settings.dbfile, settings.taxonomy)
+    lineages = domain_classifier.taxonomy.taxonomy_lineages(settings.dbfile, settings.taxonomy)
+    # The sorted index is shared by the forked filters, an SQLite connection can't be
+    lookup = domain_classifier.taxonomy.accession_lookup(settings.dbfile, settings.acc_index or settings.dbfile + ".idx")
+    return (lineages, lookup)
+
+
+def main(argv=None):
+    settings = process_command_line(argv)
+    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+    memory = settings.memory
+    if memory is None:
+        memory = (domain_classifier.taxonomy.physical_memory() or 2**32) * 3 // 4 // 2**20
+    with domain_classifier.metrics.collect() as metrics:
+        taxonomy = None
+        filter_options = None
+        if settings.filter:
+            taxonomy = load_taxonomy(settings)
+            filter_options = dict((k, getattr(settings, k)) for k in (
+                'mindomains', 'mindiff', 'filter_virus', 'filter_archaea', 'filter_enviro', 'trust_archaea',
+                'trust_viruses', 'dropped'))
+        runner = domain_classifier.batch.BatchRunner(
+            settings.dir, domain_classifier.batch.Budget(settings.threads, memory), settings.pseudocounts,
+            settings.search_threads, settings.limit, settings.seed, settings.weighted, settings.protein,
+            shards=settings.shards, hmmsearch=settings.hmmsearch, subset=settings.subset, dedup=settings.dedup, taxonomy=taxonomy,
+            filter_options=filter_options)
+        errors = runner.run(settings.inputs, settings.outdir)
+    if settings.metrics:
+        metrics.write(settings.metrics)
+    for err in errors:
+        logging.error(err)
+    if errors:
+        logging.error("{} of {} inputs failed, rerun to continue them".format(len(errors), len(settings.inputs)))
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    status = main()
+    sys.exit(status)
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+"""
+Run a local classification daemon: the likelihood model is loaded once and the requests of predict_domain.py --server
+are gathered into micro-batches that are searched and scored together
+"""
+
+from __future__ import division
+import domain_classifier
+import domain_classifier.server
+import sys
+import signal
+import argparse
+import logging
+
+def process_command_line(argv):
+    """
+    Return settings object.
+    `argv` is a list of arguments, or `None` for ``sys.argv[1:]``.
+    """
+    if argv is None:
+        argv = sys.argv[1:]
+    parser = argparse.ArgumentParser(
+        description='Classification daemon, classify the requests of many predict_domain.py --server jobs in batches',
+        formatter_class=argparse.HelpFormatter)
+    parser.add_argument("-d", "--dir", default=".",
+                        help="Database directory")
+    parser.add_argument("-s", "--socket", required=True,
+                        help="Listen on this Unix socket, or host:port for a TCP socket")
+    parser.add_argument("-p", "--protein", default=False, action='store_true',
+                        help="Requests are protein")
+    parser.add_argument("--diamond", default=False, action='store_true',
+                        help='Use diamond to find domains, default is hmmsearch')
+    parser.add_argument("--batch_records", type=int, default=domain_classifier.server.BATCH_RECORDS,
+                        help="Maximal number of records searched together. Default is %(default)s")
+    parser.add_argument("--batch_wait", type=float, default=domain_classifier.server.BATCH_WAIT,
+                        help="Seconds to wait for more requests before searching a batch. Default is %(default)s")
+    parser.add_argument("--queue_size", type=int, default=domain_classifier.server.QUEUE_SIZE,
+                        help="Number of requests waiting to be searched, further requests wait for a place. Default is %(default)s")
+    parser.add_argument("--queue_timeout", type=float, default=domain_classifier.server.QUEUE_TIMEOUT,
+                        help="Seconds a request waits for a place in the queue before it's answered busy (the client retries). Default is %(default)s")
+    parser.add_argument("--max_records", type=int, default=domain_classifier.server.MAX_RECORDS,
+                        help="Reject requests with more records than this. Default is %(default)s")
+    parser.add_argument("--limit", type=int, default=100,
+                        help="Limit the number of proteins from each sequence to this number. Default is 100")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Random seed of the proteins selected with --limit. Default is 0")
+    parser.add_argument("--threads", type=int, default=20, help="Number of threads to use with hmmsearch")
+    parser.add_argument("--shards", type=int, default=1,
+                        help="Split the proteins and run this number of hmmsearch processes in parallel, at most --threads. Default is 1")
+    parser.add_argument("--cache", default=None,
+                        help="Results cache file, see predict_domain.py")
+    parser.add_argument("--weighted", default=False, action='store_true',
+                        help="Select the proteins proportionally to their length, see predict_domain.py")
+    parser.add_argument("--stop_margin", type=float, default=None,
+                        help="Search the ORFs in escalating rounds until the margin reaches this, see predict_domain.py")
+    parser.add_argument("--first_batch", type=int, default=10,
+                        help="Number of ORFs of each sequence in the first round of --stop_margin. Default is %(default)s")
+    parser.add_argument("--dedup", default=False, action='store_true',
+                        help="Search identical sequences of a batch once, see predict_domain.py")
+    parser.add_argument("--subset", default=False, action='store_true',
+                        help="Search the discriminative subset of Pfam, see predict_domain.py")
+    parser.add_argument("--pseudocounts", type=int, default=1,
+                        help='Pseudocounts of the likelihoods. Default is 1')
+    parser.add_argument(
+        '--hmmsearch', default='hmmsearch',
+        help='hmmsearch executable, default hmmsearch')
+    parser.add_argument(
+        '--tmpdir', default=None,
+        help='Directory of the intermediate files')
+    settings = parser.parse_args(argv)
+    return settings
+
+
+def main(argv=None):
+    settings = process_command_line(argv)
+    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+    classifier = domain_classifier.DomainClassifier(
+        settings.dir, settings.pseudocounts, diamond=settings.diamond, protein=settings.protein, threads=settings.threads,
+        shards=settings.shards, limit=settings.limit, seed=settings.seed, hmmsearch=settings.hmmsearch,
+        cache=settings.cache, subset=settings.subset, weighted=settings.weighted,
+        stop_margin=settings.stop_margin, first_batch=settings.first_batch, dedup=settings.dedup, tmpdir=settings.tmpdir)
+    # Exit through serve's cleanup (removing the socket) on kill
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        domain_classifier.server.serve(classifier, settings.socket, settings.batch_records, settings.batch_wait,
+                                       settings.queue_size, settings.queue_timeout, settings.max_records)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == '__main__':
+    status = main()
+    sys.exit(status)
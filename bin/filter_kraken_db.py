@@ -11,19 +11,10 @@ import os.path
 import argparse
 import logging
 import tempfile
-import csv
 import sqlite3
-from collections import defaultdict
-from Bio import SeqIO
-import urllib
-import subprocess
-import shutil
-import glob
-import apsw
-
-py3=sys.version_info >= (3, 0)
-def inext(v):  # next value from iterator
-    return next(v) if py3 else v.next()
+import domain_classifier.taxonomy
+import domain_classifier.krakenfilter
+import domain_classifier.metrics
 
 def process_command_line(argv):
     """
@@ -36,8 +27,32 @@ def process_command_line(argv):
         description='Filter a kraken DB file according to its domain predictions',
         formatter_class=argparse.HelpFormatter)
     parser.add_argument(
-        '--dbfile', default = ":memory:",
-        help='Database file. If not given the database will be written to memory. If file exists use the data in the file')
+        '--dbfile', default=None,
+        help='Database file. If not given the database is built in a temporary file that is removed at the end (requires --taxonomy). If file exists use the data in the file, if its build was interrupted continue it')
+    parser.add_argument(
+        '--fasta_accessions', default=False, action='store_true',
+        help='When building the database load only the accessions of the input fasta file. The database will only fit this file')
+    parser.add_argument(
+        '--acc_index', default=None,
+        help='Resolve accessions with a sorted accession index with this file prefix, built from the database if missing')
+    parser.add_argument(
+        '--memory_limit', type=int, default=None,
+        help='Copy the database to memory if it is smaller than this (in MB), a quarter of the physical memory by default. Otherwise query it on disk')
+    parser.add_argument(
+        '--workers', type=int, default=1,
+        help='Number of processes filtering the fasta in parallel. Unless --acc_index is used the workers query the database on disk')
+    parser.add_argument(
+        '--offsets', default=False, action='store_true',
+        help='Index the byte offsets of the fasta records (saved to <fasta>.offsets and reused), decide on the record ids and copy the kept records with sendfile')
+    parser.add_argument(
+        '--dropped', default=None,
+        help='Write the accessions of the dropped records to this file (implies --offsets)')
+    parser.add_argument(
+        '--seqid2taxid', nargs=2, default=None, metavar=('MAP', 'OUTPUT'),
+        help='Write the lines of the kraken seqid2taxid.map MAP that belong to kept records to OUTPUT (implies --offsets)')
+    parser.add_argument(
+        '--no_fasta', default=False, action='store_true',
+        help="Don't write the filtered fasta, use with --dropped or --seqid2taxid (implies --offsets)")
     parser.add_argument(
         '--mindomains', type=int, default=5,
         help='Minimal number of domains to consider. Less than that will pass')
@@ -56,6 +71,12 @@ def process_command_line(argv):
     parser.add_argument(
         '--filter_enviro', default=False, action='store_true',
         help='Set to remove environmental samples')
+    parser.add_argument(
+        '--metrics', default=None,
+        help='Write the time, CPU, memory and I/O of each stage and the counts of records and lookups to this json file, - for STDERR')
+    parser.add_argument(
+        '--profile', default=None,
+        help='Run under cProfile and write the stats to this file')
     parser.add_argument(
         '--trust_archaea', default=False, action='store_true',
         help='By default keep all sequences that map to archaea, use this to filter them')
@@ -69,129 +90,79 @@ def process_command_line(argv):
         'table',
         help='The predicted domains table, output of predict_domain.py')
     settings = parser.parse_args(argv)
+    if settings.dbfile == ':memory:':
+        # The lookups and the workers open their own connections, each to a new empty database
+        parser.error("--dbfile must be a file, omit it to build the database in a temporary file")
+    if not settings.dbfile and not settings.taxonomy:
+        parser.error("--taxonomy is required without --dbfile")
     return settings
 
 
-def build_db(dbfile, taxdir):
+def build_db(dbfile, taxdir, accessions=None):
     logging.info(taxdir)
+    counts = domain_classifier.taxonomy.build_taxonomy_db(dbfile, taxdir, accessions)
     conn = sqlite3.connect(dbfile)
     c = conn.cursor()
-    c.execute('''CREATE TABLE nodes(
-                 taxid INTEGER PRIMARY KEY,
-                 parent INTEGER,
-                 rank text,
-                     FOREIGN KEY (parent) REFERENCES nodes(taxid))''')
-    c.execute('''CREATE TABLE names(
-                 taxid INTEGER,
-                 name text NOT NULL,
-                 class text NOT NULL,
-                     FOREIGN KEY (taxid) REFERENCES nodes(taxid))''')
-    c.execute('''CREATE TABLE acc2taxid(
-                 acc text NOT NULL,
-                 taxid INTEGER NOT NULL,
-                     FOREIGN KEY (taxid) REFERENCES nodes(taxid))''')
-    c.execute('''CREATE INDEX acc_index ON acc2taxid(acc ASC)''')
-    names = "{}/names.dmp".format(taxdir)
-    nodes = "{}/nodes.dmp".format(taxdir)
-    logging.info("Inserting values to taxonomy tables")
-    nodestp = []
-    with open(nodes, 'rb') as nodesf:
-        for line in nodesf:
-            spl = line.strip().split("\t|\t")
-            nodestp.append((spl[0], spl[1], spl[2]))
-    c.executemany("INSERT INTO nodes VALUES (?,?,?)", nodestp)
-    namestp = []
-    with open(names, 'rb') as namesf:
-        for line in namesf:
-            spl = line.strip().split("\t|\t")
-            namestp.append((spl[0], spl[1], spl[3]))
-    c.executemany("INSERT INTO names VALUES (?,?,?)", namestp)
-    accs = glob.glob("{}/*accession2taxid".format(taxdir))
-    allaccs = []
-    for fname in accs:
-        with open(fname, 'rb') as fin:
-            _ = fin.next()
-            for line in fin:
-                spl = line.strip().split()
-                allaccs.append((spl[0], spl[2]))
-    c.executemany("INSERT INTO acc2taxid VALUES (?,?)",allaccs)
-    conn.commit()
     c.execute("select count(*) from nodes")
     nnodes = c.fetchone()[0]
-    if (nnodes != len(nodestp)):
-        logging.warn("Number of nodes in database is different than in input file ({} vs {})".format(nnodes, len(nodestp)))
+    if (nnodes != counts['nodes']):
+        logging.warn("Number of nodes in database is different than in input file ({} vs {})".format(nnodes, counts['nodes']))
     c.execute("select count(*) from names")
     nnames = c.fetchone()[0]
-    if (nnames != len(namestp)):
-        logging.warn("Numer of names in database is different than in input file ({} vs {})".format(nnames, len(namestp)))
+    if (nnames != counts['names']):
+        logging.warn("Numer of names in database is different than in input file ({} vs {})".format(nnames, counts['names']))
     conn.close()
 
 
-def match_txid(domain, taxid, curr, keepvir=False, keepenv=False, keeparch=False):
-    """
-    Return True if the txid is under the domain
-    """
-    while (taxid != domain):
-        try:
-            (p,) = curr.execute("select parent from nodes where taxid=?", (taxid, )).next()
-        except:
-            logging.warn("Can't find parent for taxonomy {}".format(taxid))
-            break
-        if p == taxid:
-            break
-        if (taxid == 10239 and not keepvir):
-            return True
-        if (taxid == 48479 and not keepenv):
-            return False
-        if (taxid == 2157 and not keeparch):
-            return True
-        taxid = p
-
-    return taxid == domain 
-
-
 def main(argv=None):
     settings = process_command_line(argv)
     logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
-    if (settings.dbfile == ':memory:' or not os.path.exists(settings.dbfile)):
-        build_db(settings.dbfile, settings.taxonomy)
-    #dbconn = sqlite3.connect(settings.dbfile)
-    diskconn = apsw.Connection(settings.dbfile)
-    dbconn = apsw.Connection(":memory:")
-    with dbconn.backup("main", diskconn, "main") as backup:
-        backup.step()
+    with domain_classifier.metrics.collect() as metrics, domain_classifier.metrics.profile(settings.profile):
+        ret = filter_db(settings)
+    if settings.metrics:
+        metrics.write(settings.metrics)
+    return ret
+
+
+def filter_db(settings):
+    if settings.dbfile:
+        return filter_with_db(settings, settings.dbfile)
+    # The database of this run only, in a file so the lookups and the workers can open it
+    (fd, dbfile) = tempfile.mkstemp(suffix=".sqlite")
+    os.close(fd)
+    try:
+        return filter_with_db(settings, dbfile)
+    finally:
+        for fname in (dbfile, dbfile + "-wal", dbfile + "-shm", dbfile + "-journal"):
+            if os.path.exists(fname):
+                os.remove(fname)
 
-    curr = dbconn.cursor()
+
+def filter_with_db(settings, dbfile):
+    if not domain_classifier.taxonomy.taxonomy_db_complete(dbfile):
+        accessions = domain_classifier.taxonomy.fasta_accessions(settings.fasta) if settings.fasta_accessions else None
+        build_db(dbfile, settings.taxonomy, accessions)
+    memory_limit = settings.memory_limit * 2**20 if settings.memory_limit is not None else None
+    lineages = domain_classifier.taxonomy.taxonomy_lineages(dbfile, settings.taxonomy)
     # Read the results file
-    accdom = {}
-    domains = {'Eukaryota': 2759, 'Viruses': 10239, 'Bacteria': 2, 'Archaea': 2157}
-    with open(settings.table, 'rb') as tbin:
-        for row in csv.DictReader(tbin, delimiter="\t"):
-            if int(row['Number of Domains']) < settings.mindomains: continue
-            best_score = float(row[row['MAP']])
-            if best_score - max([float(row[x]) for x in (set(domains.keys())-set((row['MAP'],)))]) < settings.mindiff: continue
-            if row['MAP'] == 'Archaea' and not settings.trust_archaea: continue
-            if row['MAP'] == 'Viruses' and not settings.trust_viruses: continue
-            accdom[row['Record']] = domains[row['MAP']]
-    # Read the fasta and print the records passed filter to STDOUT
-    for record in SeqIO.parse(settings.fasta, 'fasta'):
-        if record.id.startswith("kraken"):
-            (_, txid, acc) = record.id.split("|",2)
-        else:
-            acc = record.id
-            nover = acc.split(".")[0]
-            try:
-                (txid,) = curr.execute("select taxid from acc2taxid where acc=?", (nover,)).next()
-            except:
-                taid = None
-#            txid = curr.fetchone()
-#            if txid: txid = txid[0]
-        if txid and acc in accdom:
-            if not match_txid(accdom[acc], txid, curr, settings.filter_virus, not settings.filter_enviro, settings.filter_archaea): continue
-        if not txid:
-            logging.warn("Can't find taxonomy ID for sequence: {}".format(record.id))
-        sys.stdout.write(record.format('fasta'))
-          
+    accdom = domain_classifier.krakenfilter.read_predictions(
+        settings.table, settings.mindomains, settings.mindiff, settings.trust_archaea, settings.trust_viruses)
+    # Read the fasta as raw records, decide in the workers which ones to keep and print them to STDOUT in the original order
+    if settings.workers > 1 and not settings.acc_index:
+        # Each worker would hold its own copy of the database in memory
+        memory_limit = 0
+
+    def make_filter():
+        lookup = domain_classifier.taxonomy.accession_lookup(dbfile, settings.acc_index, memory_limit)
+        return domain_classifier.krakenfilter.RecordFilter(
+            accdom, lineages, lookup, settings.filter_virus, not settings.filter_enviro, settings.filter_archaea)
+    if settings.offsets or settings.no_fasta or settings.dropped or settings.seqid2taxid:
+        out = None if settings.no_fasta else getattr(sys.stdout, 'buffer', sys.stdout)
+        ndrop = domain_classifier.krakenfilter.filter_by_offsets(
+            settings.fasta, make_filter(), out, settings.dropped, settings.seqid2taxid)
+        logging.info("{} records dropped".format(ndrop))
+    else:
+        domain_classifier.krakenfilter.filter_fasta(settings.fasta, make_filter, workers=settings.workers)
     return 0
 
 if __name__ == '__main__':
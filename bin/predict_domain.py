@@ -7,13 +7,12 @@ Implement a Naive-Bayes classifier and return the posterior probability for each
 
 from __future__ import division
 import domain_classifier
+import domain_classifier.server
 import sys
 import os
 import os.path
 import argparse
 from collections import defaultdict
-from Bio import SeqIO
-import gzip
 
 def process_command_line(argv):
     """
@@ -42,6 +41,28 @@ def process_command_line(argv):
     parser.add_argument("--diamond", default=False, action='store_true',
                         help='Use diamond to find domains, default is hmmsearch')
     parser.add_argument("--threads", type=int, default=20, help="Number of threads to use with hmmsearch")
+    parser.add_argument("--shards", type=int, default=1,
+                        help="Split the proteins and run this number of hmmsearch processes in parallel, at most --threads, the threads are divided between them. Default is 1")
+    parser.add_argument("--chunk", type=int, default=0,
+                        help="Search the input in chunks of this number of sequences and write the results of each chunk as soon as it's done. Default is 0, a single chunk")
+    parser.add_argument("--pipeline", default=False, action='store_true',
+                        help="Translate, search and score the chunks of --chunk at the same time, the next chunks are translated and searched while a chunk is scored")
+    parser.add_argument("--weighted", default=False, action='store_true',
+                        help="Select the proteins of --limit proportionally to their length, favouring the longer ORFs")
+    parser.add_argument("--stop_margin", type=float, default=None,
+                        help="Search the ORFs of each sequence in escalating rounds and stop searching a sequence once the margin between its MAP and the second best reaches this. Default is to search all the selected ORFs at once")
+    parser.add_argument("--first_batch", type=int, default=10,
+                        help="Number of ORFs of each sequence in the first round of --stop_margin, later rounds double the ORFs searched. Default is %(default)s")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Random seed of the proteins selected with --limit, the selection is the same in every run with the same seed. Default is 0")
+    parser.add_argument("--cache", default=None,
+                        help="Results cache file (sqlite3), only sequences that are not in the cache are searched and their results are added to it. The cache is keyed by the sequence, the Pfam release and the search parameters")
+    parser.add_argument("--dedup", default=False, action='store_true',
+                        help="Search identical sequences (identical selected proteins with hmmsearch) once and copy their domains to every record, report the dedup ratio and the search time saved to STDERR. With --chunk within each chunk")
+    parser.add_argument("--subset", default=False, action='store_true',
+                        help="Search the discriminative subset of Pfam (Pfam-A.subset.hmm or the Pfam-A.subset diamond DB) built by build_domains_DB.py --subset_coverage")
+    parser.add_argument("--server", default=None,
+                        help="Send the input to a running domain_classifier_daemon.py on this socket (or host:port) instead of searching it here")
     parser.add_argument("--pseudocounts", type=int, default=1,
                         help='Add pseudocounts to the number of domains to implement Laplace smoothing. One by default (i.e. Lidstone Smoothing)') 
     parser.add_argument(
@@ -50,38 +71,80 @@ def process_command_line(argv):
     parser.add_argument(
         '--getorf', default='getorf',
         help='getorf EMBOSS executable, default getorf')
+    parser.add_argument(
+        '--use_getorf', default=False, action='store_true',
+        help='Translate the DNA with EMBOSS getorf instead of the builtin translator')
+    parser.add_argument(
+        '--metrics', default=None,
+        help='Write the time, CPU, memory and I/O of each stage, the counts of records, ORFs and hits and the external programs exit status to this json file, - for STDERR')
+    parser.add_argument(
+        '--profile', default=None,
+        help='Run under cProfile and write the stats to this file')
     settings = parser.parse_args(argv)
+    if settings.stop_margin is not None and (settings.diamond or settings.chunk or settings.cache or settings.dedup):
+        parser.error("--stop_margin can't be used with --diamond, --chunk, --cache or --dedup")
+    if settings.pipeline and (settings.diamond or not settings.chunk or settings.cache or settings.stop_margin is not None):
+        parser.error("--pipeline requires --chunk and can't be used with --diamond, --cache or --stop_margin")
     return settings
 
 
+def write_rows(domains, info, likels):
+    """
+    Score the sequences and write their rows to STDOUT
+    """
+    for row in domain_classifier.prediction_rows(domains, info, likels):
+        print "\t".join([str(y) for y in row])
+    sys.stdout.flush()
+
+
 def main(argv=None):
     settings = process_command_line(argv)
-    # dictionary: sequence -> list(domains)
-    if settings.diamond:
-        domains = domain_classifier.find_domains(settings.input, settings.dir, settings.blout, settings.all, settings.protein, threads=settings.threads)
-    else:
-        domains = domain_classifier.find_domains_hmm(
-            settings.input, settings.dir, settings.translate, settings.blout, settings.all, settings.protein, 
-            hmmsearch=settings.hmmsearch, getorf=settings.getorf, threads=settings.threads, shuffle=settings.limit)
-    # likels: dictionary domain -> taxdomain -> likelihood lorder: list(taxdomain)
+    with domain_classifier.metrics.collect() as metrics, domain_classifier.metrics.profile(settings.profile):
+        ret = predict(settings)
+    if settings.metrics:
+        metrics.write(settings.metrics)
+    return ret
+
+
+def predict(settings):
+    if settings.server:
+        (columns, rows) = domain_classifier.server.classify_remote(
+            settings.server, domain_classifier.read_fasta(settings.input), settings.all, settings.protein)
+        print "\t".join(columns)
+        for row in rows:
+            print "\t".join([str(y) for y in row])
+        return 0
+    # likels: LikelihoodModel domain -> taxdomain -> likelihood lorder: list(taxdomain)
     (likels, lorder) = domain_classifier.read_likelihoods(settings.dir, settings.pseudocounts)
-    # dictionary sequence -> taxdomain -> posterior prob
-    posteriors = domain_classifier.compute_post(domains, likels)
-    print "\t".join(["Record", "Description", "Length", "Number of Domains", "MAP"] + lorder)
-    # Get the sequences lengths
-    slens = defaultdict(str)
-    desc = defaultdict(str)
-    if (settings.input.endswith('gz')):
-        fain = gzip.open(settings.input)
+    print "\t".join(domain_classifier.prediction_header(lorder))
+    # (dictionary: sequence -> list(domains), lengths and descriptions) for each chunk of the input
+    if settings.diamond:
+        domains = domain_classifier.find_domains(settings.input, settings.dir, settings.blout, settings.all, settings.protein, threads=settings.threads, cache=settings.cache, subset=settings.subset, dedup=settings.dedup)
+        chunks = [(domains, domain_classifier.SequenceInfo.from_fasta(settings.input))]
+    elif settings.stop_margin is not None:
+        chunks = domain_classifier.iter_domains_adaptive(
+            settings.input, settings.dir, settings.translate, settings.blout, likels, settings.stop_margin, settings.first_batch,
+            settings.protein, hmmsearch=settings.hmmsearch, getorf=settings.getorf, threads=settings.threads, shuffle=settings.limit,
+            shards=settings.shards, use_getorf=settings.use_getorf, seed=settings.seed, subset=settings.subset, weighted=settings.weighted)
+    elif settings.pipeline:
+        chunks = domain_classifier.iter_domains_pipelined(
+            settings.input, settings.dir, settings.translate, settings.blout, settings.protein,
+            hmmsearch=settings.hmmsearch, getorf=settings.getorf, threads=settings.threads, shuffle=settings.limit,
+            shards=settings.shards, use_getorf=settings.use_getorf, chunk=settings.chunk, seed=settings.seed, subset=settings.subset, weighted=settings.weighted, dedup=settings.dedup)
     else:
-        fain = open(settings.input)
-    for sr in SeqIO.parse(fain, 'fasta'):
-        slens[sr.id] = len(sr.seq)
-        desc[sr.id] = sr.description
-    fain.close()
-    for k in posteriors.keys():
-        maxp = max(posteriors[k], key=posteriors[k].get)
-        print "\t".join([str(y) for y in [k, desc[k], slens[k], len(domains[k]), maxp] + [posteriors[k][x] for x in lorder]])
+        chunks = domain_classifier.iter_domains_hmm(
+            settings.input, settings.dir, settings.translate, settings.blout, settings.protein,
+            hmmsearch=settings.hmmsearch, getorf=settings.getorf, threads=settings.threads, shuffle=settings.limit,
+            shards=settings.shards, use_getorf=settings.use_getorf, chunk=settings.chunk, seed=settings.seed, cache=settings.cache, subset=settings.subset, weighted=settings.weighted, dedup=settings.dedup)
+    alldomains = defaultdict(list)
+    for (domains, info) in chunks:
+        if settings.all:
+            for doms in domains.values():
+                alldomains['all'].extend(doms)
+        else:
+            write_rows(domains, info, likels)
+    if settings.all:
+        write_rows(alldomains, domain_classifier.SequenceInfo(), likels)
     return 0
 
 if __name__ == '__main__':
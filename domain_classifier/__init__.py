@@ -1,12 +1,28 @@
 import subprocess
 from collections import defaultdict
-import gzip
 import tempfile
 import sys
+import time
 import math
-import random
+import hashlib
+import heapq
+import os
+import shutil
+import itertools
+from .sharded import run_sharded_hmmsearch
+from .orfs import translate_fasta, translate_records, read_fasta, SequenceInfo
+from .pfamindex import lookup_hits, build_hit_index
+from .hits import resolve_hits, diamond_hits, domtblout_hits
+from .model import load_model, LikelihoodModel, Posteriors, batch_posteriors
+from .resultcache import ResultCache, pfam_release, write_fasta
+from .dedup import Deduplicator
+from .subset import SUBSET_HMM, SUBSET_DIAMOND, subset_id, build_subset, subset_report, read_subset
+from . import metrics
+from .classifier import DomainClassifier, prediction_header, prediction_rows
+from .batch import BatchRunner, Budget
+from .pipeline import iter_domains_pipelined
 
-def find_domains(infile, dbdir, blout, all=False, protein=False, scov=50, minsim=20, threads=20):
+def find_domains(infile, dbdir, blout, all=False, protein=False, scov=50, minsim=20, threads=20, cache=None, subset=False, dedup=False):
     """
     Find the domains on the input file. For each sequence (or all if all==True) return a list of domains present on it
     Arguments:
@@ -18,41 +34,334 @@ def find_domains(infile, dbdir, blout, all=False, protein=False, scov=50, minsim
     - `scov`: Minimal subject coverage
     - `minsim`: Minimal sequence similarity
     - `threads`: number of threads to use
+    - `cache`: Results cache file, search only the sequences that are not in it and add their results
+    - `subset`: Search the discriminative subset of the database (Pfam-A.subset), see build_subset
+    - `dedup`: Search identical sequences once and copy their domains to the duplicates, see Deduplicator
     """
+    queryfile = infile
+    sequences = None
+    dbname = SUBSET_DIAMOND if subset else "Pfam-A"
+    if cache:
+        params = dict(method="diamond", release=pfam_release(dbdir, dbname + ".dmnd"), protein=protein, scov=scov, minsim=minsim)
+        if subset:
+            params['subset'] = subset_id(dbdir)
+        rcache = ResultCache(cache, params)
+        (cached, keys) = ([], {})
+        sequences = rcache.split(read_fasta(infile), cached, keys)
+    if dedup:
+        dedupl = Deduplicator()
+        sequences = dedupl.unique(sequences or read_fasta(infile))
+    if sequences is not None:
+        queryfile = "{}.query".format(blout)
+        write_fasta(sequences, queryfile)
+    if cache:
+        metrics.count("cached", len(cached))
     # Run diamond
-    dcmd = "diamond {} -p {} -d {}/Pfam-A -f 6 -q {} --subject-cover {} --id {} |sort -k12gr >  {}".format(("blastp" if protein else "blastx"), threads, dbdir, infile, scov, minsim, blout)
-    subprocess.call(dcmd, shell=True)
-    # Read the translation of hits to domains
-    htod = {}
-    fain = gzip.open("{}/Pfam-A.fasta.gz".format(dbdir), 'r')
-    for line in fain:
-        if line.startswith(">"):
-            spl = line.strip().split()
-            htod[spl[0][1:]] = spl[2][:7]    
-    # Read diamond results. Return all the hits, even if they overlap
+    dcmd = "diamond {} -p {} -d {}/{} -f 6 -q {} --subject-cover {} --id {} >  {}".format(("blastp" if protein else "blastx"), threads, dbdir, dbname, queryfile, scov, minsim, blout)
+    start = time.time()
+    with metrics.stage("diamond"):
+        if cache and not keys:
+            open(blout, 'w').close()
+        else:
+            metrics.call(dcmd, shell=True)
+    # Read the translation of the hit subjects to domains
+    with metrics.stage("lookup_hits"):
+        with open(blout, 'r') as rb:
+            htod = lookup_hits(dbdir, (line.split("\t", 2)[1] for line in rb if line.strip()))
+    # Read diamond results, select the best non overlapping hits of each sequence
     # Save all the matches sequence -> list(domains)
+    qdomains = dict()
+    with metrics.stage("parse_hits"):
+        for (query, subjects) in resolve_hits(diamond_hits(blout)):
+            qdomains[query] = [htod[x] for x in subjects]
+            metrics.count("domains", len(subjects))
+    if dedup:
+        dedupl.fan_out(qdomains)
+        dedupl.report(time.time() - start)
+    if cache:
+        rcache.put((keys[q], qdomains.get(q, [])) for q in keys)
+        rcache.close()
+        qdomains.update((name, doms) for (name, _, _, doms) in cached)
+    if queryfile != infile:
+        os.remove(queryfile)
     alldomains = defaultdict(list)
-    # for each sequence keep the positions divided by 10 that are covered by a previous domain
-    # Since results are sorted, the better matches will be selected
-    covered_pos = defaultdict(set)
-    with open(blout, 'rb') as rb:
-        for line in rb:
-            spl  = line.strip().split("\t")
-            # Test if region is already covered
-            mrange = set(range(int(min(int(spl[6]), int(spl[7]))/10), int(max(int(spl[6]), int(spl[7]))/10)+1))
-            ncov = len(mrange & covered_pos[spl[0]])
-            if ncov < len(mrange)/2:
-                sname = spl[0]
-                if protein:
-                    sname = spl[0].rsplit("_", 1)[0]
-                if all:
-                    sname = 'all'
-                alldomains[sname].append(htod[spl[1]])
-                for pos in mrange:
-                    covered_pos[spl[0]].add(pos)
+    for (query, doms) in qdomains.items():
+        sname = query
+        if protein:
+            sname = query.rsplit("_", 1)[0]
+        if all:
+            sname = 'all'
+        alldomains[sname].extend(doms)
     return alldomains
 
-def find_domains_hmm(infile, dbdir, faafile, hmmout, all=False, protein=False, incscore=20, threads=20, shuffle=100, hmmsearch='hmmsearch', getorf='getorf'):
+def getorf_orfs(fin):
+    """
+    Iterate over getorf output, yield (sequence name, description, ORF) for every ORF
+    """
+    (sname, sdesc, orf) = (None, '', [])
+    for line in fin:
+        if line.startswith(">"):
+            if sname is not None:
+                yield (sname, sdesc, "".join(orf))
+            sname = line.split()[0].rsplit("_",1)[0][1:]
+            sdesc = (line.strip().split(" ",4) + [''])[4]
+            orf = []
+        else:
+            orf.append(line.strip())
+    if sname is not None:
+        yield (sname, sdesc, "".join(orf))
+
+
+def run_getorf(infile, getorf='getorf', sequences=None):
+    """
+    Translate the DNA using EMBOSS getorf. Yield (name, description, length, ORFs) for every sequence
+    with ORFs. The ORFs are an iterator over the getorf output, consume it before the next sequence
+    The sequences are read once, their lengths and descriptions are captured while getorf's input is written
+    Arguments:
+    - `infile`: Input fasta file, might be gzipped
+    - `getorf`: getorf executable
+    - `sequences`: (name, description, sequence) records to translate instead of the records of infile
+    """
+    lengths = SequenceInfo()
+
+    def captured():
+        for (name, desc, seq) in (read_fasta(infile) if sequences is None else sequences):
+            lengths.add(name, desc, len(seq))
+            yield (name, desc, seq)
+    nffile = tempfile.NamedTemporaryFile(suffix=".fna")
+    write_fasta(captured(), nffile.name)
+    # Print the proteins into this file, then group them by sequence
+    tmppt = tempfile.NamedTemporaryFile(mode='r')
+    orfcmd = "{} -table 1 -find 1 -minsize 300 -sequence {} -outseq {}".format(getorf, nffile.name, tmppt.name)
+    sys.stderr.write("Running: {}\n".format(orfcmd))
+    with metrics.stage("getorf"):
+        metrics.check_call(orfcmd, shell=True)
+    nffile.close()
+    # The description of a sequence is taken from its first ORF
+    for (sname, group) in itertools.groupby(getorf_orfs(tmppt), key=lambda x: x[0]):
+        (_, sdesc, orf) = next(group)
+        yield (sname, sdesc, lengths.get(sname)[1], itertools.chain([orf], (x[2] for x in group)))
+    tmppt.close()
+
+
+def sample_orfs(orfs, limit, seed=0, weighted=False):
+    """
+    Select up to limit ORFs of an iterator in a single pass, keeping only limit ORFs in memory (a bottom-k reservoir).
+    Every ORF gets a key from a hash of the seed, the ORF index and the ORF sequence, the ORFs with the smallest keys are
+    selected in the order of their keys, so the selection of a sequence is the same in every run (and Python version)
+    with the same seed. With weighted the key is -log(u)/length with u uniform from the hash, sampling the ORFs
+    proportionally to their length (Efraimidis-Spirakis)
+    Return the list of selected ORFs and the number of ORFs seen
+    Arguments:
+    - `orfs`: iterator of ORF sequences
+    - `limit`: number of ORFs to select
+    - `seed`: random seed
+    - `weighted`: favour the longer ORFs
+    """
+    seen = [0]
+
+    def keyed():
+        for (i, orf) in enumerate(orfs):
+            seen[0] += 1
+            key = hashlib.md5("{}\t{}\t{}".format(seed, i, orf).encode('ascii')).hexdigest()
+            if weighted:
+                key = -math.log((int(key[:16], 16) + 0.5) / 2.0 ** 64) / max(1, len(orf))
+            yield (key, i, orf)
+
+    selected = [orf for (_, _, orf) in heapq.nsmallest(max(0, limit), keyed())]
+    return (selected, seen[0])
+
+
+def select_orfs(orfs, limit, seed=0, weighted=False):
+    """
+    Return up to limit ORFs in a random order, see sample_orfs
+    Arguments:
+    - `orfs`: list of ORF sequences
+    - `limit`: number of ORFs to select
+    - `seed`: random seed
+    - `weighted`: favour the longer ORFs
+    """
+    return sample_orfs(orfs, limit, seed, weighted)[0]
+
+
+def write_proteins(records, faafile, shuffle=100, seed=0, weighted=False, dedup=None):
+    """
+    Write the ORFs of each sequence concatenated with XXX to a single protein record
+    Select random proteins if there are more than shuffle, the ORFs are sampled as they are read
+    Return the number of protein records written
+    Arguments:
+    - `records`: iterator of (name, description, length, ORFs), ORFs might be an iterator
+    - `faafile`: Write the protein fasta file here
+    - `shuffle`: Maximal number of proteins to select for each sequence
+    - `seed`: Random seed of the selection, see sample_orfs
+    - `weighted`: Sample the ORFs proportionally to their length
+    - `dedup`: Deduplicator, write only the proteins it didn't see before
+    """
+    (nrecords, norfs, nproteins, nwritten) = (0, 0, 0, 0)
+    with metrics.stage("translate"):
+        with open(faafile, 'w') as ptout:
+            for (sname, sdesc, _, orfs) in records:
+                nrecords += 1
+                (selected, seen) = sample_orfs(orfs, shuffle, seed, weighted)
+                norfs += seen
+                if not selected:
+                    continue
+                protein = "XXX".join(selected)
+                if dedup is not None and not dedup.add(sname, protein):
+                    continue
+                nproteins += len(selected)
+                nwritten += 1
+                ptout.write(">{} {}\n{}\n".format(sname, sdesc, protein))
+    metrics.count("records", nrecords)
+    metrics.count("orfs", norfs)
+    metrics.count("proteins", nproteins)
+    return nwritten
+
+
+def run_hmmsearch(faafile, dbdir, hmmout, incscore=20, threads=20, shards=1, hmmsearch='hmmsearch', subset=False, copies=None):
+    """
+    Run hmmsearch on the proteins and write the domtblout
+    Arguments:
+    - `faafile`: protein fasta file
+    - `dbdir`: database dir, assume Pfam-A.hmm in it
+    - `hmmout`: Write hmmsearch output here
+    - `incscore`: pass to -T and --incT parameters
+    - `threads`: number of threads to use
+    - `shards`: Split the proteins to this number of shards and run hmmsearch on them in parallel
+    - `hmmsearch`: hmmsearch executable
+    - `subset`: Search Pfam-A.subset.hmm instead of Pfam-A.hmm
+    - `copies`: dictionary record -> number of identical records it was searched for, see Deduplicator.copies. The
+                E-values are computed as if every copy was searched, through the sharded search and its merge
+    """
+    hmmfile = "{}/{}".format(dbdir, SUBSET_HMM if subset else "Pfam-A.hmm")
+#    hmmcmd = "hmmscan --cpu {} --domtblout {} -o /dev/null --incT {} -T {} {}/Pfam-A.hmm {}".format(threads, hmmout, incscore, incscore, dbdir,  faafile)
+    with metrics.stage("hmmsearch"):
+        if shards > 1 or copies:
+            run_sharded_hmmsearch(faafile, hmmfile, hmmout, incscore, threads, shards, hmmsearch, copies)
+        else:
+            hmmcmd = "{} --cpu {} --domtblout {} -o /dev/null --incT {} -T {} {} {}".format(hmmsearch, threads, hmmout, incscore, incscore, hmmfile,  faafile)
+            sys.stderr.write("Running: {}\n".format(hmmcmd))
+            metrics.check_call(hmmcmd, shell=True, stderr=subprocess.STDOUT)
+
+
+def _append(src, dest, first):
+    """
+    Append the content of src to dest, truncate dest first if first is True
+    """
+    if dest:
+        with open(src, 'r') as fin:
+            with open(dest, 'w' if first else 'a') as fout:
+                shutil.copyfileobj(fin, fout)
+    os.remove(src)
+
+
+def iter_domains_hmm(infile, dbdir, faafile, hmmout, protein=False, incscore=20, threads=20, shuffle=100, hmmsearch='hmmsearch', getorf='getorf', shards=1, use_getorf=False, chunk=0, seed=0, cache=None, subset=False, weighted=False, dedup=False):
+    """
+    Use hmmsearch to look for PFAM domains, yield the results of chunks of input sequences as soon as they are ready
+    Yield (domains, info) for each chunk, domains is a dictionary sequence -> list(domains) and info is a SequenceInfo with the
+    lengths and descriptions of the chunk sequences captured while the input is read.
+    hmmsearch reports domains by an E-value that depends on the other sequences in the search, the results of a chunked run
+    might differ slightly from the results of the whole file
+    Arguments:
+    - `infile`: Input fasta file
+    - `dbdir`: database dir, assume Pfam-A.hmm in it
+    - `faafile`: Write the protein fasta file here
+    - `hmmout`: Write hmmsearch output here
+    - `protein`: The input file is protein
+    - `chunk`: Number of input sequences in each chunk, 0 for a single chunk
+    - `cache`: Results cache file, only the sequences that are not in it are translated and searched. The cached
+               sequences are yielded with the chunk they were read with
+    - `subset`: Search Pfam-A.subset.hmm instead of Pfam-A.hmm
+    - `weighted`: Sample the ORFs proportionally to their length
+    - `dedup`: Search the identical proteins of a chunk once, see Deduplicator
+    Other arguments are the same as find_domains_hmm
+    """
+    sequences = None
+    if cache:
+        params = dict(method="hmmsearch", release=pfam_release(dbdir), protein=protein, incscore=incscore,
+                      limit=shuffle, seed=seed, getorf=use_getorf and not protein)
+        if subset:
+            params['subset'] = subset_id(dbdir)
+        if weighted:
+            params['weighted'] = True
+        rcache = ResultCache(cache, params)
+        (cached, keys) = ([], {})
+        sequences = rcache.split(read_fasta(infile), cached, keys)
+    # Translate the DNA to proteins:
+    if not protein:
+        if use_getorf:
+            records = run_getorf(infile, getorf, sequences)
+        elif cache:
+            records = translate_records(sequences)
+        else:
+            records = translate_fasta(infile)
+    else:
+        records = ((name, desc, len(seq), [seq.decode('ascii')]) for (name, desc, seq) in (sequences or read_fasta(infile)))
+    first = True
+    while True:
+        info = SequenceInfo()
+        batch = info.capture(itertools.islice(records, chunk) if chunk > 0 else records)
+        dedupl = Deduplicator() if dedup else None
+        if chunk > 0:
+            (chunkfaa, chunkout) = ("{}.chunk".format(hmmout), "{}.chunk.domtbl".format(hmmout))
+            nsearch = write_proteins(batch, chunkfaa, shuffle, seed, weighted, dedupl)
+        elif protein and not cache and not dedup:
+            (chunkfaa, chunkout) = (infile, hmmout)
+            for _ in batch:
+                pass
+            metrics.count("records", len(info))
+            nsearch = len(info)
+        else:
+            (chunkfaa, chunkout) = (faafile, hmmout)
+            nsearch = write_proteins(batch, faafile, shuffle, seed, weighted, dedupl)
+        # hmmsearch fails on an empty file, a chunk without ORFs or with cached or duplicate proteins only isn't searched
+        domains = defaultdict(list)
+        if nsearch:
+            # Run hmmsearch
+            start = time.time()
+            run_hmmsearch(chunkfaa, dbdir, chunkout, incscore, threads, shards, hmmsearch, subset,
+                          dedupl.copies() if dedupl else None)
+            # Parse the output same way as with diamond, the hits of a sequence are spread in the output
+            with metrics.stage("parse_domtblout"):
+                for (target, doms) in resolve_hits(domtblout_hits(chunkout), grouped=False):
+                    domains[target].extend(doms)
+                    metrics.count("domains", len(doms))
+            if dedupl:
+                dedupl.fan_out(domains)
+                dedupl.report(time.time() - start)
+            if chunk > 0:
+                _append(chunkfaa, faafile, first)
+                _append(chunkout, hmmout, first)
+            first = False
+        elif chunk > 0:
+            os.remove(chunkfaa)
+        elif chunkout:
+            # Don't leave the results of a previous run
+            open(chunkout, 'w').close()
+        if cache:
+            rcache.put((keys.pop(name), domains.get(name, [])) for name in info.index if name in keys)
+            metrics.count("cached", len(cached))
+            for (name, desc, length, doms) in cached:
+                info.add(name, desc, length)
+                domains[name].extend(doms)
+            del cached[:]
+        if not len(info):
+            break
+        yield (domains, info)
+        if chunk <= 0:
+            break
+    if cache:
+        # Sequences the translation didn't report have no ORFs
+        rcache.put((key, []) for key in keys.values())
+        rcache.close()
+        if first:
+            # Nothing was searched, don't leave the files of a previous run
+            for fname in (faafile, hmmout):
+                if fname:
+                    open(fname, 'w').close()
+
+
+def find_domains_hmm(infile, dbdir, faafile, hmmout, all=False, protein=False, incscore=20, threads=20, shuffle=100, hmmsearch='hmmsearch', getorf='getorf', shards=1, use_getorf=False, chunk=0, seed=0, cache=None, subset=False, weighted=False, dedup=False):
     """
     Use hmmsearch to look for PFAM domains. Accuarte but longer runtime
     Arguments:
@@ -66,119 +375,175 @@ def find_domains_hmm(infile, dbdir, faafile, hmmout, all=False, protein=False, i
     - `shuffle`: Select random 1000 (or as defined) proteins for each DNA sequence
     - `hmmsearch`: hmmsearch executable
     - `getorf`: getorf executable
+    - `use_getorf`: Translate the DNA with getorf instead of the builtin translator
+    - `shards`: Split the proteins to this number of shards and run hmmsearch on them in parallel,
+                the threads are divided between the hmmsearch processes
+    - `chunk`: Search the input in chunks of this number of sequences, see iter_domains_hmm
+    - `seed`: Random seed of the proteins selection
+    - `cache`: Results cache file, search only the sequences that are not in it and add their results
+    - `subset`: Search the discriminative subset of Pfam (Pfam-A.subset.hmm), see build_subset
+    - `weighted`: Sample the ORFs proportionally to their length, favouring the longer ORFs
+    - `dedup`: Search identical proteins once and copy their domains to every record with them
     """
-    # Translate the DNA to proteins:
-    if not protein:
-        nfn = infile
-        if infile.endswith(".gz"):
-            nffile = tempfile.NamedTemporaryFile()
-            subprocess.call("zcat {} > {}".format(infile, nffile.name), shell=True)
-            nfn = nffile.name
-        # Print the proteins into this file, then concatenate them
-        tmppt = tempfile.NamedTemporaryFile()
-        orfcmd = "{} -table 1 -find 1 -minsize 300 -sequence {} -outseq {}".format(getorf, nfn, tmppt.name)
-        sys.stderr.write("Running: {}\n".format(orfcmd))
-        subprocess.check_call(orfcmd, shell=True)
-        if infile.endswith(".gz"):
-            nffile.close()
-        # Concat the proteins
-        with open(faafile, 'wb') as ptout:
-            sname = None
-            sdesc = ''
-            seqbuff = []
-            for line in tmppt:
+    alldomains = defaultdict(list)
+    for (domains, _) in iter_domains_hmm(infile, dbdir, faafile, hmmout, protein, incscore, threads, shuffle, hmmsearch, getorf, shards, use_getorf, chunk, seed, cache, subset, weighted, dedup):
+        for (target, doms) in domains.items():
+            alldomains['all' if all else target].extend(doms)
+    return alldomains
+
+
+def escalating_batches(limit, first):
+    """
+    Return the (start, end) ranges of the selected ORFs searched in each round of the adaptive search, the first round
+    searches first ORFs and every later round doubles the number of ORFs searched so far, up to limit
+    """
+    bounds = []
+    (start, end) = (0, min(max(1, first), limit))
+    while start < limit:
+        bounds.append((start, end))
+        (start, end) = (end, min(limit, end * 2))
+    return bounds
+
+
+def write_orf_pool(records, poolfile, shuffle=100, seed=0, weighted=False):
+    """
+    Write the selected ORFs of each sequence, in their selection order, to the pool of the adaptive search.
+    Each sequence is a >name line followed by its ORFs, one per line
+    Arguments:
+    - `records`: iterator of (name, description, length, ORFs)
+    - `poolfile`: Write the pool here
+    - `shuffle`: Maximal number of proteins to select for each sequence
+    - `seed`: Random seed of the selection, see sample_orfs
+    - `weighted`: Sample the ORFs proportionally to their length
+    """
+    (nrecords, norfs) = (0, 0)
+    with metrics.stage("translate"):
+        with open(poolfile, 'w') as fout:
+            for (sname, _, _, orfs) in records:
+                nrecords += 1
+                (selected, seen) = sample_orfs(orfs, shuffle, seed, weighted)
+                norfs += seen
+                if not selected:
+                    continue
+                fout.write(">{}\n".format(sname))
+                for orf in selected:
+                    fout.write(orf + "\n")
+    metrics.count("records", nrecords)
+    metrics.count("orfs", norfs)
+
+
+def write_round(poolfile, faafile, start, end, active=None):
+    """
+    Write the ORFs start to end of the pooled sequences (only the active ones if given) concatenated with XXX
+    to a protein fasta file. Return the names of the sequences written
+    """
+    written = []
+    nproteins = [0]
+
+    def flush(name, orfs):
+        if name is not None and orfs[start:end] and (active is None or name in active):
+            fout.write(">{}\n{}\n".format(name, "XXX".join(orfs[start:end])))
+            written.append(name)
+            nproteins[0] += len(orfs[start:end])
+
+    with open(poolfile, 'r') as fin:
+        with open(faafile, 'w') as fout:
+            (name, orfs) = (None, [])
+            for line in fin:
                 if line.startswith(">"):
-                    s = line.split()[0].rsplit("_",1)[0][1:]
-                    if s != sname:
-                        if sname:
-                            # Write the previous proteins
-                            buffer = "XXX".join(random.sample(seqbuff, min(len(seqbuff), shuffle)))
-                            ptout.write(">{} {}\n{}\n".format(sname, sdesc, buffer))
-                        sname = s
-                        sdesc = line.strip().split(" ",4)[4]
-                        seqbuff = []
+                    flush(name, orfs)
+                    (name, orfs) = (line[1:].strip(), [])
                 else:
-                    seqbuff.append(line.strip())
-            if sname:
-                buffer = "XXX".join(random.sample(seqbuff, min(len(seqbuff), shuffle)))  
-                ptout.write(">{} {}\n{}\n".format(sname, sdesc, buffer))
-        tmppt.close()                
+                    orfs.append(line.strip())
+            flush(name, orfs)
+    metrics.count("proteins", nproteins[0])
+    return written
+
+
+def iter_domains_adaptive(infile, dbdir, faafile, hmmout, model, margin=5, first=10, protein=False, incscore=20, threads=20, shuffle=100, hmmsearch='hmmsearch', getorf='getorf', shards=1, use_getorf=False, seed=0, subset=False, weighted=False):
+    """
+    Search the selected ORFs of each sequence in escalating rounds and stop searching a sequence once the margin of its
+    posterior (the MAP log posterior minus the second best) reaches margin, so the search time goes to the ambiguous
+    sequences. The ORFs are selected in the same order as iter_domains_hmm, a sequence that doesn't reach the margin
+    is searched with all of its selected ORFs (in several proteins instead of one)
+    Yield (domains, info) once, like iter_domains_hmm with a single chunk
+    Arguments:
+    - `model`: LikelihoodModel, scores the sequences after each round
+    - `margin`: Stop searching a sequence when its posterior margin reaches this
+    - `first`: Number of ORFs of each sequence searched in the first round, see escalating_batches
+    - `faafile`: The proteins of all the rounds are written here
+    - `hmmout`: The hmmsearch output of all the rounds is written here
+    Other arguments are the same as find_domains_hmm
+    """
+    if not protein:
+        records = run_getorf(infile, getorf) if use_getorf else translate_fasta(infile)
     else:
-        faafile = infile
-    # Run hmmsearch
-#    hmmcmd = "hmmscan --cpu {} --domtblout {} -o /dev/null --incT {} -T {} {}/Pfam-A.hmm {}".format(threads, hmmout, incscore, incscore, dbdir,  faafile)
-    hmmcmd = "{} --cpu {} --domtblout {} -o /dev/null --incT {} -T {} {}/Pfam-A.hmm {}".format(hmmsearch, threads, hmmout, incscore, incscore, dbdir,  faafile)
-    sys.stderr.write("Running: {}\n".format(hmmcmd))
-    subprocess.check_call(hmmcmd, shell=True, stderr=subprocess.STDOUT)
-    # Parse the output same way as with diamond
-    alldomains = defaultdict(list)
-    covered_pos = defaultdict(set)
-    
-    with open(hmmout, 'r') as hin:
-        for line in hin:
-            if line.startswith("#"):
-                continue
-            spl = line.strip().split()
-            mrange = set(range(int(int(spl[19])/10), int(int(spl[20])/10)+1))
-#            ncov = len(mrange & covered_pos[spl[3]])
-            ncov = len(mrange & covered_pos[spl[0]])
-            if ncov < len(mrange) / 2:
-#                sname = spl[3]
-                sname = spl[0]
-                if all:
-                    sname = 'all'
-#                alldomains[sname].append(spl[1].split(".")[0])
-                alldomains[sname].append(spl[4].split(".")[0])
-                for pos in mrange:
-#                    covered_pos[spl[3]].add(pos)
-                    covered_pos[spl[0]].add(pos)
-    return alldomains
-            
+        records = ((name, desc, len(seq), [seq.decode('ascii')]) for (name, desc, seq) in read_fasta(infile))
+    info = SequenceInfo()
+    poolfile = "{}.pool".format(hmmout)
+    write_orf_pool(info.capture(records), poolfile, shuffle, seed, weighted)
+    (roundfaa, roundout) = ("{}.round".format(hmmout), "{}.round.domtbl".format(hmmout))
+    domains = defaultdict(list)
+    active = None
+    for rnd, (start, end) in enumerate(escalating_batches(shuffle, first)):
+        searched = write_round(poolfile, roundfaa, start, end, active)
+        if not searched:
+            os.remove(roundfaa)
+            if rnd == 0:
+                # Nothing to search, don't leave the files of a previous run
+                for fname in (faafile, hmmout):
+                    if fname:
+                        open(fname, 'w').close()
+            break
+        run_hmmsearch(roundfaa, dbdir, roundout, incscore, threads, shards, hmmsearch, subset)
+        with metrics.stage("parse_domtblout"):
+            for (target, doms) in resolve_hits(domtblout_hits(roundout), grouped=False):
+                domains[target].extend(doms)
+                metrics.count("domains", len(doms))
+        _append(roundfaa, faafile, rnd == 0)
+        _append(roundout, hmmout, rnd == 0)
+        posteriors = batch_posteriors(dict((name, domains[name]) for name in searched), model)
+        decided = set(name for (name, m) in zip(posteriors.names, posteriors.margin.tolist()) if m >= margin)
+        active = set(searched) - decided
+        metrics.count("round_sequences", len(searched))
+        sys.stderr.write("Round {}: searched ORFs {}-{} of {} sequences, {} reached the margin\n".format(
+            rnd + 1, start + 1, end, len(searched), len(decided)))
+    os.remove(poolfile)
+    yield (domains, info)
+
 
-def read_likelihoods(dbdir, pseudocounts=1):
+def read_likelihoods(dbdir, pseudocounts=1, compile=True):
     """
     Read the domain distribution in taxonomy and return the likelihood for each taxonomic domain
-    Use pseudocounts to avoid zeros
+    Use pseudocounts to avoid zeros. The likelihoods are compiled once to a file in the database dir
+    and memory mapped by later calls, the file is rebuilt when pfamA_tax_depth.txt.gz changes
+    Return a LikelihoodModel (indexed like a dictionary domain -> taxdomain -> likelihood) and the list of taxdomains
     Arguments:
     - `dbdir`: Database dir, look for the file pfamA_tax_depth.txt.gz
     - `pseudocounts`: Laplace smmothing factor to use
+    - `compile`: Write the compiled likelihoods file if it's missing or outdated
     """
-    # Keep the counts in this dict
-    rawc = defaultdict(lambda: defaultdict(int))
-    taxin = gzip.open("{}/pfamA_tax_depth.txt.gz".format(dbdir))
-    lorder = []
-    taxsum = defaultdict(int)
-    for line in taxin:
-        spl = line.strip().split("\t")
-        rawc[spl[0]][spl[1]] = int(spl[2])
-        taxsum[spl[1]] += int(spl[2])
-        if spl[1] not in lorder:
-            lorder.append(spl[1])
-    # Compute likelihood
-    likel = defaultdict(lambda: defaultdict(float))
-    for dom in rawc.keys():
-#        domsum = 0 #sum(rawc[dom].values()) + pseudocounts*len(lorder)
-        for tx in lorder:
-            likel[dom][tx] = float(rawc[dom][tx] + pseudocounts)/taxsum[tx]
-        domsum = sum(likel[dom].values())
-        for tx in lorder:
-            likel[dom][tx] = likel[dom][tx]/domsum
-    return (likel, lorder)
+    with metrics.stage("read_likelihoods"):
+        model = load_model(dbdir, pseudocounts, compile)
+    return (model, model.lorder)
 
 def compute_post(domains, likel):
     """
     compute posterior probabilities using the domains in each sequence and likelihoods
     Arguments:
     - `domains`: A dictionary with domain names in each sequence
-    - `likel`: Likelihoods of domains taxonomies
+    - `likel`: Likelihoods of domains taxonomies, LikelihoodModel or a dictionary domain -> taxdomain -> likelihood
     """
+    if isinstance(likel, LikelihoodModel):
+        return batch_posteriors(domains, likel).todict()
     post = dict()
-    for sname in domains.keys():
-        mult = defaultdict(lambda: 0)
-        for domain in domains[sname]:
-            for tx in likel[domain].keys():
-                mult[tx] += math.log(likel[domain][tx])
-        if (mult):
-            post[sname] = mult
+    with metrics.stage("compute_post"):
+        for sname in domains.keys():
+            mult = defaultdict(lambda: 0)
+            for domain in domains[sname]:
+                for tx in likel[domain].keys():
+                    mult[tx] += math.log(likel[domain][tx])
+            if (mult):
+                post[sname] = mult
     return post
 
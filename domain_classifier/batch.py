@@ -0,0 +1,384 @@
+"""
+Classify many inputs (e.g. every library/*/library.fna of a kraken database) under one CPU and memory budget.
+The likelihood model, the taxonomy lineages and the accession index are loaded once. Every input runs through
+translation, hmmsearch, scoring and optionally the kraken filter, each stage reserves its cores and an estimate
+of its memory from the shared Budget before it starts, so the stages of different inputs fill the machine
+without oversubscribing it. The Python stages run in forked processes that share the loaded data.
+Each stage writes its output to a temporary name and renames it when done, a rerun after a crash skips the
+finished stages. A stamp of the input and the settings invalidates the outputs when either changes, a stamp of the
+filter settings invalidates only the filtered outputs
+"""
+
+import os
+import json
+import shutil
+import logging
+import threading
+import multiprocessing
+from collections import defaultdict
+from multiprocessing.pool import ThreadPool
+from . import metrics
+from .orfs import translate_fasta, read_fasta, SequenceInfo
+from .dedup import Deduplicator
+from .hits import resolve_hits, domtblout_hits
+from .model import load_model, TAX_DEPTH
+from .resultcache import pfam_release
+from .subset import SUBSET_HMM, subset_id
+from .classifier import prediction_header, prediction_rows
+from .krakenfilter import FastaOffsets, read_predictions, filter_by_offsets, RecordFilter
+
+# Memory estimates of the stages in MB, a fixed part and a part proportional to the data the stage holds
+TRANSLATE_MEMORY = 200
+# Bytes of translation memory per byte of the largest record (six frames and their codons)
+TRANSLATE_FACTOR = 10
+SEARCH_MEMORY = 500
+SCORE_MEMORY = 200
+# Bytes of scoring memory per byte of hmmsearch output
+SCORE_FACTOR = 3
+FILTER_MEMORY = 200
+# Bytes of filter memory per record (the offsets index and the decisions)
+FILTER_FACTOR = 200
+# Bytes read at a time when the inputs are scanned for their records
+SCAN_BLOCK = 2**20
+
+
+class Budget(object):
+    """
+    Cores and memory (MB) shared by the stages. reserve blocks until the request fits, a request larger
+    than the whole budget is reduced to the budget so it runs alone
+    """
+
+    def __init__(self, cores, memory):
+        self.cores = cores
+        self.memory = memory
+        self.free = [cores, memory]
+        self.cond = threading.Condition()
+
+    def acquire(self, cores, memory):
+        request = (min(cores, self.cores), min(memory, self.memory))
+        with self.cond:
+            while self.free[0] < request[0] or self.free[1] < request[1]:
+                self.cond.wait()
+            self.free[0] -= request[0]
+            self.free[1] -= request[1]
+        return request
+
+    def release(self, request):
+        with self.cond:
+            self.free[0] += request[0]
+            self.free[1] += request[1]
+            self.cond.notify_all()
+
+    def reserve(self, cores, memory):
+        """
+        Context manager holding cores and memory
+        """
+        return _Reservation(self, cores, memory)
+
+
+class _Reservation(object):
+
+    def __init__(self, budget, cores, memory):
+        self.budget = budget
+        self.request = (cores, memory)
+
+    def __enter__(self):
+        self.held = self.budget.acquire(*self.request)
+        return self.held
+
+    def __exit__(self, *exc):
+        self.budget.release(self.held)
+        return False
+
+
+def _forked(func, args):
+    """
+    Run in the forked process. Other threads of the parent might have held the logging and metrics locks
+    when it forked, the child gets new locks and doesn't collect metrics
+    """
+    for handler in logging.getLogger().handlers:
+        handler.createLock()
+    del metrics._active[:]
+    func(*args)
+
+
+def run_forked(func, *args):
+    """
+    Run func(*args) in a forked process that shares the loaded data, raise RuntimeError if it fails
+    """
+    ctx = multiprocessing.get_context('fork') if hasattr(multiprocessing, 'get_context') else multiprocessing
+    proc = ctx.Process(target=_forked, args=(func, args))
+    proc.start()
+    proc.join()
+    if proc.exitcode != 0:
+        raise RuntimeError("{} failed with exit code {}".format(getattr(func, '__name__', func), proc.exitcode))
+
+
+def output_name(infile):
+    """
+    Return the name of the outputs of an input, its path relative to the working directory (or its absolute path
+    outside it) with the directory separators replaced by _. The name doesn't depend on the other inputs so
+    a rerun with more or fewer inputs finds the finished ones
+    """
+    path = os.path.relpath(os.path.abspath(infile))
+    if path.startswith(os.pardir + os.sep):
+        path = os.path.abspath(infile).lstrip(os.sep)
+    return path.replace(os.sep, "_")
+
+
+def scan_records(fname):
+    """
+    Return the number of records of the fasta and the size in bytes of the largest one, scanned for the headers
+    without writing an index next to the input. Gzipped files are assumed to be a single record of four times
+    their size
+    """
+    if fname.endswith(".gz"):
+        return (1, os.path.getsize(fname) * 4)
+    (nrecords, largest, start, offset, prev) = (0, 0, 0, 0, b"\n")
+    with open(fname, 'rb') as fin:
+        while True:
+            block = fin.read(SCAN_BLOCK)
+            if not block:
+                break
+            # Index i of buf is offset - 1 + i in the file, a header at buf[i + 1] starts at offset + i
+            buf = prev + block
+            i = buf.find(b"\n>")
+            while i >= 0:
+                nrecords += 1
+                largest = max(largest, offset + i - start)
+                start = offset + i
+                i = buf.find(b"\n>", i + 1)
+            offset += len(block)
+            prev = block[-1:]
+    return (nrecords, max(largest, offset - start))
+
+
+def file_version(fname):
+    """
+    Return the size and modification time of a file, None if it doesn't exist
+    """
+    if not os.path.exists(fname):
+        return None
+    st = os.stat(fname)
+    return "{}:{}".format(st.st_size, int(st.st_mtime))
+
+
+class BatchInput(object):
+    """
+    The files of one input in the output directory:
+    <name>.faa, <name>.dups.txt (the duplicates of the searched proteins with dedup), <name>.domtbl, <name>.tsv
+    (the predictions table), <name>.filtered.fna and <name>.dropped.txt and <name>.stamp with the input size, time and the settings the outputs were made with,
+    <name>.filter.stamp with the filter settings of the filtered outputs
+    """
+
+    def __init__(self, infile, outdir, name):
+        self.infile = infile
+        self.name = name
+        prefix = os.path.join(outdir, name)
+        self.faafile = prefix + ".faa"
+        self.dups = prefix + ".dups.txt"
+        self.hmmout = prefix + ".domtbl"
+        self.table = prefix + ".tsv"
+        self.filtered = prefix + ".filtered.fna"
+        self.dropped = prefix + ".dropped.txt"
+        self.stamp = prefix + ".stamp"
+        self.filter_stamp = prefix + ".filter.stamp"
+
+    def outputs(self):
+        return (self.faafile, self.dups, self.hmmout, self.table, self.filtered, self.dropped)
+
+    def remove_after(self, fname):
+        """
+        Remove the outputs made from fname, before it's made again
+        """
+        outputs = self.outputs()
+        for out in outputs[outputs.index(fname) + 1:]:
+            if os.path.exists(out):
+                os.remove(out)
+
+    def check_stamp(self, settings, filter_settings=None):
+        """
+        Remove the outputs if they were made from another version of the input or with other settings, and the
+        filtered outputs if they were made with other filter settings. Write the current stamps
+        """
+        st = os.stat(self.infile)
+        if not _same_stamp(self.stamp, dict(size=st.st_size, mtime=st.st_mtime, settings=settings)):
+            logging.info("{}: the input or the settings changed, starting over".format(self.name))
+            for fname in self.outputs():
+                if os.path.exists(fname):
+                    os.remove(fname)
+        if not _same_stamp(self.filter_stamp, filter_settings):
+            self.remove_after(self.table)
+
+
+def _same_stamp(fname, stamp):
+    """
+    Return True if the stamp file has this stamp, otherwise write it and return False
+    """
+    if os.path.exists(fname):
+        with open(fname, 'r') as fin:
+            if json.load(fin) == json.loads(json.dumps(stamp)):
+                return True
+    with open(fname + ".tmp", 'w') as fout:
+        json.dump(stamp, fout)
+    os.rename(fname + ".tmp", fname)
+    return False
+
+
+def _translate(infile, faafile, dups, limit, seed, weighted, protein, dedup):
+    # Imported here, the package imports this module
+    from . import write_proteins
+    dedupl = Deduplicator() if dedup else None
+    if protein and not dedup:
+        shutil.copyfile(infile, faafile + ".tmp")
+    elif protein:
+        records = ((name, desc, len(seq), [seq.decode('ascii')]) for (name, desc, seq) in read_fasta(infile))
+        write_proteins(records, faafile + ".tmp", limit, seed, weighted, dedupl)
+    else:
+        write_proteins(translate_fasta(infile), faafile + ".tmp", limit, seed, weighted, dedupl)
+    if dedupl:
+        dedupl.write(dups)
+        dedupl.report()
+    os.rename(faafile + ".tmp", faafile)
+
+
+def _score(infile, hmmout, dups, table, model):
+    domains = defaultdict(list)
+    for (target, doms) in resolve_hits(domtblout_hits(hmmout), grouped=False):
+        domains[target].extend(doms)
+    if os.path.exists(dups):
+        Deduplicator.read(dups).fan_out(domains)
+    info = SequenceInfo.from_fasta(infile)
+    with open(table + ".tmp", 'w') as fout:
+        fout.write("\t".join(prediction_header(model.lorder)) + "\n")
+        for row in prediction_rows(domains, info, model):
+            fout.write("\t".join([str(y) for y in row]) + "\n")
+    os.rename(table + ".tmp", table)
+
+
+def _filter(infile, table, filtered, dropped, lineages, lookup, options):
+    accdom = read_predictions(table, options['mindomains'], options['mindiff'], options['trust_archaea'],
+                              options['trust_viruses'])
+    rfilter = RecordFilter(accdom, lineages, lookup, options['filter_virus'], not options['filter_enviro'],
+                           options['filter_archaea'])
+    # Not saved next to the input like fasta_offsets does, the inputs are only read
+    with metrics.stage("fasta_offsets"):
+        offsets = FastaOffsets.build(infile)
+    with open(filtered + ".tmp", 'wb') as out:
+        ndrop = filter_by_offsets(infile, rfilter, out, dropped + ".tmp" if options['dropped'] else None,
+                                  offsets=offsets)
+    if options['dropped']:
+        os.rename(dropped + ".tmp", dropped)
+    os.rename(filtered + ".tmp", filtered)
+    logging.info("{}: {} records dropped".format(infile, ndrop))
+
+
+class BatchRunner(object):
+    """
+    Run the stages of many inputs under a shared Budget, the likelihood model is loaded once
+    Arguments:
+    - `dbdir`: database dir
+    - `budget`: Budget of cores and memory
+    - `pseudocounts`: Laplace smoothing of the model
+    - `search_threads`: cores of each hmmsearch
+    - `limit`, `seed`, `weighted`: selection of the proteins, see find_domains_hmm
+    - `protein`: The inputs are protein
+    - `incscore`, `shards`, `hmmsearch`, `subset`: passed to run_hmmsearch
+    - `dedup`: Search the identical proteins of an input once, see Deduplicator
+    - `taxonomy`: (lineages, accession lookup) to filter the inputs as kraken fasta files, None not to filter
+    - `filter_options`: dictionary of the filter settings, the options of filter_kraken_db.py
+    """
+
+    def __init__(self, dbdir, budget, pseudocounts=1, search_threads=4, limit=100, seed=0, weighted=False, protein=False,
+                 incscore=20, shards=1, hmmsearch='hmmsearch', subset=False, dedup=False, taxonomy=None, filter_options=None):
+        self.dbdir = dbdir
+        self.budget = budget
+        self.pseudocounts = pseudocounts
+        with metrics.stage("read_likelihoods"):
+            self.model = load_model(dbdir, pseudocounts)
+        self.search_threads = search_threads
+        self.selection = (limit, seed, weighted, protein)
+        self.search = (incscore, shards, hmmsearch, subset)
+        self.dedup = dedup
+        self.taxonomy = taxonomy
+        self.filter_options = filter_options or {}
+        # The database versions are read once, not for every input
+        self.stamp_settings = self.settings()
+
+    def settings(self):
+        """
+        The settings and the database versions the outputs depend on, for the stamp
+        """
+        subset = self.search[3]
+        settings = dict(selection=self.selection, search=self.search[:2] + self.search[3:],
+                        pseudocounts=self.pseudocounts, dedup=self.dedup,
+                        release=pfam_release(self.dbdir, SUBSET_HMM if subset else "Pfam-A.hmm"),
+                        likelihoods=file_version(os.path.join(self.dbdir, TAX_DEPTH)))
+        if subset:
+            settings['subset'] = subset_id(self.dbdir)
+        return settings
+
+    def run_input(self, job):
+        """
+        Run the stages of one input that are not done yet
+        """
+        # Imported here, the package imports this module
+        from . import run_hmmsearch
+        job.check_stamp(self.stamp_settings, self.filter_options)
+        if not os.path.exists(job.hmmout):
+            if not os.path.exists(job.faafile):
+                job.remove_after(job.faafile)
+                memory = TRANSLATE_MEMORY + TRANSLATE_FACTOR * scan_records(job.infile)[1] // 2**20
+                with self.budget.reserve(1, memory):
+                    with metrics.stage("translate"):
+                        run_forked(_translate, job.infile, job.faafile, job.dups, *(self.selection + (self.dedup,)))
+            job.remove_after(job.hmmout)
+            if not os.path.getsize(job.faafile):
+                # An input without ORFs, hmmsearch fails on an empty file
+                open(job.hmmout, 'w').close()
+            else:
+                with self.budget.reserve(self.search_threads, SEARCH_MEMORY) as (cores, _):
+                    (incscore, shards, hmmsearch, subset) = self.search
+                    copies = Deduplicator.read(job.dups).copies() if os.path.exists(job.dups) else None
+                    run_hmmsearch(job.faafile, self.dbdir, job.hmmout + ".tmp", incscore, cores, shards, hmmsearch, subset,
+                                  copies)
+                    os.rename(job.hmmout + ".tmp", job.hmmout)
+        if not os.path.exists(job.table):
+            job.remove_after(job.table)
+            with self.budget.reserve(1, SCORE_MEMORY + SCORE_FACTOR * os.path.getsize(job.hmmout) // 2**20):
+                with metrics.stage("score"):
+                    run_forked(_score, job.infile, job.hmmout, job.dups, job.table, self.model)
+        if self.taxonomy is not None and not os.path.exists(job.filtered):
+            with self.budget.reserve(1, FILTER_MEMORY + FILTER_FACTOR * scan_records(job.infile)[0] // 2**20):
+                with metrics.stage("filter"):
+                    run_forked(_filter, job.infile, job.table, job.filtered, job.dropped, self.taxonomy[0],
+                               self.taxonomy[1], self.filter_options)
+        logging.info("{}: done".format(job.name))
+
+    def _run_safe(self, job):
+        try:
+            self.run_input(job)
+            return None
+        except Exception as e:
+            logging.exception("{} failed".format(job.name))
+            return "{}: {}".format(job.name, e)
+
+    def run(self, inputs, outdir):
+        """
+        Run all the inputs, return the list of errors of the inputs that failed. Rerunning continues the failed
+        and unfinished inputs
+        """
+        if not os.path.exists(outdir):
+            os.makedirs(outdir)
+        names = [output_name(x) for x in inputs]
+        if len(set(names)) < len(names):
+            raise ValueError("Inputs with the same name")
+        jobs = [BatchInput(infile, outdir, name) for (infile, name) in zip(inputs, names)]
+        # Enough threads to keep every core busy with single core stages while others wait for a search
+        pool = ThreadPool(max(1, min(len(jobs), 2 * self.budget.cores)))
+        try:
+            errors = pool.map(self._run_safe, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        return [e for e in errors if e]
@@ -0,0 +1,134 @@
+"""
+Classifier object that keeps the likelihood model loaded between classifications, for services and
+pipelines that classify many small inputs. The searches run the same way as predict_domain.py
+"""
+
+import os
+import shutil
+import tempfile
+from collections import defaultdict
+from . import metrics
+from .model import load_model, batch_posteriors
+from .orfs import SequenceInfo
+from .resultcache import write_fasta
+
+
+def prediction_header(lorder):
+    """
+    Return the columns of the predictions table
+    """
+    return ["Record", "Description", "Length", "Number of Domains", "MAP"] + list(lorder) + ["Margin"]
+
+
+def prediction_rows(domains, info, model):
+    """
+    Score the sequences, return the rows of the predictions table
+    Arguments:
+    - `domains`: dictionary sequence -> list(domains)
+    - `info`: SequenceInfo with the descriptions and lengths of the sequences
+    - `model`: LikelihoodModel
+    """
+    posteriors = batch_posteriors(domains, model)
+    logpost = posteriors.logpost.tolist()
+    margin = posteriors.margin.tolist()
+    rows = []
+    for i, k in enumerate(posteriors.names):
+        (desc, slen) = info.get(k)
+        rows.append([k, desc, slen, int(posteriors.ndomains[i]), posteriors.MAP(i)] + logpost[i] + [margin[i]])
+    return rows
+
+
+class DomainClassifier(object):
+    """
+    Classify fasta files or records with a resident likelihood model
+    Arguments:
+    - `dbdir`: database dir
+    - `pseudocounts`: Laplace smoothing of the model
+    - `diamond`: Search with diamond instead of hmmsearch
+    - `protein`: The inputs are protein
+    - `stop_margin`: Search with iter_domains_adaptive, stop searching a sequence when its margin reaches this
+    - `first_batch`: Number of ORFs of each sequence in the first round of the adaptive search
+    - `dedup`: Search identical sequences once, see Deduplicator
+    - `tmpdir`: directory of the intermediate files, the system default if None
+    Other arguments are passed to find_domains_hmm or find_domains
+    """
+
+    def __init__(self, dbdir, pseudocounts=1, diamond=False, protein=False, threads=20, shards=1, incscore=20, limit=100,
+                 seed=0, hmmsearch='hmmsearch', getorf='getorf', use_getorf=False, cache=None, subset=False, weighted=False, stop_margin=None, first_batch=10,
+                 dedup=False, tmpdir=None):
+        self.dbdir = dbdir
+        self.diamond = diamond
+        self.protein = protein
+        self.threads = threads
+        self.search = dict(incscore=incscore, threads=threads, shuffle=limit, hmmsearch=hmmsearch, getorf=getorf,
+                           shards=shards, use_getorf=use_getorf, seed=seed, cache=cache, subset=subset, weighted=weighted, dedup=dedup)
+        self.cache = cache
+        self.subset = subset
+        self.dedup = dedup
+        self.stop_margin = stop_margin
+        self.first_batch = first_batch
+        if stop_margin is not None and (diamond or cache or dedup):
+            raise ValueError("The adaptive search can't be used with diamond, a results cache or dedup")
+        self.tmpdir = tmpdir
+        with metrics.stage("read_likelihoods"):
+            self.model = load_model(dbdir, pseudocounts)
+        self.lorder = self.model.lorder
+
+    def header(self):
+        return prediction_header(self.lorder)
+
+    def find_domains(self, infile):
+        """
+        Search the fasta file, return the domains of its sequences and its SequenceInfo
+        """
+        # Imported here, the package imports this module
+        from . import find_domains, iter_domains_hmm, iter_domains_adaptive
+        workdir = tempfile.mkdtemp(prefix="dclassify", dir=self.tmpdir)
+        try:
+            if self.diamond:
+                domains = find_domains(infile, self.dbdir, os.path.join(workdir, "hits.blout"), protein=self.protein,
+                                       threads=self.threads, cache=self.cache, subset=self.subset, dedup=self.dedup)
+                return (domains, SequenceInfo.from_fasta(infile))
+            (faafile, hmmout) = (os.path.join(workdir, "proteins.faa"), os.path.join(workdir, "hits.domtbl"))
+            if self.stop_margin is not None:
+                search = dict((k, v) for (k, v) in self.search.items() if k not in ('cache', 'dedup'))
+                chunks = iter_domains_adaptive(infile, self.dbdir, faafile, hmmout, self.model, self.stop_margin,
+                                               self.first_batch, self.protein, **search)
+            else:
+                chunks = iter_domains_hmm(infile, self.dbdir, faafile, hmmout, self.protein, **self.search)
+            (domains, info) = (defaultdict(list), SequenceInfo())
+            for (doms, chunkinfo) in chunks:
+                domains.update(doms)
+                info.update(chunkinfo)
+            return (domains, info)
+        finally:
+            shutil.rmtree(workdir)
+
+    def rows(self, domains, info, all=False):
+        """
+        Return the predictions table rows of the domains, with all=True a single row of all the domains together
+        """
+        if all:
+            domains = {'all': [d for doms in domains.values() for d in doms]}
+            info = SequenceInfo()
+        return prediction_rows(domains, info, self.model)
+
+    def classify_fasta(self, infile, all=False):
+        """
+        Classify the sequences of a fasta file, return the rows of the predictions table
+        """
+        (domains, info) = self.find_domains(infile)
+        return self.rows(domains, info, all)
+
+    def classify(self, records, all=False):
+        """
+        Classify an iterator of (name, description, sequence) records, the sequence as bytes
+        Return the rows of the predictions table
+        """
+        (fd, fname) = tempfile.mkstemp(suffix=".fa", dir=self.tmpdir)
+        os.close(fd)
+        try:
+            write_fasta(records, fname)
+            return self.classify_fasta(fname, all)
+        finally:
+            os.remove(fname)
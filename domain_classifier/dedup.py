@@ -0,0 +1,108 @@
+"""
+Search identical sequences once. Kraken libraries have many identical plasmids, strains and RefSeq duplicates, their
+records translate to the same selected proteins (the selection doesn't depend on the record name). The proteins are
+hashed before the search, only the first record with each protein is searched and its domains are copied to the
+records with the same protein. Only identical sequences are merged, the case is ignored
+hmmsearch reports domains by an E-value scaled by the number of reported targets, the hmmsearch of the unique proteins
+counts each searched record once for each record with its protein (see run_hmmsearch) so the same domains are reported
+"""
+
+import sys
+import hashlib
+from . import metrics
+
+
+class Deduplicator(object):
+    """
+    The proteins of one search, the duplicates of each protein and the residues they saved
+    """
+
+    def __init__(self):
+        self.first = {}
+        self.duplicates = {}
+        self.residues = [0, 0]
+
+    def add(self, name, seq):
+        """
+        Return True if the sequence (str or bytes) wasn't seen before and should be searched, otherwise record
+        name as a duplicate of the first record with the sequence
+        """
+        if not isinstance(seq, bytes):
+            seq = seq.encode('ascii')
+        key = hashlib.sha1(seq.upper()).digest()
+        if key in self.first:
+            self.duplicates[name] = self.first[key]
+            self.residues[1] += len(seq)
+            return False
+        self.first[key] = name
+        self.residues[0] += len(seq)
+        return True
+
+    def unique(self, sequences):
+        """
+        Yield the (name, description, sequence) records with a sequence that wasn't seen before
+        """
+        for (name, desc, seq) in sequences:
+            if self.add(name, seq):
+                yield (name, desc, seq)
+
+    def fan_out(self, domains):
+        """
+        Copy the domains of the searched records to their duplicates
+        Arguments:
+        - `domains`: dictionary name -> list(domains) of the searched records, updated in place
+        """
+        for (name, first) in self.duplicates.items():
+            if first in domains:
+                domains[name] = list(domains[first])
+        return domains
+
+    def copies(self):
+        """
+        Return a dictionary searched record -> number of records with its protein, for the records with duplicates
+        """
+        copies = {}
+        for first in self.duplicates.values():
+            copies[first] = copies.get(first, 1) + 1
+        return copies
+
+    def report(self, seconds=None):
+        """
+        Count the unique and duplicate proteins and write the dedup ratio to STDERR. The search time is proportional
+        to the residues searched, the time saved is estimated from the seconds the search of the unique proteins took
+        Return a dictionary of the numbers
+        """
+        (nunique, ndup) = (len(self.first), len(self.duplicates))
+        stats = dict(proteins=nunique + ndup, unique=nunique, duplicates=ndup,
+                     ratio=float(nunique + ndup) / nunique if nunique else 1.0,
+                     residues=self.residues[0], duplicate_residues=self.residues[1])
+        metrics.count("dedup_unique", nunique)
+        metrics.count("dedup_duplicates", ndup)
+        metrics.count("dedup_residues_saved", self.residues[1])
+        msg = "Deduplicated {} proteins to {} (ratio {:.2f})".format(stats['proteins'], nunique, stats['ratio'])
+        if seconds is not None and self.residues[0]:
+            stats['saved_seconds'] = seconds * self.residues[1] / float(self.residues[0])
+            metrics.count("dedup_seconds_saved", stats['saved_seconds'])
+            msg += ", about {:.1f}s of search saved".format(stats['saved_seconds'])
+        sys.stderr.write(msg + "\n")
+        return stats
+
+    def write(self, fname):
+        """
+        Write the duplicates as name<TAB>first record lines
+        """
+        with open(fname, 'w') as fout:
+            for (name, first) in self.duplicates.items():
+                fout.write("{}\t{}\n".format(name, first))
+
+    @classmethod
+    def read(cls, fname):
+        """
+        Return a Deduplicator with the duplicates written by write, for fan_out
+        """
+        dedup = cls()
+        with open(fname, 'r') as fin:
+            for line in fin:
+                (name, first) = line.rstrip("\n").split("\t")
+                dedup.duplicates[name] = first
+        return dedup
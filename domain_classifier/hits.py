@@ -0,0 +1,123 @@
+"""
+Resolve overlapping domain hits. The hits of each query are selected by their bitscore, a hit is selected
+if less than half of its positions (divided by 10) are covered by previously selected hits
+"""
+
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from . import metrics
+
+
+class IntervalCover(object):
+    """
+    Union of integer intervals, kept as sorted lists of the starts and ends of disjoint intervals
+    """
+
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+
+    def covered(self, start, end):
+        """
+        Return the number of positions in [start, end] covered by the union
+        """
+        ncov = 0
+        i = max(0, bisect_left(self.ends, start))
+        while i < len(self.starts) and self.starts[i] <= end:
+            ncov += min(end, self.ends[i]) - max(start, self.starts[i]) + 1
+            i += 1
+        return ncov
+
+    def add(self, start, end):
+        """
+        Add the interval [start, end] to the union, merge it with touching intervals
+        """
+        i = bisect_left(self.ends, start - 1)
+        j = bisect_right(self.starts, end + 1)
+        if i < j:
+            start = min(start, self.starts[i])
+            end = max(end, self.ends[j - 1])
+        self.starts[i:j] = [start]
+        self.ends[i:j] = [end]
+
+
+def resolve_group(hits):
+    """
+    Select the hits of a single query. Return the selected domains ordered by bitscore
+    Arguments:
+    - `hits`: list of (start, end, bitscore, domain)
+    """
+    cover = IntervalCover()
+    selected = []
+    for (start, end, _, domain) in sorted(hits, key=lambda x: -x[2]):
+        (a, b) = (min(start, end) // 10, max(start, end) // 10)
+        if cover.covered(a, b) < (b - a + 1) // 2:
+            selected.append(domain)
+            cover.add(a, b)
+    return selected
+
+
+def resolve_hits(hits, grouped=True):
+    """
+    Resolve a stream of hits, yield (query, selected domains) for each query
+    If the hits are grouped by query each query is resolved and released as soon as its hits end
+    Arguments:
+    - `hits`: iterator of (query, start, end, bitscore, domain)
+    - `grouped`: The hits of each query are consecutive
+    """
+    if not grouped:
+        groups = defaultdict(list)
+        for (query, start, end, score, domain) in hits:
+            groups[query].append((start, end, score, domain))
+        for query in list(groups.keys()):
+            yield (query, resolve_group(groups.pop(query)))
+        return
+    done = set()
+    query = None
+    group = []
+    for (q, start, end, score, domain) in hits:
+        if q != query:
+            if query is not None:
+                done.add(query)
+                yield (query, resolve_group(group))
+            if q in done:
+                raise ValueError("Hits of {} are not consecutive".format(q))
+            query = q
+            group = []
+        group.append((start, end, score, domain))
+    if query is not None:
+        yield (query, resolve_group(group))
+
+
+def diamond_hits(blout):
+    """
+    Iterate over diamond tabular output, yield (query, start, end, bitscore, subject)
+    Arguments:
+    - `blout`: diamond output file
+    """
+    nhits = 0
+    with open(blout, 'r') as rb:
+        for line in rb:
+            spl = line.strip().split("\t")
+            if len(spl) < 12:
+                continue
+            nhits += 1
+            yield (spl[0], int(spl[6]), int(spl[7]), float(spl[11]), spl[1])
+    metrics.count("hits", nhits)
+
+
+def domtblout_hits(hmmout):
+    """
+    Iterate over hmmsearch domtblout, yield (target, envelope start, envelope end, domain score, Pfam accession)
+    Arguments:
+    - `hmmout`: hmmsearch --domtblout file
+    """
+    nhits = 0
+    with open(hmmout, 'r') as hin:
+        for line in hin:
+            if line.startswith("#"):
+                continue
+            spl = line.strip().split()
+            nhits += 1
+            yield (spl[0], int(spl[19]), int(spl[20]), float(spl[13]), spl[4].split(".")[0])
+    metrics.count("hits", nhits)
@@ -0,0 +1,362 @@
+"""
+Filter a kraken fasta file according to the domain predictions of its records
+The fasta is handled as raw bytes: it's split to record aligned byte ranges, worker processes decide which
+records to keep and return their offsets, and the kept records are copied from the input in their original order
+Alternatively an index of the records byte offsets is built once, the records are decided by their ids and the kept
+ranges are copied with sendfile
+"""
+
+import os
+import sys
+import csv
+import mmap
+import logging
+import multiprocessing
+from array import array
+from . import metrics
+from .taxonomy import BACTERIA, EUKARYOTA, ARCHAEA, VIRUSES
+
+# Size of the byte ranges handed to the workers
+RANGE_SIZE = 64 * 2**20
+# Number of records decided together when filtering by offsets
+RECORD_BATCH = 100000
+
+
+DOMAIN_TAXIDS = {'Eukaryota': EUKARYOTA, 'Viruses': VIRUSES, 'Bacteria': BACTERIA, 'Archaea': ARCHAEA}
+
+
+def read_predictions(table, mindomains=5, mindiff=1.0, trust_archaea=False, trust_viruses=False):
+    """
+    Read a predict_domain.py table, return a dictionary record -> taxid of the predicted domain of the records
+    with a confident prediction
+    Arguments:
+    - `table`: predictions table
+    - `mindomains`: Minimal number of domains of a record
+    - `mindiff`: Minimal log probability difference between the MAP and the second best
+    - `trust_archaea`, `trust_viruses`: Use Archaea and Viruses predictions, they are skipped by default
+    """
+    accdom = {}
+    with metrics.stage("read_table"):
+        with open(table, 'r') as tbin:
+            for row in csv.DictReader(tbin, delimiter="\t"):
+                if int(row['Number of Domains']) < mindomains: continue
+                if row.get('Margin'):
+                    margin = float(row['Margin'])
+                else:
+                    best_score = float(row[row['MAP']])
+                    margin = best_score - max([float(row[x]) for x in (set(DOMAIN_TAXIDS.keys())-set((row['MAP'],)))])
+                if margin < mindiff: continue
+                if row['MAP'] == 'Archaea' and not trust_archaea: continue
+                if row['MAP'] == 'Viruses' and not trust_viruses: continue
+                accdom[row['Record']] = DOMAIN_TAXIDS[row['MAP']]
+    return accdom
+
+
+def _str(b):
+    return b if isinstance(b, str) else b.decode('ascii')
+
+
+def _open_map(fname):
+    with open(fname, 'rb') as fin:
+        if os.fstat(fin.fileno()).st_size == 0:
+            return b""
+        return mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def record_ranges(fname, size=RANGE_SIZE):
+    """
+    Split the fasta file to byte ranges of about size bytes, each range but the first starts at a record header
+    Return a list of (start, end)
+    Arguments:
+    - `fname`: fasta file
+    - `size`: approximate range size
+    """
+    buf = _open_map(fname)
+    starts = [0]
+    while True:
+        nxt = buf.find(b"\n>", starts[-1] + size - 1)
+        if nxt < 0:
+            break
+        starts.append(nxt + 1)
+    return list(zip(starts, starts[1:] + [len(buf)]))
+
+
+def iter_records(buf, start, end):
+    """
+    Iterate over the records in buf[start:end], yield (record id, record start, record end)
+    Bytes before the first header are skipped
+    Arguments:
+    - `buf`: bytes or mmap of the fasta file
+    - `start`: range start
+    - `end`: range end
+    """
+    pos = start
+    if buf[start:start + 1] != b">":
+        pos = buf.find(b"\n>", start, end)
+        pos = -1 if pos < 0 else pos + 1
+    while 0 <= pos < end:
+        nxt = buf.find(b"\n>", pos, end)
+        nxt = end if nxt < 0 else nxt + 1
+        eol = buf.find(b"\n", pos, nxt)
+        header = buf[pos + 1:nxt if eol < 0 else eol].split(None, 1)
+        yield (_str(header[0]) if header else '', pos, nxt)
+        pos = nxt
+
+
+class RecordFilter(object):
+    """
+    Decide which records of a kraken fasta to keep
+    A record is dropped if it has a prediction in accdom and its taxid isn't under the predicted domain
+    Arguments:
+    - `accdom`: dictionary record accession -> predicted domain taxid
+    - `lineages`: taxonomy LineageTable
+    - `lookup`: accession resolver with a resolve method (see taxonomy.accession_lookup)
+    - `keepvir`, `keepenv`, `keeparch`: passed to LineageTable.match
+    """
+
+    def __init__(self, accdom, lineages, lookup, keepvir=False, keepenv=False, keeparch=False):
+        self.accdom = accdom
+        self.lineages = lineages
+        self.lookup = lookup
+        self.flags = (keepvir, keepenv, keeparch)
+
+    def taxids(self, ids):
+        """
+        Return a list of (accession, taxid) of the record ids, the taxid is None if not found
+        """
+        taxids = self.lookup.resolve(set(x.split(".")[0] for x in ids if not x.startswith("kraken")))
+        res = []
+        for rid in ids:
+            if rid.startswith("kraken"):
+                (_, txid, acc) = rid.split("|", 2)
+            else:
+                acc = rid
+                txid = taxids.get(acc.split(".")[0])
+            res.append((acc, txid))
+        return res
+
+    def keep(self, rid, acc, txid):
+        """
+        Return True if the record should be kept
+        """
+        if txid and acc in self.accdom:
+            if not self.lineages.match(self.accdom[acc], int(txid), *self.flags):
+                return False
+        if not txid:
+            logging.warn("Can't find taxonomy ID for sequence: {}".format(rid))
+        return True
+
+    def decide(self, ids):
+        """
+        Return a list of True/False, keep or drop, for the record ids
+        """
+        keep = [self.keep(rid, acc, txid) for (rid, (acc, txid)) in zip(ids, self.taxids(ids))]
+        metrics.count("records", len(keep))
+        metrics.count("records_dropped", keep.count(False))
+        return keep
+
+    def filter(self, buf, start, end):
+        """
+        Return the list of (start, end) of the kept records in the range, adjacent records are merged
+        """
+        records = list(iter_records(buf, start, end))
+        keep = self.decide([x[0] for x in records])
+        return merge_ranges((x[1], x[2]) for (x, k) in zip(records, keep) if k)
+
+
+def merge_ranges(ranges):
+    """
+    Merge adjacent (start, end) ranges
+    """
+    merged = []
+    for (start, end) in ranges:
+        if merged and merged[-1][1] == start:
+            merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+
+class FastaOffsets(object):
+    """
+    Byte offsets of the records of a fasta file, like a faidx index but with the start of the header and
+    the end of the record. Saved as a tab delimited file of id, start and end
+    """
+
+    def __init__(self, ids, starts, ends):
+        self.ids = ids
+        self.starts = starts
+        self.ends = ends
+
+    @classmethod
+    def build(cls, fname):
+        records = list(iter_records(_open_map(fname), 0, os.path.getsize(fname)))
+        return cls([x[0] for x in records], array('l', (x[1] for x in records)), array('l', (x[2] for x in records)))
+
+    @classmethod
+    def load(cls, fname):
+        (ids, starts, ends) = ([], array('l'), array('l'))
+        with open(fname, 'r') as fin:
+            for line in fin:
+                spl = line.rstrip("\n").split("\t")
+                ids.append(spl[0])
+                starts.append(int(spl[1]))
+                ends.append(int(spl[2]))
+        return cls(ids, starts, ends)
+
+    def save(self, fname):
+        with open(fname + ".tmp", 'w') as fout:
+            for rec in zip(self.ids, self.starts, self.ends):
+                fout.write("{}\t{}\t{}\n".format(*rec))
+        os.rename(fname + ".tmp", fname)
+
+    def __len__(self):
+        return len(self.ids)
+
+
+def fasta_offsets(fname):
+    """
+    Return the FastaOffsets of the fasta, use <fname>.offsets if it is newer than the fasta, otherwise
+    build it and try to save it there
+    """
+    idx = "{}.offsets".format(fname)
+    if os.path.exists(idx) and os.path.getmtime(idx) >= os.path.getmtime(fname):
+        return FastaOffsets.load(idx)
+    offsets = FastaOffsets.build(fname)
+    if os.access(os.path.dirname(os.path.abspath(fname)), os.W_OK):
+        offsets.save(idx)
+    return offsets
+
+
+def copy_ranges(fname, ranges, out):
+    """
+    Copy the byte ranges of the file to out, with sendfile if possible, otherwise from a memory map
+    Return the number of bytes written
+    """
+    out.flush()
+    written = 0
+    with open(fname, 'rb') as fin:
+        try:
+            outfd = out.fileno()
+        except (AttributeError, IOError, ValueError):
+            outfd = None
+        buf = None
+        for (start, end) in ranges:
+            while start < end:
+                if buf is None and outfd is not None and hasattr(os, 'sendfile'):
+                    try:
+                        sent = os.sendfile(outfd, fin.fileno(), start, end - start)
+                    except OSError:
+                        buf = _open_map(fname)
+                        continue
+                else:
+                    if buf is None:
+                        buf = _open_map(fname)
+                    out.write(buf[start:end])
+                    sent = end - start
+                start += sent
+                written += sent
+    out.flush()
+    return written
+
+
+def drop_records(offsets, rfilter, batch=RECORD_BATCH):
+    """
+    Return the keep/drop decision of every record in the offsets index
+    Arguments:
+    - `offsets`: FastaOffsets
+    - `rfilter`: RecordFilter
+    - `batch`: number of records decided together
+    """
+    keep = []
+    for i in range(0, len(offsets), batch):
+        keep.extend(rfilter.decide(offsets.ids[i:i + batch]))
+    return keep
+
+
+def filter_by_offsets(fname, rfilter, out=None, dropped=None, seqid2taxid=None, offsets=None):
+    """
+    Filter the fasta file using the byte offsets of its records. The decisions are made on the record ids
+    and the kept records are copied in contiguous ranges. Return the number of dropped records
+    Arguments:
+    - `fname`: kraken fasta file
+    - `rfilter`: RecordFilter
+    - `out`: binary file to write the kept records to, None to skip writing the fasta
+    - `dropped`: write the accessions of the dropped records to this file
+    - `seqid2taxid`: (input, output) kraken seqid2taxid.map files, write the input lines of the kept records to the output
+    - `offsets`: FastaOffsets of the file, by default from fasta_offsets
+    """
+    if offsets is None:
+        with metrics.stage("fasta_offsets"):
+            offsets = fasta_offsets(fname)
+    with metrics.stage("filter_records"):
+        keep = drop_records(offsets, rfilter)
+    if out is not None:
+        with metrics.stage("copy_ranges"):
+            written = copy_ranges(fname, merge_ranges((s, e) for (s, e, k) in zip(offsets.starts, offsets.ends, keep) if k), out)
+        metrics.count("bytes_written", written)
+    drop = set(rid for (rid, k) in zip(offsets.ids, keep) if not k)
+    if dropped:
+        with open(dropped, 'w') as fout:
+            for rid in offsets.ids:
+                if rid in drop:
+                    fout.write("{}\n".format(rid.split("|", 2)[2] if rid.startswith("kraken") else rid))
+    if seqid2taxid:
+        with open(seqid2taxid[0], 'r') as fin:
+            with open(seqid2taxid[1], 'w') as fout:
+                for line in fin:
+                    if line.split("\t", 1)[0].strip() not in drop:
+                        fout.write(line)
+    return len(drop)
+
+
+_worker = {}
+
+
+def _init_worker(fname, make_filter):
+    _worker['buf'] = _open_map(fname)
+    _worker['filter'] = make_filter()
+
+
+def _filter_range(rng):
+    return _worker['filter'].filter(_worker['buf'], rng[0], rng[1])
+
+
+def filter_fasta(fname, make_filter, out=None, workers=1, size=RANGE_SIZE):
+    """
+    Filter the fasta file and write the kept records to out, in their original order
+    Return the number of bytes written. The metrics of the worker processes (record counts, accession lookups)
+    are not collected
+    Arguments:
+    - `fname`: kraken fasta file
+    - `make_filter`: function returning a RecordFilter, called once in every worker
+    - `out`: binary file to write to, STDOUT by default
+    - `workers`: number of worker processes, 1 to filter in this process
+    - `size`: size of the byte ranges handed to the workers
+    """
+    if out is None:
+        out = getattr(sys.stdout, 'buffer', sys.stdout)
+    ranges = record_ranges(fname, size)
+    buf = _open_map(fname)
+    if workers > 1:
+        ctx = multiprocessing.get_context('fork') if hasattr(multiprocessing, 'get_context') else multiprocessing
+        pool = ctx.Pool(workers, _init_worker, (fname, make_filter))
+        results = pool.imap(_filter_range, ranges)
+    else:
+        pool = None
+        rfilter = make_filter()
+        results = (rfilter.filter(buf, s, e) for (s, e) in ranges)
+    written = 0
+    with metrics.stage("filter_fasta"):
+        try:
+            for kept in results:
+                for (s, e) in kept:
+                    out.write(buf[s:e])
+                    written += e - s
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        out.flush()
+    metrics.count("bytes_written", written)
+    return written
@@ -0,0 +1,174 @@
+"""
+Per stage instrumentation. Library functions wrap their stages with stage() and count() and run external
+programs with call()/check_call(), these do nothing unless metrics are collected:
+
+    with domain_classifier.metrics.collect() as m:
+        domain_classifier.find_domains_hmm(...)
+    m.write("metrics.json")
+
+For every stage the wall time, CPU time, peak RSS and bytes read and written (from /proc/self/io) are
+accumulated. For every external program the command, exit status, wall time, CPU time and peak RSS are kept
+"""
+
+import os
+import sys
+import time
+import json
+import resource
+import subprocess
+import threading
+import cProfile
+from contextlib import contextmanager
+from collections import defaultdict, OrderedDict
+
+_active = []
+_lock = threading.Lock()
+
+
+def _io():
+    """
+    Return the bytes read and written by this process, zeros if /proc/self/io is not available
+    """
+    try:
+        with open("/proc/self/io", 'r') as fin:
+            vals = dict(line.split(":") for line in fin)
+        return (int(vals["rchar"]), int(vals["wchar"]))
+    except (IOError, OSError, KeyError, ValueError):
+        return (0, 0)
+
+
+def _cpu(usage):
+    return usage.ru_utime + usage.ru_stime
+
+
+class Metrics(object):
+    """
+    Collected metrics of stages, counters and external programs
+    """
+
+    def __init__(self):
+        self.stages = OrderedDict()
+        self.counters = defaultdict(int)
+        self.subprocesses = []
+        self.start = time.time()
+
+    @contextmanager
+    def stage(self, name):
+        (rchar, wchar) = _io()
+        (wall, cpu) = (time.time(), _cpu(resource.getrusage(resource.RUSAGE_SELF)))
+        try:
+            yield self
+        finally:
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            (rchar2, wchar2) = _io()
+            with _lock:
+                st = self.stages.setdefault(name, dict(calls=0, wall=0.0, cpu=0.0, read_bytes=0, write_bytes=0, peak_rss_kb=0))
+                st['calls'] += 1
+                st['wall'] += time.time() - wall
+                st['cpu'] += _cpu(usage) - cpu
+                st['read_bytes'] += rchar2 - rchar
+                st['write_bytes'] += wchar2 - wchar
+                st['peak_rss_kb'] = max(st['peak_rss_kb'], usage.ru_maxrss)
+
+    def count(self, name, n=1):
+        with _lock:
+            self.counters[name] += n
+
+    def call(self, cmd, **kwargs):
+        """
+        Run the command like subprocess.call and record its exit status and resource usage
+        """
+        wall = time.time()
+        proc = subprocess.Popen(cmd, **kwargs)
+        (_, status, usage) = os.wait4(proc.pid, 0)
+        proc.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+        with _lock:
+            self.subprocesses.append(OrderedDict((
+                ("command", cmd if isinstance(cmd, str) else " ".join(cmd)), ("returncode", proc.returncode),
+                ("wall", time.time() - wall), ("cpu", _cpu(usage)), ("peak_rss_kb", usage.ru_maxrss))))
+        return proc.returncode
+
+    def todict(self):
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return OrderedDict((
+            ("wall", time.time() - self.start), ("cpu", _cpu(usage)), ("peak_rss_kb", usage.ru_maxrss),
+            ("stages", self.stages), ("counters", dict(self.counters)), ("subprocesses", self.subprocesses)))
+
+    def write(self, fname):
+        """
+        Write the metrics as json, "-" for STDERR
+        """
+        if fname == '-':
+            json.dump(self.todict(), sys.stderr, indent=2)
+            sys.stderr.write("\n")
+        else:
+            with open(fname, 'w') as fout:
+                json.dump(self.todict(), fout, indent=2)
+
+
+@contextmanager
+def collect():
+    """
+    Collect the metrics of the library calls in the block
+    """
+    metrics = Metrics()
+    _active.append(metrics)
+    try:
+        yield metrics
+    finally:
+        _active.remove(metrics)
+
+
+def current():
+    """
+    Return the Metrics being collected or None
+    """
+    return _active[-1] if _active else None
+
+
+@contextmanager
+def _nothing():
+    yield None
+
+
+def stage(name):
+    metrics = current()
+    return metrics.stage(name) if metrics else _nothing()
+
+
+def count(name, n=1):
+    metrics = current()
+    if metrics:
+        metrics.count(name, n)
+
+
+def call(cmd, **kwargs):
+    metrics = current()
+    return metrics.call(cmd, **kwargs) if metrics else subprocess.call(cmd, **kwargs)
+
+
+def check_call(cmd, **kwargs):
+    """
+    Like subprocess.check_call, record the program if metrics are collected
+    """
+    ret = call(cmd, **kwargs)
+    if ret:
+        raise subprocess.CalledProcessError(ret, cmd)
+    return 0
+
+
+@contextmanager
+def profile(fname=None):
+    """
+    Run the block under cProfile and dump the stats to fname, do nothing if fname is None
+    """
+    if not fname:
+        yield None
+        return
+    prof = cProfile.Profile()
+    prof.enable()
+    try:
+        yield prof
+    finally:
+        prof.disable()
+        prof.dump_stats(fname)
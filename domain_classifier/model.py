@@ -0,0 +1,227 @@
+"""
+Compiled likelihood model. pfamA_tax_depth.txt.gz is parsed once and the log likelihoods are written
+to a file in the database directory which is memory mapped by later runs
+The file starts with a magic line and a json header line followed by the Pfam accessions, one per line,
+and the float64 log likelihoods matrix (domains X taxonomic domains) aligned to 8 bytes
+"""
+
+import os
+import gzip
+import json
+import tempfile
+from collections import defaultdict
+import numpy as np
+from . import metrics
+
+MAGIC = b"DCMODEL1\n"
+TAX_DEPTH = "pfamA_tax_depth.txt.gz"
+
+
+def parse_tax_depth(fname):
+    """
+    Read the number of genomes each Pfam family is found in for every taxonomic domain
+    Return the counts as a dictionary domain -> taxdomain -> count, the total counts of each taxdomain
+    and the list of taxdomains by their order in the file
+    Arguments:
+    - `fname`: pfamA_tax_depth.txt.gz file
+    """
+    rawc = defaultdict(dict)
+    taxsum = defaultdict(int)
+    lorder = []
+    with gzip.open(fname, 'rb') as taxin:
+        for line in taxin:
+            spl = line.decode('ascii').strip().split("\t")
+            rawc[spl[0]][spl[1]] = int(spl[2])
+            if spl[1] not in taxsum:
+                lorder.append(spl[1])
+            taxsum[spl[1]] += int(spl[2])
+    return (rawc, taxsum, lorder)
+
+
+def loglikelihoods(rawc, taxsum, lorder, pseudocounts=1):
+    """
+    Compute the log likelihood of each domain in each taxonomic domain, normalized over the taxdomains
+    Return the sorted list of domains and the matrix of log likelihoods
+    Arguments:
+    - `rawc`: counts as returned by parse_tax_depth
+    - `taxsum`: total counts of each taxdomain
+    - `lorder`: list of taxdomains
+    - `pseudocounts`: Laplace smoothing factor to use
+    """
+    doms = sorted(rawc.keys())
+    counts = np.array([[rawc[d].get(tx, 0) for tx in lorder] for d in doms], dtype=np.float64).reshape(-1, len(lorder))
+    likel = (counts + pseudocounts) / np.array([taxsum[tx] for tx in lorder], dtype=np.float64)
+    likel /= likel.sum(axis=1)[:, None]
+    return (doms, np.log(likel))
+
+
+def _stamp(source):
+    st = os.stat(source)
+    return {"size": st.st_size, "mtime": st.st_mtime}
+
+
+def model_file(dbdir, pseudocounts=1):
+    """
+    Return the name of the compiled model file for the pseudocounts setting
+    """
+    return os.path.join(dbdir, "pfamA_tax_depth.pc{}.model".format(pseudocounts))
+
+
+def write_model(fname, doms, lorder, loglik, source, pseudocounts):
+    """
+    Write the model to a file, replace the previous file atomically
+    """
+    header = dict(_stamp(source), pseudocounts=pseudocounts, lorder=lorder, ndom=len(doms))
+    head = MAGIC + json.dumps(header).encode('ascii') + b"\n" + "\n".join(doms).encode('ascii') + b"\n"
+    head += b"\0" * (-len(head) % 8)
+    (fd, tmpname) = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(fname)))
+    with os.fdopen(fd, 'wb') as fout:
+        fout.write(head)
+        fout.write(np.ascontiguousarray(loglik, dtype=np.float64).tobytes())
+    os.chmod(tmpname, 0o644)
+    os.rename(tmpname, fname)
+
+
+class LikelihoodModel(object):
+    """
+    Log likelihoods of Pfam domains in taxonomic domains
+    `index` maps a Pfam accession to its row in `loglik`, the columns are ordered by `lorder`
+    Indexing with a domain returns a dictionary taxdomain -> likelihood like the one read_likelihoods used to
+    return, unknown domains return an empty dictionary
+    """
+
+    def __init__(self, doms, lorder, loglik):
+        self.domains = doms
+        self.lorder = lorder
+        self.loglik = loglik
+        self.index = dict((d, i) for i, d in enumerate(doms))
+
+    @classmethod
+    def load(cls, fname, source=None):
+        """
+        Memory map the compiled model file. Return None if the file is missing or doesn't match the
+        source file size and modification time
+        """
+        if not os.path.exists(fname):
+            return None
+        with open(fname, 'rb') as fin:
+            if fin.readline() != MAGIC:
+                return None
+            header = json.loads(fin.readline().decode('ascii'))
+            if source is not None and header["size"] != _stamp(source)["size"]:
+                return None
+            if source is not None and header["mtime"] != _stamp(source)["mtime"]:
+                return None
+            doms = [fin.readline().decode('ascii').rstrip("\n") for _ in range(header["ndom"])]
+            offset = fin.tell() + (-fin.tell() % 8)
+        shape = (header["ndom"], len(header["lorder"]))
+        if header["ndom"] == 0:
+            return cls(doms, header["lorder"], np.zeros(shape))
+        return cls(doms, header["lorder"], np.memmap(fname, dtype=np.float64, mode='r', offset=offset, shape=shape))
+
+    def __getitem__(self, dom):
+        if dom not in self.index:
+            return {}
+        return dict(zip(self.lorder, np.exp(self.loglik[self.index[dom]])))
+
+    def __contains__(self, dom):
+        return dom in self.index
+
+    def keys(self):
+        return list(self.domains)
+
+
+def load_model(dbdir, pseudocounts=1, compile=True):
+    """
+    Return the LikelihoodModel of the database. Use the compiled model file if it is up to date, otherwise
+    parse pfamA_tax_depth.txt.gz and write the compiled model (if compile and the directory is writable)
+    Arguments:
+    - `dbdir`: Database dir, look for the file pfamA_tax_depth.txt.gz
+    - `pseudocounts`: Laplace smoothing factor to use
+    - `compile`: Write the compiled model if it's missing or outdated
+    """
+    source = os.path.join(dbdir, TAX_DEPTH)
+    fname = model_file(dbdir, pseudocounts)
+    model = LikelihoodModel.load(fname, source)
+    if model is not None:
+        return model
+    (rawc, taxsum, lorder) = parse_tax_depth(source)
+    (doms, loglik) = loglikelihoods(rawc, taxsum, lorder, pseudocounts)
+    if compile and os.access(dbdir, os.W_OK):
+        write_model(fname, doms, lorder, loglik, source, pseudocounts)
+        return LikelihoodModel.load(fname)
+    return LikelihoodModel(doms, lorder, loglik)
+
+
+class Posteriors(object):
+    """
+    Posteriors of a batch of sequences, computed from a sparse matrix of domain counts
+    - `names`: sequence names, only sequences with at least one known domain
+    - `lorder`: taxdomains, the columns of the matrices
+    - `ndomains`: number of domains found in each sequence (including domains missing from the model)
+    - `logpost`: unnormalized log posteriors
+    - `post`: normalized posteriors
+    - `best`: index of the MAP taxdomain
+    - `margin`: log posterior difference between the MAP and the second best
+    """
+
+    def __init__(self, names, lorder, ndomains, logpost):
+        self.names = names
+        self.lorder = lorder
+        self.ndomains = ndomains
+        self.logpost = logpost
+        norm = np.exp(logpost - logpost.max(axis=1)[:, None]) if len(names) else logpost
+        self.post = norm / norm.sum(axis=1)[:, None] if len(names) else norm
+        self.best = logpost.argmax(axis=1)
+        top = np.sort(logpost, axis=1)
+        self.margin = top[:, -1] - top[:, -2] if len(lorder) > 1 else np.zeros(len(names))
+
+    def MAP(self, i):
+        """
+        Return the MAP taxdomain of the i-th sequence
+        """
+        return self.lorder[self.best[i]]
+
+    def todict(self):
+        """
+        Return the log posteriors as a dictionary sequence -> taxdomain -> log posterior
+        """
+        return dict((n, dict(zip(self.lorder, row))) for n, row in zip(self.names, self.logpost.tolist()))
+
+
+def domain_counts(domains, model):
+    """
+    Intern the domains of each sequence to the model rows and count them
+    Return the sequence names, the number of domains of each sequence and the sparse
+    counts matrix as (rows, cols, counts) arrays
+    Arguments:
+    - `domains`: A dictionary with domain names in each sequence
+    - `model`: LikelihoodModel
+    """
+    names = list(domains.keys())
+    ndomains = np.array([len(domains[n]) for n in names], dtype=np.int64)
+    rows = np.repeat(np.arange(len(names), dtype=np.int64), ndomains)
+    index = model.index
+    cols = np.array([index.get(d, -1) for n in names for d in domains[n]], dtype=np.int64)
+    known = cols >= 0
+    (keys, counts) = np.unique(rows[known] * len(model.domains) + cols[known], return_counts=True)
+    return (names, ndomains, keys // max(1, len(model.domains)), keys % max(1, len(model.domains)), counts)
+
+
+def batch_posteriors(domains, model):
+    """
+    compute posterior probabilities of all the sequences together as a product of the sparse domain
+    counts matrix and the log likelihood matrix
+    Return a Posteriors object
+    Arguments:
+    - `domains`: A dictionary with domain names in each sequence
+    - `model`: LikelihoodModel
+    """
+    with metrics.stage("compute_post"):
+        (names, ndomains, rows, cols, counts) = domain_counts(domains, model)
+        ntax = len(model.lorder)
+        logpost = np.zeros((len(names), ntax))
+        for j in range(ntax):
+            logpost[:, j] = np.bincount(rows, weights=counts * model.loglik[cols, j], minlength=len(names))
+        hasdom = np.bincount(rows, minlength=len(names)) > 0
+    return Posteriors([n for n, h in zip(names, hasdom) if h], model.lorder, ndomains[hasdom], logpost[hasdom])
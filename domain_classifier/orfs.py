@@ -0,0 +1,189 @@
+"""
+Six frame translation of DNA sequences to ORFs, a replacement for EMBOSS getorf -table 1 -find 1
+ORFs are the regions between STOP codons (or the sequence ends), translated with the standard code
+"""
+
+import gzip
+import itertools
+from array import array
+import numpy as np
+
+BASES = "TCAG"
+CODONS = "FFLLSSSSYY**CC*WLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG"
+# IUPAC nucleotide codes and the bases they stand for
+IUPAC = [("A", "A"), ("C", "C"), ("G", "G"), ("T", "T"), ("R", "AG"), ("Y", "CT"), ("S", "CG"), ("W", "AT"),
+         ("K", "GT"), ("M", "AC"), ("B", "CGT"), ("D", "AGT"), ("H", "ACT"), ("V", "ACG"), ("N", "ACGT")]
+COMPLEMENT = {"A": "T", "C": "G", "G": "C", "T": "A", "R": "Y", "Y": "R", "S": "S", "W": "W",
+              "K": "M", "M": "K", "B": "V", "D": "H", "H": "D", "V": "B", "N": "N"}
+STOP = ord("*")
+
+
+def _build_tables():
+    """
+    Return the byte -> nucleotide code table, the code -> complement code table and the
+    translation table of 16*16*16 codon codes. An ambiguous codon is translated to an amino acid only
+    if all the codons it stands for translate to it, otherwise to X
+    """
+    std = dict(("".join(c), a) for c, a in zip(itertools.product(BASES, repeat=3), CODONS))
+    codes = np.full(256, IUPAC.index(("N", "ACGT")), dtype=np.uint8)
+    for i, (c, _) in enumerate(IUPAC):
+        codes[ord(c)] = i
+        codes[ord(c.lower())] = i
+    codes[ord("U")] = codes[ord("u")] = codes[ord("T")]
+    comp = np.zeros(16, dtype=np.uint8)
+    for i, (c, _) in enumerate(IUPAC):
+        comp[i] = [x[0] for x in IUPAC].index(COMPLEMENT[c])
+    trans = np.full(16 ** 3, ord("X"), dtype=np.uint8)
+    for i, j, k in itertools.product(range(len(IUPAC)), repeat=3):
+        aas = set(std[a + b + c] for a in IUPAC[i][1] for b in IUPAC[j][1] for c in IUPAC[k][1])
+        if len(aas) == 1:
+            trans[(i * 16 + j) * 16 + k] = ord(aas.pop())
+    return (codes, comp, trans)
+
+(NUC_CODES, NUC_COMPLEMENT, TRANSLATE) = _build_tables()
+
+
+def _str(b):
+    return b if isinstance(b, str) else b.decode('ascii')
+
+
+def translate_frames(seq):
+    """
+    Return the translation of the three forward frames followed by the three reverse frames of the
+    sequence, as numpy arrays of amino acid bytes
+    Arguments:
+    - `seq`: DNA sequence as bytes
+    """
+    fwd = NUC_CODES[np.frombuffer(seq, dtype=np.uint8)]
+    rev = NUC_COMPLEMENT[fwd[::-1]]
+    frames = []
+    for strand in (fwd, rev):
+        for frame in range(3):
+            ncod = (len(strand) - frame) // 3
+            cod = strand[frame:frame + ncod * 3].reshape(-1, 3).astype(np.uint16)
+            frames.append(TRANSLATE[(cod[:, 0] * 16 + cod[:, 1]) * 16 + cod[:, 2]])
+    return frames
+
+
+def iter_orfs(seq, minsize=300, maxsize=1000000):
+    """
+    Yield the ORFs of the sequence in the order getorf reports them, ORFs are the regions
+    between STOP codons, the STOP codons are not included
+    Arguments:
+    - `seq`: DNA sequence as bytes
+    - `minsize`: Minimal nucleotide size of ORF
+    - `maxsize`: Maximal nucleotide size of ORF
+    """
+    for prot in translate_frames(seq):
+        bounds = np.concatenate(([-1], np.flatnonzero(prot == STOP), [len(prot)]))
+        lens = (np.diff(bounds) - 1) * 3
+        for i in np.flatnonzero((lens >= minsize) & (lens <= maxsize)):
+            yield _str(prot[bounds[i] + 1:bounds[i + 1]].tobytes())
+
+
+def find_orfs(seq, minsize=300, maxsize=1000000):
+    """
+    Return the list of ORFs of the sequence, see iter_orfs
+    """
+    return list(iter_orfs(seq, minsize, maxsize))
+
+
+def read_fasta(infile):
+    """
+    Iterate over the records of a fasta file, might be gzipped. Yield (name, description, sequence)
+    with the sequence as bytes
+    Arguments:
+    - `infile`: input fasta file
+    """
+    fin = gzip.open(infile, 'rb') if infile.endswith(".gz") else open(infile, 'rb')
+    with fin:
+        name = None
+        for line in fin:
+            if line.startswith(b">"):
+                if name is not None:
+                    yield (name, desc, b"".join(seq))
+                spl = _str(line[1:]).strip().split(None, 1)
+                name = spl[0] if spl else ''
+                desc = spl[1] if len(spl) > 1 else ''
+                seq = []
+            elif name is not None:
+                seq.append(line.strip())
+        if name is not None:
+            yield (name, desc, b"".join(seq))
+
+
+def translate_fasta(infile, minsize=300, maxsize=1000000):
+    """
+    Stream the records of the fasta file and translate them. Yield (name, description, length, ORFs)
+    for every record, the ORFs are an iterator, see translate_records
+    Arguments:
+    - `infile`: input fasta file, might be gzipped
+    - `minsize`: Minimal nucleotide size of ORF
+    - `maxsize`: Maximal nucleotide size of ORF
+    """
+    return translate_records(read_fasta(infile), minsize, maxsize)
+
+
+def translate_records(sequences, minsize=300, maxsize=1000000):
+    """
+    Translate an iterator of (name, description, sequence) as read_fasta yields, yield (name, description, length, ORFs)
+    The ORFs are an iterator so they can be sampled without keeping all of them
+    """
+    for (name, desc, seq) in sequences:
+        yield (name, desc, len(seq), iter_orfs(seq, minsize, maxsize))
+
+
+class SequenceInfo(object):
+    """
+    Lengths and descriptions of fasta records, captured while the records are read
+    The description is the full header line like Biopython's SeqRecord.description
+    """
+
+    def __init__(self):
+        self.index = {}
+        self.lengths = array('l')
+        self.descs = []
+
+    def add(self, name, desc, length):
+        self.index[name] = len(self.descs)
+        self.lengths.append(-1 if length is None else length)
+        self.descs.append("{} {}".format(name, desc) if desc else name)
+
+    def get(self, name):
+        """
+        Return the description and length of a record, empty strings for unknown records
+        """
+        if name not in self.index:
+            return ('', '')
+        i = self.index[name]
+        return (self.descs[i], self.lengths[i] if self.lengths[i] >= 0 else '')
+
+    def __len__(self):
+        return len(self.descs)
+
+    def update(self, other):
+        """
+        Add the records of another SequenceInfo
+        """
+        for name in sorted(other.index, key=other.index.get):
+            self.index[name] = len(self.descs)
+            self.lengths.append(other.lengths[other.index[name]])
+            self.descs.append(other.descs[other.index[name]])
+
+    def capture(self, records):
+        """
+        Add the records of an iterator of (name, description, length, ...) as they pass
+        """
+        for rec in records:
+            self.add(rec[0], rec[1], rec[2])
+            yield rec
+
+    @classmethod
+    def from_fasta(cls, infile):
+        """
+        Read the lengths and descriptions of a fasta file
+        """
+        info = cls()
+        for (name, desc, seq) in read_fasta(infile):
+            info.add(name, desc, len(seq))
+        return info
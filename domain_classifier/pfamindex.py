@@ -0,0 +1,79 @@
+"""
+Index of the Pfam-A.fasta.gz sequence IDs (diamond subjects) to their Pfam family
+The index is an SQLite table keyed by the sequence ID with the Pfam accession number as integer
+"""
+
+import os
+import gzip
+import sqlite3
+
+HIT_INDEX = "Pfam-A.hits.sqlite"
+# Number of IDs in a single lookup query
+QUERY_CHUNK = 500
+
+
+def pfam_headers(fasta):
+    """
+    Iterate over the headers of Pfam-A.fasta.gz, yield (sequence id, Pfam accession)
+    Arguments:
+    - `fasta`: Pfam-A.fasta.gz file
+    """
+    with gzip.open(fasta, 'rb') as fain:
+        for line in fain:
+            if line.startswith(b">"):
+                spl = line.decode('ascii').strip().split()
+                yield (spl[0][1:], spl[2][:7])
+
+
+def pfam_to_int(acc):
+    return int(acc[2:])
+
+
+def int_to_pfam(num):
+    return "PF{:05d}".format(num)
+
+
+def build_hit_index(fasta, dbfile):
+    """
+    Write the index of the sequence IDs in Pfam-A.fasta.gz. The index is built in a temporary file
+    and renamed when done
+    Arguments:
+    - `fasta`: Pfam-A.fasta.gz file
+    - `dbfile`: write the index here
+    """
+    tmpname = dbfile + ".tmp"
+    if os.path.exists(tmpname):
+        os.remove(tmpname)
+    conn = sqlite3.connect(tmpname)
+    conn.execute("PRAGMA journal_mode=OFF")
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.execute("CREATE TABLE hit2pfam(hit TEXT PRIMARY KEY, pfam INTEGER NOT NULL) WITHOUT ROWID")
+    conn.executemany("INSERT OR REPLACE INTO hit2pfam VALUES (?,?)",
+                     ((hit, pfam_to_int(acc)) for (hit, acc) in pfam_headers(fasta)))
+    conn.commit()
+    conn.close()
+    os.rename(tmpname, dbfile)
+
+
+def lookup_hits(dbdir, hits):
+    """
+    Return a dictionary of the hits to their Pfam accessions. Use the index if it exists in the
+    database dir, otherwise read Pfam-A.fasta.gz and keep only the given hits
+    Arguments:
+    - `dbdir`: database dir
+    - `hits`: the sequence IDs to look for
+    """
+    hits = list(set(hits))
+    dbfile = os.path.join(dbdir, HIT_INDEX)
+    if not os.path.exists(dbfile):
+        hitset = set(hits)
+        return dict((hit, acc) for (hit, acc) in pfam_headers(os.path.join(dbdir, "Pfam-A.fasta.gz")) if hit in hitset)
+    htod = {}
+    conn = sqlite3.connect(dbfile)
+    for i in range(0, len(hits), QUERY_CHUNK):
+        chunk = hits[i:i + QUERY_CHUNK]
+        query = "SELECT hit, pfam FROM hit2pfam WHERE hit IN ({})".format(",".join("?" * len(chunk)))
+        for (hit, pfam) in conn.execute(query, chunk):
+            htod[hit] = int_to_pfam(pfam)
+    conn.close()
+    return htod
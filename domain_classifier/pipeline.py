@@ -0,0 +1,204 @@
+"""
+Pipelined chunked search. iter_domains_hmm reads, translates, searches and parses a chunk before it starts the next one,
+here the stages run at the same time on consecutive chunks: a thread reads and translates chunk k+1 (running getorf
+on it with use_getorf) while another thread waits for the hmmsearch of chunk k and the caller parses and scores chunk
+k-1. Bounded queues between the stages keep at most depth chunks waiting for the next stage. getorf and hmmsearch run
+outside the interpreter, so the time of a run approaches the time of its slowest stage instead of their sum
+"""
+
+import os
+import time
+import itertools
+import threading
+from collections import defaultdict
+from . import metrics
+from .orfs import translate_fasta, read_fasta, SequenceInfo
+from .hits import resolve_hits, domtblout_hits
+from .dedup import Deduplicator
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# Number of chunks waiting between two stages
+PIPELINE_DEPTH = 2
+# Seconds between checks that the pipeline was stopped while a stage waits for a queue
+POLL_INTERVAL = 0.1
+
+_DONE = object()
+
+
+class _Failed(object):
+    """
+    Passed down the queues when a stage fails, the exception is raised in the caller
+    """
+
+    def __init__(self, error):
+        self.error = error
+
+
+def _put(out, item, stop):
+    """
+    Put the item in the queue unless the pipeline is stopped, return False if it was
+    """
+    while not stop.is_set():
+        try:
+            out.put(item, timeout=POLL_INTERVAL)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _get(inq, stop):
+    """
+    Return the next item of the queue, _DONE if the pipeline is stopped
+    """
+    while not stop.is_set():
+        try:
+            return inq.get(timeout=POLL_INTERVAL)
+        except queue.Empty:
+            pass
+    return _DONE
+
+
+class _Stage(threading.Thread):
+    """
+    Run func(stop) in a thread, an exception is passed to the out queue
+    """
+
+    def __init__(self, func, out, stop):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.func = func
+        self.out = out
+        self.stop = stop
+
+    def run(self):
+        try:
+            self.func(self.stop)
+        except Exception as e:
+            _put(self.out, _Failed(e), self.stop)
+
+
+def chunk_records(infile, chunk, protein=False, use_getorf=False, getorf='getorf'):
+    """
+    Yield the (name, description, length, ORFs) records of each chunk of chunk input sequences, consume a chunk
+    before asking for the next one. With use_getorf every chunk of the DNA is translated with getorf by itself,
+    the records of sequences without ORFs are not yielded so a chunk might be empty
+    """
+    # Imported here, the package imports this module
+    from . import run_getorf
+    if use_getorf and not protein:
+        sequences = read_fasta(infile)
+        for first in sequences:
+            yield run_getorf(infile, getorf, itertools.chain([first], itertools.islice(sequences, chunk - 1)))
+        return
+    if protein:
+        records = ((name, desc, len(seq), [seq.decode('ascii')]) for (name, desc, seq) in read_fasta(infile))
+    else:
+        records = translate_fasta(infile)
+    for first in records:
+        yield itertools.chain([first], itertools.islice(records, chunk - 1))
+
+
+def iter_domains_pipelined(infile, dbdir, faafile, hmmout, protein=False, incscore=20, threads=20, shuffle=100, hmmsearch='hmmsearch', getorf='getorf', shards=1, use_getorf=False, chunk=1000, seed=0, subset=False, weighted=False, dedup=False, depth=PIPELINE_DEPTH):
+    """
+    Like iter_domains_hmm with chunks, the translation, the search and the parsing of consecutive chunks overlap.
+    Yield (domains, info) of every chunk in the input order, score a chunk while the next ones are translated and searched.
+    The proteins and the hmmsearch output of the chunks are appended to faafile and hmmout in the input order
+    Arguments:
+    - `chunk`: Number of input sequences in each chunk
+    - `depth`: Number of chunks waiting between two stages
+    - `dedup`: Search the identical proteins of a chunk once, see Deduplicator
+    Other arguments are the same as find_domains_hmm
+    """
+    # Imported here, the package imports this module
+    from . import write_proteins, run_hmmsearch, _append
+    prefix = "{}.chunk".format(hmmout)
+    translated = queue.Queue(depth)
+    searched = queue.Queue(depth)
+    stop = threading.Event()
+    pending = []
+
+    def translate(stop):
+        chunks = chunk_records(infile, max(1, chunk), protein, use_getorf, getorf)
+        try:
+            for (k, records) in enumerate(chunks):
+                info = SequenceInfo()
+                dedupl = Deduplicator() if dedup else None
+                chunkfaa = "{}{}.faa".format(prefix, k)
+                pending.append(chunkfaa)
+                if not write_proteins(info.capture(records), chunkfaa, shuffle, seed, weighted, dedupl):
+                    # No ORFs in the chunk, hmmsearch fails on an empty file
+                    os.remove(chunkfaa)
+                    if not len(info):
+                        # With getorf the sequences without ORFs are not reported
+                        continue
+                    chunkfaa = None
+                if not _put(translated, (chunkfaa, info, dedupl), stop):
+                    return
+        finally:
+            chunks.close()
+        _put(translated, _DONE, stop)
+
+    def search(stop):
+        while True:
+            item = _get(translated, stop)
+            if item is _DONE or isinstance(item, _Failed):
+                _put(searched, item, stop)
+                return
+            (chunkfaa, info, dedupl) = item
+            if chunkfaa is None:
+                if not _put(searched, (None, None, info, dedupl, 0), stop):
+                    return
+                continue
+            chunkout = "{}.domtbl".format(chunkfaa[:-len(".faa")])
+            pending.append(chunkout)
+            start = time.time()
+            run_hmmsearch(chunkfaa, dbdir, chunkout, incscore, threads, shards, hmmsearch, subset,
+                          dedupl.copies() if dedupl else None)
+            if not _put(searched, (chunkfaa, chunkout, info, dedupl, time.time() - start), stop):
+                return
+
+    stages = [_Stage(translate, translated, stop), _Stage(search, searched, stop)]
+    for stage in stages:
+        stage.start()
+    first = True
+    try:
+        while True:
+            try:
+                # Polled, a blocking get can't be interrupted in Python 2
+                item = searched.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                continue
+            if item is _DONE:
+                break
+            if isinstance(item, _Failed):
+                raise item.error
+            (chunkfaa, chunkout, info, dedupl, seconds) = item
+            domains = defaultdict(list)
+            if chunkfaa is None:
+                yield (domains, info)
+                continue
+            with metrics.stage("parse_domtblout"):
+                for (target, doms) in resolve_hits(domtblout_hits(chunkout), grouped=False):
+                    domains[target].extend(doms)
+                    metrics.count("domains", len(doms))
+            if dedupl:
+                dedupl.fan_out(domains)
+                dedupl.report(seconds)
+            _append(chunkfaa, faafile, first)
+            _append(chunkout, hmmout, first)
+            first = False
+            metrics.count("pipeline_chunks")
+            yield (domains, info)
+    finally:
+        stop.set()
+        for stage in stages:
+            stage.join()
+        # The chunks of a failed or abandoned run
+        for fname in pending:
+            if os.path.exists(fname):
+                os.remove(fname)
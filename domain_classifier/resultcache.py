@@ -0,0 +1,121 @@
+"""
+Cache of the resolved domains of sequences, to search only new or changed sequences when an input is classified again
+The cache is an SQLite table keyed by a hash of the sequence salted with the Pfam release and the search parameters,
+a change in any of them makes the old results unreachable
+"""
+
+import os
+import gzip
+import json
+import hashlib
+import sqlite3
+
+# Number of keys in a single lookup query
+QUERY_CHUNK = 500
+# Number of sequences looked up together
+LOOKUP_BATCH = 2000
+
+
+def pfam_release(dbdir, dbfile="Pfam-A.hmm"):
+    """
+    Return the Pfam release of the database dir from Pfam.version(.gz) if it exists,
+    otherwise the size and modification time of the search database file
+    Arguments:
+    - `dbdir`: database dir
+    - `dbfile`: the database file searched, Pfam-A.hmm or the diamond database
+    """
+    for (fname, opener) in (("Pfam.version.gz", gzip.open), ("Pfam.version", open)):
+        fname = os.path.join(dbdir, fname)
+        if os.path.exists(fname):
+            with opener(fname, 'rb') as fin:
+                for line in fin:
+                    spl = line.decode('ascii').split(":", 1)
+                    if spl[0].strip() == "Pfam release":
+                        return spl[1].strip()
+    fname = os.path.join(dbdir, dbfile)
+    if not os.path.exists(fname):
+        return None
+    stat = os.stat(fname)
+    return "{}:{}:{}".format(dbfile, stat.st_size, int(stat.st_mtime))
+
+
+def write_fasta(sequences, fname):
+    """
+    Write (name, description, sequence) records to a fasta file, return the number of records written
+    """
+    nrec = 0
+    with open(fname, 'wb') as fout:
+        for (name, desc, seq) in sequences:
+            fout.write(">{} {}\n".format(name, desc).encode('ascii') if desc else ">{}\n".format(name).encode('ascii'))
+            fout.write(seq + b"\n")
+            nrec += 1
+    return nrec
+
+
+class ResultCache(object):
+    """
+    Domains found on sequences by a specific search
+    Arguments:
+    - `fname`: SQLite cache file, shared by all the searches
+    - `params`: dictionary of everything the results depend on (method, Pfam release, thresholds, ...)
+    """
+
+    def __init__(self, fname, params):
+        self.conn = sqlite3.connect(fname, timeout=600)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS results(key TEXT PRIMARY KEY, domains TEXT NOT NULL) WITHOUT ROWID")
+        self.conn.commit()
+        self.salt = json.dumps(sorted(params.items())).encode('ascii')
+
+    def key(self, seq):
+        """
+        Return the cache key of a sequence (bytes), the case of the sequence is ignored
+        """
+        return hashlib.sha1(self.salt + b"\n" + seq.upper()).hexdigest()
+
+    def get(self, keys):
+        """
+        Return a dictionary key -> list(domains) of the cached keys
+        """
+        keys = list(keys)
+        found = {}
+        for i in range(0, len(keys), QUERY_CHUNK):
+            part = keys[i:i + QUERY_CHUNK]
+            for (key, doms) in self.conn.execute("SELECT key, domains FROM results WHERE key IN ({})".format(
+                    ",".join("?" * len(part))), part):
+                found[key] = doms.split()
+        return found
+
+    def put(self, results):
+        """
+        Store an iterator of (key, list(domains))
+        """
+        self.conn.executemany("INSERT OR REPLACE INTO results VALUES (?,?)", ((k, " ".join(d)) for (k, d) in results))
+        self.conn.commit()
+
+    def split(self, sequences, cached, keys, batch=LOOKUP_BATCH):
+        """
+        Look up the sequences in batches, yield the sequences that are not in the cache
+        Arguments:
+        - `sequences`: iterator of (name, description, sequence) as read_fasta yields
+        - `cached`: append (name, description, length, domains) of the cached sequences to this list
+        - `keys`: add name -> key of the yielded sequences to this dictionary, to store their results later
+        - `batch`: number of sequences looked up together
+        """
+        while True:
+            part = []
+            for rec in sequences:
+                part.append((rec, self.key(rec[2])))
+                if len(part) >= batch:
+                    break
+            if not part:
+                return
+            found = self.get(set(x[1] for x in part))
+            for ((name, desc, seq), key) in part:
+                if key in found:
+                    cached.append((name, desc, len(seq), found[key]))
+                else:
+                    keys[name] = key
+                    yield (name, desc, seq)
+
+    def close(self):
+        self.conn.close()
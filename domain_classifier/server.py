@@ -0,0 +1,233 @@
+"""
+Local classification daemon. Requests from many small jobs are gathered into micro-batches, each batch is searched
+with a single hmmsearch (or diamond) run so the Pfam profiles are read once for all of them, and scored with the
+resident model of a DomainClassifier.
+The daemon listens on a Unix socket (or host:port on localhost). The protocol is a json line for a request and a json
+line for its response:
+    request:  {"records": [[name, description, sequence], ...], "all": false, "protein": false}
+    response: {"columns": [...], "rows": [[...], ...]} or {"error": message, "busy": true/false}
+Pending requests wait in a bounded queue, when it's full the request is answered busy after a timeout and the
+client retries with a backoff
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import logging
+import tempfile
+import threading
+from collections import defaultdict
+from .orfs import SequenceInfo
+from .resultcache import write_fasta
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# Maximal number of records searched together
+BATCH_RECORDS = 2000
+# Seconds to wait for more requests before a batch is searched
+BATCH_WAIT = 0.5
+# Number of requests waiting to be searched
+QUEUE_SIZE = 64
+# Seconds a request waits for a place in the queue before it's answered busy
+QUEUE_TIMEOUT = 30
+# Largest request accepted, in records
+MAX_RECORDS = 100000
+
+
+class Request(object):
+    """
+    A classification request waiting for its batch
+    """
+
+    def __init__(self, records, all=False):
+        self.records = records
+        self.all = all
+        self.done = threading.Event()
+        self.response = None
+
+
+class Batcher(threading.Thread):
+    """
+    Take requests from the queue, gather them to batches of up to batch_records records (waiting up to batch_wait
+    seconds for more requests) and classify each batch together
+    """
+
+    def __init__(self, classifier, requests, batch_records=BATCH_RECORDS, batch_wait=BATCH_WAIT):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.classifier = classifier
+        self.requests = requests
+        self.batch_records = batch_records
+        self.batch_wait = batch_wait
+
+    def next_batch(self):
+        batch = [self.requests.get()]
+        nrec = len(batch[0].records)
+        deadline = time.time() + self.batch_wait
+        while nrec < self.batch_records:
+            try:
+                req = self.requests.get(timeout=max(0, deadline - time.time()))
+            except queue.Empty:
+                break
+            batch.append(req)
+            nrec += len(req.records)
+        return batch
+
+    def classify(self, batch):
+        """
+        Search the records of all the requests together, the records are renamed to <request>|<name>
+        and the domains are split back to the requests
+        """
+        records = (("{}|{}".format(i, name), desc, seq.encode('ascii')) for i, req in enumerate(batch)
+                   for (name, desc, seq) in req.records)
+        (fd, fname) = tempfile.mkstemp(suffix=".fa", dir=self.classifier.tmpdir)
+        os.close(fd)
+        try:
+            write_fasta(records, fname)
+            (domains, _) = self.classifier.find_domains(fname)
+        finally:
+            os.remove(fname)
+        split = defaultdict(dict)
+        for (name, doms) in domains.items():
+            (i, name) = name.split("|", 1)
+            split[int(i)][name] = doms
+        header = self.classifier.header()
+        for i, req in enumerate(batch):
+            info = SequenceInfo()
+            for (name, desc, seq) in req.records:
+                info.add(name, desc, len(seq))
+            req.response = dict(columns=header, rows=self.classifier.rows(split[i], info, req.all))
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            logging.info("Classifying {} requests, {} records".format(len(batch), sum(len(x.records) for x in batch)))
+            try:
+                self.classify(batch)
+            except Exception as e:
+                logging.exception("Batch failed")
+                for req in batch:
+                    req.response = dict(error="Classification failed: {}".format(e), busy=False)
+            for req in batch:
+                req.done.set()
+
+
+class Handler(socketserver.StreamRequestHandler):
+    """
+    Read a request line, queue it and write the response line when its batch is done
+    """
+
+    def handle(self):
+        server = self.server
+        try:
+            msg = json.loads(self.rfile.readline().decode('utf-8'))
+            records = msg.get("records", [])
+            if bool(msg.get("protein", False)) != server.classifier.protein:
+                response = dict(error="The daemon classifies {} sequences".format("protein" if server.classifier.protein else "DNA"), busy=False)
+            elif len(records) > server.max_records:
+                response = dict(error="Too many records ({}), the limit is {}".format(len(records), server.max_records), busy=False)
+            else:
+                req = Request(records, bool(msg.get("all", False)))
+                try:
+                    server.requests.put(req, timeout=server.queue_timeout)
+                    req.done.wait()
+                    response = req.response
+                except queue.Full:
+                    response = dict(error="Queue is full", busy=True)
+        except ValueError as e:
+            response = dict(error="Bad request: {}".format(e), busy=False)
+        self.wfile.write((json.dumps(response) + "\n").encode('utf-8'))
+
+
+class ThreadedUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class ThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def _address(address):
+    """
+    Return (family, address) of a Unix socket path or a host:port
+    """
+    if ":" in address and "/" not in address:
+        (host, port) = address.rsplit(":", 1)
+        return (socket.AF_INET, (host or "localhost", int(port)))
+    return (socket.AF_UNIX, address)
+
+
+def serve(classifier, address, batch_records=BATCH_RECORDS, batch_wait=BATCH_WAIT, queue_size=QUEUE_SIZE,
+          queue_timeout=QUEUE_TIMEOUT, max_records=MAX_RECORDS):
+    """
+    Serve classification requests until interrupted
+    Arguments:
+    - `classifier`: DomainClassifier
+    - `address`: Unix socket path or host:port
+    - `batch_records`: Maximal number of records in a batch
+    - `batch_wait`: Seconds to wait for more requests before a batch is searched
+    - `queue_size`: Number of requests waiting to be searched
+    - `queue_timeout`: Seconds to wait for a place in the queue before answering busy
+    - `max_records`: Largest request accepted
+    """
+    (family, addr) = _address(address)
+    if family == socket.AF_UNIX:
+        if os.path.exists(addr):
+            os.remove(addr)
+        server = ThreadedUnixServer(addr, Handler)
+    else:
+        server = ThreadedTCPServer(addr, Handler)
+    server.classifier = classifier
+    server.requests = queue.Queue(queue_size)
+    server.queue_timeout = queue_timeout
+    server.max_records = max_records
+    Batcher(classifier, server.requests, batch_records, batch_wait).start()
+    logging.info("Listening on {}".format(address))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if family == socket.AF_UNIX and os.path.exists(addr):
+            os.remove(addr)
+
+
+def classify_remote(address, records, all=False, protein=False, retries=10, backoff=1.0):
+    """
+    Send records to a classification daemon, return (columns, rows) of the predictions table
+    A busy daemon is retried with an exponential backoff
+    Arguments:
+    - `address`: Unix socket path or host:port of the daemon
+    - `records`: iterator of (name, description, sequence) with the sequence as bytes
+    - `all`: Classify all the records together
+    - `protein`: The records are protein
+    - `retries`: Number of times to retry a busy daemon
+    - `backoff`: Seconds to wait before the first retry
+    """
+    (family, addr) = _address(address)
+    msg = json.dumps(dict(records=[[n, d, s.decode('ascii')] for (n, d, s) in records], all=all, protein=protein))
+    for attempt in range(retries + 1):
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            sock.connect(addr)
+            sock.sendall((msg + "\n").encode('utf-8'))
+            fin = sock.makefile('rb')
+            response = json.loads(fin.readline().decode('utf-8'))
+            fin.close()
+        finally:
+            sock.close()
+        if 'error' not in response:
+            return (response['columns'], response['rows'])
+        if not response.get('busy') or attempt == retries:
+            raise RuntimeError("Classification daemon: {}".format(response['error']))
+        sys.stderr.write("Classification daemon is busy, retrying\n")
+        time.sleep(backoff * 2 ** attempt)
@@ -0,0 +1,180 @@
+"""
+Run hmmsearch on shards of a protein fasta file in parallel and merge the results
+hmmsearch threads don't scale well beyond a few cores, running several processes
+on balanced parts of the input uses the rest of the machine
+The merged domains match a single run up to the rounding of the domtblout: the domain P-values are printed with
+two digits, a domain with an E-value within that rounding of the reporting threshold might be kept or dropped
+differently. The merged lines are grouped by shard, not in the model order of a single run
+"""
+
+import os
+import re
+import sys
+import heapq
+import shutil
+import tempfile
+import subprocess
+from collections import defaultdict
+from multiprocessing.pool import ThreadPool
+from . import metrics
+
+# hmmsearch default domain reporting threshold (--domE)
+DOM_EVALUE = 10.0
+# The c-Evalue and i-Evalue columns of a domtblout line
+DOM_EVALUE_COLUMNS = (11, 12)
+
+
+def fasta_lengths(faafile):
+    """
+    Return a list of (name, length) of the records in the fasta file by their order
+    Arguments:
+    - `faafile`: protein fasta file
+    """
+    lens = []
+    with open(faafile, 'r') as fin:
+        for line in fin:
+            if line.startswith(">"):
+                lens.append([line[1:].split(None, 1)[0], 0])
+            elif lens:
+                lens[-1][1] += len(line.strip())
+    return [tuple(x) for x in lens]
+
+
+def balance_shards(lens, nshards):
+    """
+    Assign records to shards such that the number of residues in each shard is balanced
+    Use the longest processing time heuristic, longest records first to the lightest shard
+    Return a list with the shard number of each record
+    Arguments:
+    - `lens`: list of (name, length) as returned by fasta_lengths
+    - `nshards`: number of shards
+    """
+    heap = [(0, i) for i in range(nshards)]
+    assign = [0] * len(lens)
+    for rec in sorted(range(len(lens)), key=lambda x: -lens[x][1]):
+        (size, shard) = heapq.heappop(heap)
+        assign[rec] = shard
+        heapq.heappush(heap, (size + lens[rec][1], shard))
+    return assign
+
+
+def split_fasta(faafile, nshards, outdir):
+    """
+    Split the fasta file to shards balanced by residue count. Records keep their original order
+    within each shard. Return the list of shard file names and the total number of records
+    Arguments:
+    - `faafile`: protein fasta file
+    - `nshards`: number of shards
+    - `outdir`: write the shards in this directory
+    """
+    lens = fasta_lengths(faafile)
+    nshards = max(1, min(nshards, len(lens)))
+    assign = balance_shards(lens, nshards)
+    names = [os.path.join(outdir, "shard_{}.faa".format(i)) for i in range(nshards)]
+    outs = [open(x, 'w') for x in names]
+    rec = -1
+    with open(faafile, 'r') as fin:
+        for line in fin:
+            if line.startswith(">"):
+                rec += 1
+            if rec >= 0:
+                outs[assign[rec]].write(line)
+    for fout in outs:
+        fout.close()
+    return (names, len(lens))
+
+
+def scale_columns(line, columns, factor):
+    """
+    Return the whitespace separated line with the numbers of the columns multiplied by factor, the other
+    columns and the alignment of the line are kept. The numbers are printed with two digits like hmmsearch does
+    """
+    fields = re.split(r'(\s+)', line)
+    # The separators are kept between the fields, a leading separator follows an empty first field
+    first = 0 if fields[0] else 2
+    for col in columns:
+        idx = first + 2 * col
+        old = fields[idx]
+        new = "{:.2g}".format(float(old) * factor)
+        fields[idx - 1] = " " * max(1, len(fields[idx - 1]) + len(old) - len(new))
+        fields[idx] = new
+    return "".join(fields)
+
+
+def merge_domtblout(shardouts, hmmout, domE=DOM_EVALUE, copies=None):
+    """
+    Merge the domtblout files of the shards to a single file.
+    The shards were searched with --domZ 1 so the c-Evalue and i-Evalue columns are domain P-values. hmmsearch
+    sets domZ to the number of reported targets for each model, recompute it over all the shards, rescale the
+    columns by it and keep only the domains a single run would have reported. The cut is made on the product of the
+    P-value and domZ before it's rounded again
+    Arguments:
+    - `shardouts`: list of domtblout files
+    - `hmmout`: write the merged table here
+    - `domE`: domain reporting E-value threshold
+    - `copies`: dictionary target -> number of targets it stands for, the targets not in it count once
+    """
+    copies = copies or {}
+    targets = defaultdict(set)
+    for fname in shardouts:
+        with open(fname, 'r') as fin:
+            for line in fin:
+                if line.startswith("#"):
+                    continue
+                spl = line.split()
+                targets[spl[3]].add(spl[0])
+    with open(hmmout, 'w') as fout:
+        for i, fname in enumerate(shardouts):
+            with open(fname, 'r') as fin:
+                header = True
+                for line in fin:
+                    if line.startswith("#"):
+                        if header and i == 0:
+                            fout.write(line)
+                        continue
+                    header = False
+                    spl = line.split()
+                    domZ = sum(copies.get(x, 1) for x in targets[spl[3]])
+                    if float(spl[12]) * domZ <= domE:
+                        fout.write(scale_columns(line, DOM_EVALUE_COLUMNS, domZ))
+
+
+def run_sharded_hmmsearch(faafile, hmmfile, hmmout, incscore=20, threads=20, shards=4, hmmsearch='hmmsearch', copies=None):
+    """
+    Split the protein file to shards and run a pool of hmmsearch processes on them
+    The threads are divided between the processes, at most threads processes are run. The merged domtblout is
+    written to hmmout
+    Arguments:
+    - `faafile`: protein fasta file
+    - `hmmfile`: the HMM database
+    - `hmmout`: write the merged hmmsearch domtblout here
+    - `incscore`: pass to -T and --incT parameters
+    - `threads`: total number of cores to use
+    - `shards`: number of hmmsearch processes
+    - `hmmsearch`: hmmsearch executable
+    - `copies`: dictionary record -> number of records it stands for in the E-values, see merge_domtblout
+    """
+    tmpdir = tempfile.mkdtemp(prefix="hmmshards")
+    try:
+        # More processes than cores would oversubscribe the machine
+        (names, nseqs) = split_fasta(faafile, min(shards, max(1, threads)), tmpdir)
+        if copies:
+            nseqs += sum(copies.values()) - len(copies)
+        # The first shards get the remainder of the threads
+        (cpu, extra) = divmod(max(1, threads), len(names))
+        cmds = []
+        for (i, name) in enumerate(names):
+            cmds.append("{} --cpu {} -Z {} --domZ 1 --domtblout {}.domtbl -o /dev/null --incT {} -T {} {} {}".format(
+                hmmsearch, cpu + (1 if i < extra else 0), nseqs, name, incscore, incscore, hmmfile, name))
+        for cmd in cmds:
+            sys.stderr.write("Running: {}\n".format(cmd))
+        pool = ThreadPool(len(cmds))
+        try:
+            pool.map(lambda cmd: metrics.check_call(cmd, shell=True, stderr=subprocess.STDOUT), cmds)
+        finally:
+            pool.close()
+            pool.join()
+        with metrics.stage("merge_domtblout"):
+            merge_domtblout(["{}.domtbl".format(x) for x in names], hmmout, copies=copies)
+    finally:
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,182 @@
+"""
+Discriminative subset of the Pfam database. Most families are found in all the taxonomic domains in about the same
+proportions, their likelihoods are nearly uniform and they barely change the posteriors, but hmmsearch time grows
+with the number of models. The families are ranked by their information content (the divergence of their taxdomain
+likelihoods from uniform, in bits) weighted by the number of genomes they are found in, and the top families that
+carry the requested coverage of the total weighted information are written to Pfam-A.subset.hmm and to a subset of
+Pfam-A.fasta.gz for the diamond database
+"""
+
+import os
+import gzip
+import hashlib
+from collections import defaultdict
+import numpy as np
+from . import metrics
+from .model import load_model, parse_tax_depth, batch_posteriors, TAX_DEPTH
+from .hits import resolve_hits, domtblout_hits
+
+SUBSET_HMM = "Pfam-A.subset.hmm"
+SUBSET_FASTA = "Pfam-A.subset.fasta.gz"
+SUBSET_DIAMOND = "Pfam-A.subset"
+SUBSET_FAMILIES = "Pfam-A.subset.txt"
+
+
+def information_content(model):
+    """
+    Return the information content of each family of the model (in its domains order), log2 of the number
+    of taxdomains minus the entropy of the family likelihoods
+    Arguments:
+    - `model`: LikelihoodModel, the likelihoods of each family are normalized over the taxdomains
+    """
+    loglik = np.asarray(model.loglik)
+    return np.log2(len(model.lorder)) + (np.exp(loglik) * loglik).sum(axis=1) / np.log(2)
+
+
+def rank_families(dbdir, pseudocounts=1):
+    """
+    Rank the families of the database by their information content weighted by the number of genomes they are
+    found in. Return a list of (family, information content, weight) by decreasing weighted information
+    Arguments:
+    - `dbdir`: database dir
+    - `pseudocounts`: Laplace smoothing of the model
+    """
+    model = load_model(dbdir, pseudocounts)
+    (rawc, _, _) = parse_tax_depth(os.path.join(dbdir, TAX_DEPTH))
+    info = information_content(model)
+    weights = np.array([sum(rawc[d].values()) for d in model.domains], dtype=np.float64)
+    order = np.argsort(-info * weights, kind='mergesort')
+    return [(model.domains[i], float(info[i]), float(weights[i])) for i in order]
+
+
+def select_families(ranked, coverage):
+    """
+    Return the top families of the ranking that carry coverage (0-1) of the total weighted information
+    """
+    if not ranked:
+        return []
+    cumulative = np.cumsum([info * weight for (_, info, weight) in ranked])
+    nfams = min(len(ranked), int(np.searchsorted(cumulative, coverage * cumulative[-1])) + 1)
+    return [fam for (fam, _, _) in ranked[:nfams]]
+
+
+def write_subset_hmm(hmmfile, families, outfile):
+    """
+    Copy the models of the families from the HMM database to outfile, return the number of models copied
+    Arguments:
+    - `hmmfile`: Pfam-A.hmm
+    - `families`: set of Pfam accessions without version
+    - `outfile`: write the subset here, the file is renamed to its place when done
+    """
+    nmodels = 0
+    tmpname = outfile + ".tmp"
+    with open(hmmfile, 'r') as fin:
+        with open(tmpname, 'w') as fout:
+            model = []
+            keep = False
+            for line in fin:
+                model.append(line)
+                if line.startswith("ACC "):
+                    keep = line.split()[1].split(".")[0] in families
+                elif line.startswith("//"):
+                    if keep:
+                        fout.writelines(model)
+                        nmodels += 1
+                    model = []
+                    keep = False
+    os.rename(tmpname, outfile)
+    return nmodels
+
+
+def write_subset_fasta(fasta, families, outfile):
+    """
+    Copy the sequences of the families from Pfam-A.fasta.gz to outfile (gzipped), return the number of sequences copied
+    Arguments:
+    - `fasta`: Pfam-A.fasta.gz
+    - `families`: set of Pfam accessions without version
+    - `outfile`: write the subset here, the file is renamed to its place when done
+    """
+    nseqs = 0
+    tmpname = outfile + ".tmp"
+    with gzip.open(fasta, 'rb') as fin:
+        with gzip.open(tmpname, 'wb') as fout:
+            keep = False
+            for line in fin:
+                if line.startswith(b">"):
+                    keep = line.split()[2][:7].decode('ascii') in families
+                    nseqs += keep
+                if keep:
+                    fout.write(line)
+    os.rename(tmpname, outfile)
+    return nseqs
+
+
+def build_subset(dbdir, coverage, pseudocounts=1, fasta=True):
+    """
+    Write Pfam-A.subset.hmm, the list of the selected families with their information content and weight
+    (Pfam-A.subset.txt) and, if fasta, Pfam-A.subset.fasta.gz for the diamond database.
+    Return the selected families and the number of models written
+    Arguments:
+    - `dbdir`: database dir with Pfam-A.hmm, pfamA_tax_depth.txt.gz and Pfam-A.fasta.gz
+    - `coverage`: fraction of the total weighted information the subset carries
+    - `pseudocounts`: Laplace smoothing of the model
+    - `fasta`: Write the subset of Pfam-A.fasta.gz too
+    """
+    with metrics.stage("rank_families"):
+        ranked = rank_families(dbdir, pseudocounts)
+        families = select_families(ranked, coverage)
+    with open(os.path.join(dbdir, SUBSET_FAMILIES), 'w') as fout:
+        for (fam, info, weight) in ranked[:len(families)]:
+            fout.write("{}\t{:.4f}\t{:g}\n".format(fam, info, weight))
+    famset = set(families)
+    with metrics.stage("write_subset"):
+        nmodels = write_subset_hmm(os.path.join(dbdir, "Pfam-A.hmm"), famset, os.path.join(dbdir, SUBSET_HMM))
+        if fasta:
+            nseqs = write_subset_fasta(os.path.join(dbdir, "Pfam-A.fasta.gz"), famset, os.path.join(dbdir, SUBSET_FASTA))
+            metrics.count("subset_sequences", nseqs)
+    metrics.count("subset_models", nmodels)
+    return (families, nmodels)
+
+
+def read_subset(dbdir):
+    """
+    Return the set of families in the subset of the database
+    """
+    with open(os.path.join(dbdir, SUBSET_FAMILIES), 'r') as fin:
+        return set(line.split("\t", 1)[0] for line in fin if line.strip())
+
+
+def subset_id(dbdir):
+    """
+    Return a hash of the subset families list, identifies the subset in the results cache
+    """
+    with open(os.path.join(dbdir, SUBSET_FAMILIES), 'rb') as fin:
+        return hashlib.sha1(fin.read()).hexdigest()
+
+
+def subset_report(hmmout, model, families):
+    """
+    Compare the MAP calls of a search of the full database to the calls of the subset. hmmsearch reports hits by their
+    bit score (-T) so the subset search finds the same hits of the kept families, its results are the hits of the
+    full search without the removed families, resolved again
+    Return a dictionary with the number of sequences classified by the full search, the number of them the subset
+    classifies differently (or can't classify) and the list of (sequence, full MAP, subset MAP) of the changed calls
+    Arguments:
+    - `hmmout`: hmmsearch domtblout of the full database
+    - `model`: LikelihoodModel
+    - `families`: set of the subset families
+    """
+    full = defaultdict(list)
+    subset = defaultdict(list)
+    for (target, doms) in resolve_hits(domtblout_hits(hmmout), grouped=False):
+        full[target].extend(doms)
+    for (target, doms) in resolve_hits((x for x in domtblout_hits(hmmout) if x[4] in families), grouped=False):
+        subset[target].extend(doms)
+    fullpost = batch_posteriors(full, model)
+    subpost = batch_posteriors(subset, model)
+    submap = dict((name, subpost.MAP(i)) for i, name in enumerate(subpost.names))
+    changed = []
+    for i, name in enumerate(fullpost.names):
+        if submap.get(name) != fullpost.MAP(i):
+            changed.append((name, fullpost.MAP(i), submap.get(name)))
+    return dict(sequences=len(fullpost.names), changed=len(changed), calls=changed)
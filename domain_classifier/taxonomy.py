@@ -0,0 +1,444 @@
+"""
+Taxonomy lookups for filtering kraken databases
+The lineage table keeps the parent of every taxid in an array indexed by taxid and the nearest
+ancestor (or the node itself) which is a taxonomic domain or one of the nodes the filter treats specially
+(viruses, archaea, environmental samples). Checking a lineage is a few array lookups instead of walking
+up the tree
+"""
+
+import os
+import glob
+import logging
+import sqlite3
+import itertools
+import numpy as np
+from . import metrics
+
+ROOT = 1
+BACTERIA = 2
+EUKARYOTA = 2759
+ARCHAEA = 2157
+VIRUSES = 10239
+ENVIRONMENTAL = 48479
+MARKERS = (BACTERIA, EUKARYOTA, ARCHAEA, VIRUSES, ENVIRONMENTAL)
+
+
+def read_nodes(nodes):
+    """
+    Iterate over nodes.dmp, yield (taxid, parent)
+    Arguments:
+    - `nodes`: nodes.dmp file
+    """
+    with open(nodes, 'r') as nodesf:
+        for line in nodesf:
+            spl = line.split("\t|\t", 2)
+            yield (int(spl[0]), int(spl[1]))
+
+
+class LineageTable(object):
+    """
+    Parent and nearest marker ancestor of every taxid. Missing nodes have parent -1 and nodes without
+    a marker ancestor have marker 0
+    """
+
+    def __init__(self, parent, marker):
+        self.parent = parent
+        self.marker = marker
+
+    @classmethod
+    def build(cls, nodes):
+        """
+        Build the table from an iterator of (taxid, parent)
+        """
+        pairs = np.fromiter(itertools.chain.from_iterable(nodes), dtype=np.int64).reshape(-1, 2)
+        size = int(max(pairs.max(), max(MARKERS))) + 1 if len(pairs) else max(MARKERS) + 1
+        parent = np.full(size, -1, dtype=np.int32)
+        parent[pairs[:, 0]] = pairs[:, 1]
+        # Pointer jumping, the markers, the root and missing nodes point to themselves
+        ismarker = np.zeros(size, dtype=bool)
+        ismarker[list(MARKERS)] = parent[list(MARKERS)] >= 0
+        jump = np.where((parent < 0) | ismarker, np.arange(size, dtype=np.int32), parent)
+        while True:
+            nxt = jump[jump]
+            if np.array_equal(nxt, jump):
+                break
+            jump = nxt
+        marker = np.where(ismarker[jump], jump, 0).astype(np.int32)
+        return cls(parent, marker)
+
+    @classmethod
+    def load(cls, fname):
+        """
+        Memory map a table saved with save
+        """
+        table = np.load(fname, mmap_mode='r')
+        return cls(table[0], table[1])
+
+    def save(self, fname):
+        """
+        Save the table, write a temporary file first and rename it
+        """
+        tmpname = "{}.tmp.npy".format(fname)
+        np.save(tmpname, np.vstack((self.parent, self.marker)))
+        os.rename(tmpname, fname)
+
+    def known(self, taxid):
+        return 0 < taxid < len(self.parent) and self.parent[taxid] >= 0
+
+    def match(self, domain, taxid, keepvir=False, keepenv=False, keeparch=False):
+        """
+        Return True if the taxid is under the domain, same rules as walking up the tree:
+        a virus returns True unless keepvir, archaea returns True unless keeparch and environmental samples
+        return False unless keepenv
+        Arguments:
+        - `domain`: taxid of the domain
+        - `taxid`: taxid of the record
+        """
+        if taxid == domain:
+            return True
+        if not self.known(taxid):
+            logging.warn("Can't find parent for taxonomy {}".format(taxid))
+            return False
+        m = self.marker[taxid]
+        while m:
+            if m == domain:
+                return True
+            if m == VIRUSES and not keepvir:
+                return True
+            if m == ENVIRONMENTAL and not keepenv:
+                return False
+            if m == ARCHAEA and not keeparch:
+                return True
+            p = self.parent[m]
+            if p == m or p < 0:
+                return False
+            m = self.marker[p]
+        return False
+
+
+def lineage_table(nodes, cache=None, source=None):
+    """
+    Return the LineageTable of the nodes. If the cache file exists and is newer than the source, load it,
+    otherwise build the table and save it to the cache file (if given and writable)
+    Arguments:
+    - `nodes`: nodes.dmp file or a function returning an iterator of (taxid, parent)
+    - `cache`: binary table file
+    - `source`: The file the nodes are read from, nodes by default
+    """
+    if source is None and not callable(nodes):
+        source = nodes
+    with metrics.stage("lineage_table"):
+        if cache and os.path.exists(cache) and (source is None or os.path.getmtime(cache) >= os.path.getmtime(source)):
+            return LineageTable.load(cache)
+        table = LineageTable.build(nodes() if callable(nodes) else read_nodes(nodes))
+        if cache and os.access(os.path.dirname(os.path.abspath(cache)), os.W_OK):
+            table.save(cache)
+    return table
+
+
+def taxonomy_lineages(dbfile, taxdir=None):
+    """
+    Return the LineageTable of the taxonomy, build it from nodes.dmp if the taxonomy dir is given, otherwise from the
+    database. The table is saved next to the source and reused
+    Arguments:
+    - `dbfile`: sqlite3 taxonomy database file
+    - `taxdir`: kraken taxonomy dir with nodes.dmp
+    """
+    if taxdir:
+        return lineage_table("{}/nodes.dmp".format(taxdir), "{}/nodes.lineage.npy".format(taxdir))
+    if dbfile == ':memory:':
+        raise ValueError("The lineages can't be read from a new in-memory database, give the taxonomy dir or a database file")
+
+    def nodes():
+        conn = sqlite3.connect(dbfile)
+        try:
+            for (t, p) in conn.execute("select taxid, parent from nodes"):
+                yield (t, p)
+        finally:
+            conn.close()
+    return lineage_table(nodes, "{}.lineage.npy".format(dbfile), dbfile)
+
+
+# Number of rows inserted in each transaction
+LOAD_BATCH = 200000
+LOAD_PRAGMAS = ("PRAGMA journal_mode=WAL", "PRAGMA synchronous=OFF", "PRAGMA cache_size=-262144", "PRAGMA temp_store=MEMORY")
+
+
+def fasta_accessions(fasta):
+    """
+    Return the set of accessions (without version) of the fasta records that need a taxid lookup,
+    records with kraken:taxid headers are skipped
+    Arguments:
+    - `fasta`: kraken fasta file
+    """
+    accs = set()
+    with open(fasta, 'rb') as fin:
+        for line in fin:
+            if line.startswith(b">") and not line.startswith(b">kraken"):
+                accs.add(line[1:].split(None, 1)[0].split(b".")[0].decode('ascii'))
+    return accs
+
+
+def _load_table(conn, table, fname, parse, header=False, batch=LOAD_BATCH):
+    """
+    Load the rows parsed from the lines of a file to the table, in batches. Each batch is committed together
+    with the file offset it reached in load_progress so an interrupted load continues from the last batch
+    Return the number of rows loaded from the file
+    Arguments:
+    - `conn`: sqlite3 connection
+    - `table`: table name
+    - `fname`: input file
+    - `parse`: function from a decoded line to a row tuple or None to skip the line
+    - `header`: skip the first line of the file
+    - `batch`: number of rows in a transaction
+    """
+    name = os.path.basename(fname)
+    row = conn.execute("SELECT offset, rows, done FROM load_progress WHERE name=?", (name,)).fetchone()
+    (offset, nrows, done) = row if row else (0, 0, 0)
+    if done:
+        logging.info("{} already loaded, {} rows".format(name, nrows))
+        return nrows
+    size = os.path.getsize(fname)
+    ncols = len(conn.execute("SELECT * FROM {} LIMIT 0".format(table)).description)
+    insert = "INSERT INTO {} VALUES ({})".format(table, ",".join("?" * ncols))
+    with open(fname, 'rb') as fin:
+        fin.seek(offset)
+        if offset == 0 and header:
+            offset += len(fin.readline())
+        rows = []
+        for line in fin:
+            offset += len(line)
+            rec = parse(line.decode('ascii'))
+            if rec is not None:
+                rows.append(rec)
+            if len(rows) >= batch:
+                conn.executemany(insert, rows)
+                nrows += len(rows)
+                conn.execute("INSERT OR REPLACE INTO load_progress VALUES (?,?,?,0)", (name, offset, nrows))
+                conn.commit()
+                logging.info("{}: {} rows loaded ({:.1f}%)".format(name, nrows, 100.0 * offset / max(1, size)))
+                rows = []
+        conn.executemany(insert, rows)
+        nrows += len(rows)
+        conn.execute("INSERT OR REPLACE INTO load_progress VALUES (?,?,?,1)", (name, offset, nrows))
+        conn.commit()
+    logging.info("{}: done, {} rows loaded".format(name, nrows))
+    return nrows
+
+
+def build_taxonomy_db(dbfile, taxdir, accessions=None, batch=LOAD_BATCH):
+    """
+    Load the taxonomy (nodes.dmp, names.dmp and *accession2taxid files) to an sqlite3 database.
+    The files are streamed in batched transactions and the accession index is created after the load.
+    If the load is interrupted, running it again with the same arguments continues it
+    Return a dictionary of table -> number of rows loaded from the files
+    Arguments:
+    - `dbfile`: sqlite3 database file
+    - `taxdir`: taxonomy directory, should contain names.dmp, nodes.dmp and *accession2taxid files
+    - `accessions`: Load only these accessions (without version) to acc2taxid, e.g. fasta_accessions of the kraken fasta
+    - `batch`: number of rows in a transaction
+    """
+    conn = sqlite3.connect(dbfile)
+    for pragma in LOAD_PRAGMAS:
+        conn.execute(pragma)
+    conn.execute('''CREATE TABLE IF NOT EXISTS nodes(
+                 taxid INTEGER PRIMARY KEY,
+                 parent INTEGER,
+                 rank text,
+                     FOREIGN KEY (parent) REFERENCES nodes(taxid))''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS names(
+                 taxid INTEGER,
+                 name text NOT NULL,
+                 class text NOT NULL,
+                     FOREIGN KEY (taxid) REFERENCES nodes(taxid))''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS acc2taxid(
+                 acc text NOT NULL,
+                 taxid INTEGER NOT NULL,
+                     FOREIGN KEY (taxid) REFERENCES nodes(taxid))''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS load_progress(
+                 name text PRIMARY KEY,
+                 offset INTEGER,
+                 rows INTEGER,
+                 done INTEGER)''')
+    conn.commit()
+    counts = {}
+
+    def dmp(cols):
+        def parse(line):
+            spl = line.strip().split("\t|\t")
+            return tuple(spl[i] for i in cols)
+        return parse
+
+    def acc2taxid(line):
+        spl = line.split()
+        if accessions is not None and spl[0] not in accessions:
+            return None
+        return (spl[0], spl[2])
+
+    logging.info("Inserting values to taxonomy tables")
+    with metrics.stage("load_nodes"):
+        counts['nodes'] = _load_table(conn, "nodes", os.path.join(taxdir, "nodes.dmp"), dmp((0, 1, 2)), batch=batch)
+    with metrics.stage("load_names"):
+        counts['names'] = _load_table(conn, "names", os.path.join(taxdir, "names.dmp"), dmp((0, 1, 3)), batch=batch)
+    counts['acc2taxid'] = 0
+    with metrics.stage("load_acc2taxid"):
+        for fname in sorted(glob.glob(os.path.join(taxdir, "*accession2taxid"))):
+            counts['acc2taxid'] += _load_table(conn, "acc2taxid", fname, acc2taxid, header=True, batch=batch)
+    logging.info("Creating accession index")
+    with metrics.stage("acc_index"):
+        conn.execute("CREATE INDEX IF NOT EXISTS acc_index ON acc2taxid(acc ASC)")
+        conn.execute("INSERT OR REPLACE INTO load_progress VALUES ('acc_index', 0, 0, 1)")
+        conn.commit()
+    conn.execute("PRAGMA journal_mode=DELETE")
+    conn.close()
+    return counts
+
+
+def taxonomy_db_complete(dbfile):
+    """
+    Return True if the taxonomy database exists and its load is complete
+    """
+    if dbfile == ':memory:' or not os.path.exists(dbfile):
+        return False
+    conn = sqlite3.connect(dbfile)
+    tables = set(x[0] for x in conn.execute("SELECT name FROM sqlite_master WHERE type='table'"))
+    if 'load_progress' not in tables:
+        # Built before the load was tracked
+        complete = 'nodes' in tables
+    else:
+        complete = conn.execute("SELECT done FROM load_progress WHERE name='acc_index'").fetchone() is not None
+    conn.close()
+    return complete
+
+
+class SQLiteAccessions(object):
+    """
+    Resolve accessions to taxids in batches by joining a temporary table of the accessions with acc2taxid
+    Works with sqlite3 and apsw connections
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.cursor = conn.cursor()
+        self.cursor.execute("CREATE TEMP TABLE IF NOT EXISTS query_acc(acc TEXT PRIMARY KEY)")
+
+    def resolve(self, accs):
+        """
+        Return a dictionary accession -> taxid of the accessions found in the database
+        """
+        with metrics.stage("accession_lookup"):
+            self.cursor.execute("DELETE FROM query_acc")
+            self.cursor.executemany("INSERT OR IGNORE INTO query_acc VALUES (?)", ((x,) for x in accs))
+            found = {}
+            for (acc, taxid) in self.cursor.execute("SELECT q.acc, a.taxid FROM query_acc q JOIN acc2taxid a ON a.acc=q.acc"):
+                found.setdefault(acc, taxid)
+        metrics.count("accessions_found", len(found))
+        return found
+
+
+class SortedAccessions(object):
+    """
+    Sorted array of fixed width accessions and the array of their taxids, memory mapped from .npy files
+    Accessions are resolved in batches with a binary search
+    """
+
+    def __init__(self, accs, taxids):
+        self.accs = accs
+        self.taxids = taxids
+
+    @staticmethod
+    def files(fname):
+        return ("{}.acc.npy".format(fname), "{}.taxid.npy".format(fname))
+
+    @classmethod
+    def build(cls, dbfile, fname, chunk=LOAD_BATCH):
+        """
+        Write the accessions and taxids of the database sorted by accession
+        Arguments:
+        - `dbfile`: sqlite3 taxonomy database
+        - `fname`: index file prefix
+        """
+        conn = sqlite3.connect(dbfile)
+        (nacc, width) = conn.execute("SELECT count(*), max(length(acc)) FROM acc2taxid").fetchone()
+        (accfile, taxfile) = cls.files(fname)
+        accs = np.lib.format.open_memmap(accfile + ".tmp", mode='w+', dtype="S{}".format(max(1, width or 1)), shape=(nacc,))
+        taxids = np.lib.format.open_memmap(taxfile + ".tmp", mode='w+', dtype=np.int32, shape=(nacc,))
+        cur = conn.execute("SELECT acc, taxid FROM acc2taxid ORDER BY acc")
+        pos = 0
+        while True:
+            rows = cur.fetchmany(chunk)
+            if not rows:
+                break
+            accs[pos:pos + len(rows)] = [x[0].encode('ascii') for x in rows]
+            taxids[pos:pos + len(rows)] = [x[1] for x in rows]
+            pos += len(rows)
+            logging.info("Accession index: {} of {} written".format(pos, nacc))
+        conn.close()
+        del accs, taxids
+        os.rename(accfile + ".tmp", accfile)
+        os.rename(taxfile + ".tmp", taxfile)
+
+    @classmethod
+    def load(cls, fname):
+        (accfile, taxfile) = cls.files(fname)
+        return cls(np.load(accfile, mmap_mode='r'), np.load(taxfile, mmap_mode='r'))
+
+    def resolve(self, accs):
+        """
+        Return a dictionary accession -> taxid of the accessions found in the index
+        """
+        accs = list(accs)
+        if not accs or not len(self.accs):
+            return {}
+        with metrics.stage("accession_lookup"):
+            query = np.array([x.encode('ascii') for x in accs], dtype="S{}".format(max(1, max(len(x) for x in accs))))
+            pos = np.minimum(np.searchsorted(self.accs, query), len(self.accs) - 1)
+            hit = self.accs[pos] == query
+            found = dict((acc, int(t)) for acc, t, h in zip(accs, self.taxids[pos], hit) if h)
+        metrics.count("accessions_found", len(found))
+        return found
+
+
+def physical_memory():
+    """
+    Return the size of the physical memory in bytes, None if not known
+    """
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def accession_lookup(dbfile, index=None, memory_limit=None):
+    """
+    Return an object that resolves accessions to taxids in batches with a resolve method:
+    - The sorted accession index if index is given, it's built from the database if it doesn't exist
+    - A copy of the database in memory if the database file is smaller than memory_limit
+    - Batched joins against the database on disk otherwise
+    Arguments:
+    - `dbfile`: sqlite3 taxonomy database
+    - `index`: sorted accessions index prefix
+    - `memory_limit`: largest database (in bytes) to copy to memory, a quarter of the physical memory by default
+    """
+    if dbfile == ':memory:':
+        # A new connection to :memory: is a new empty database
+        raise ValueError("Accessions can't be looked up in an in-memory database, build the taxonomy database in a file")
+    if index:
+        if not all(os.path.exists(x) for x in SortedAccessions.files(index)):
+            logging.info("Building accession index {}".format(index))
+            with metrics.stage("build_acc_index"):
+                SortedAccessions.build(dbfile, index)
+        return SortedAccessions.load(index)
+    if memory_limit is None:
+        memory_limit = (physical_memory() or 0) // 4
+    if os.path.getsize(dbfile) <= memory_limit:
+        import apsw
+        logging.info("Copying the database to memory")
+        with metrics.stage("copy_db_to_memory"):
+            diskconn = apsw.Connection(dbfile)
+            dbconn = apsw.Connection(":memory:")
+            with dbconn.backup("main", diskconn, "main") as backup:
+                backup.step()
+            diskconn.close()
+        return SQLiteAccessions(dbconn)
+    return SQLiteAccessions(sqlite3.connect(dbfile))
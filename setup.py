@@ -14,10 +14,12 @@ setup(name='domain_classifier',
       scripts=[
         'bin/build_domains_DB.py',
         'bin/predict_domain.py',
-        'bin/filter_kraken_db.py'], 
+        'bin/filter_kraken_db.py',
+        'bin/domain_classifier_daemon.py',
+        'bin/domain_classifier_batch.py'], 
       install_requires=[
-        'biopython',
         'apsw',
+        'numpy',
         ],
       zip_safe=False,
       url='https://github.com/asafpr/domain_classifier',